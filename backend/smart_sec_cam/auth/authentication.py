@@ -1,57 +1,100 @@
 import datetime
 import os
+from typing import Callable, Optional
+
 import jwt
 import logging
 from smart_sec_cam.auth.database import AuthDatabase
+from smart_sec_cam.auth.models import User
+from smart_sec_cam.auth.throttle import LoginThrottle
+from smart_sec_cam.auth.token_cache import TokenCache
 
 logger = logging.getLogger(__name__)
 
 class Authenticator:
     JWT_SECRET_LENGTH = 24
     TOKEN_DURATION_HOURS = 1
+    # A refreshed token is still accepted for this long, for requests already made with it (e.g. by media elements, or
+    # other tabs that haven't seen the new token yet)
+    REFRESH_GRACE_SECONDS = 30
 
-    def __init__(self, auth_db: AuthDatabase):
+    def __init__(self, auth_db: AuthDatabase, token_cache_size: int = 1024, run_blocking: Optional[Callable] = None,
+                 login_throttle: Optional[LoginThrottle] = None, secret: Optional[bytes] = None,
+                 on_revoke: Optional[Callable[[bytes, float, float], None]] = None):
         self.auth_db = auth_db
-        self.secret = os.urandom(self.JWT_SECRET_LENGTH)
+        # Processes that accept each other's tokens (e.g. server workers) must be given the same secret
+        self.secret = secret or os.urandom(self.JWT_SECRET_LENGTH)
+        # Avoids repeating signature verification for every request made with the same token
+        self.token_cache = TokenCache(self._now, max_entries=token_cache_size)
+        # Password hashing is CPU bound. run_blocking(func, *args) lets the caller move it off its event loop (e.g.
+        # eventlet.tpool.execute); by default it runs inline.
+        self.run_blocking = run_blocking or self._run_inline
+        self.login_throttle = login_throttle or LoginThrottle()
+        # Called with (token digest, time the revocation takes effect, token expiry) when a token is revoked, e.g. to
+        # share it with other processes, which apply it with token_cache.add_revocation()
+        self.on_revoke = on_revoke
 
     def authenticate(self, username: str, password: str, client_ip_addr: str) -> str:
-        existing_user = self.auth_db.get_user_by_username(username)
-        if not existing_user:
-            raise ValueError(f"Failed to find user with username: {username}")
-        if not existing_user.does_password_match(password):
-            raise ValueError(f"Password mismatch for user: {username}")
+        with self.login_throttle.attempt(client_ip_addr, username):
+            existing_user = self.auth_db.get_user_by_username(username)
+            if not existing_user:
+                raise ValueError(f"Failed to find user with username: {username}")
+            if not self.run_blocking(existing_user.does_password_match, password):
+                raise ValueError(f"Password mismatch for user: {username}")
         return self._generate_token(existing_user.user_id, client_ip_addr)
 
+    def set_password(self, user: User, password: str, client_ip_addr: str):
+        with self.login_throttle.attempt(client_ip_addr, user.username):
+            self.run_blocking(user.set_password, password)
+
     def validate_token(self, token: str, client_ip_addr: str) -> bool:
+        if not isinstance(token, str):
+            return False
+        cached_result = self.token_cache.get(token, client_ip_addr)
+        if cached_result is not None:
+            return cached_result
         try:
             payload = jwt.decode(token, self.secret, algorithms=['HS256'])
             is_valid = (
-                payload['exp'] > datetime.datetime.utcnow().timestamp()
+                payload['exp'] > self._now()
                 and payload['client_ip'] == client_ip_addr
             )
-            if not is_valid:
+            if is_valid:
+                self.token_cache.put_valid(token, client_ip_addr, payload['exp'])
+            else:
                 logger.warning("Token validation failed: Exp=%s, IP=%s", payload['exp'], payload['client_ip'])
+                self.token_cache.put_invalid(token, client_ip_addr)
             return is_valid
         except jwt.ExpiredSignatureError:
             logger.warning("Token expired.")
+            self.token_cache.put_invalid(token, client_ip_addr)
             return False
         except jwt.InvalidTokenError as e:
             logger.warning("Invalid token: %s", e)
+            self.token_cache.put_invalid(token, client_ip_addr)
             return False
 
     def refresh_token(self, token: str, client_ip_addr: str) -> str:
         try:
             if self.validate_token(token, client_ip_addr):
                 payload = jwt.decode(token, self.secret, algorithms=['HS256'])
-                return self._generate_token(payload['sub'], client_ip_addr)
+                new_token = self._generate_token(payload['sub'], client_ip_addr)
+                # The old token has been exchanged, so it should no longer be accepted once in-flight requests are done
+                self.revoke_token(token, payload['exp'], self.REFRESH_GRACE_SECONDS)
+                return new_token
         except jwt.InvalidTokenError as e:
             logger.warning("Failed to refresh token: %s", e)
         return None
 
+    def revoke_token(self, token: str, exp: float, grace_period: float = 0):
+        digest, revoke_from = self.token_cache.revoke(token, exp, grace_period)
+        if self.on_revoke:
+            self.on_revoke(digest, revoke_from, exp)
+
     def get_token_ttl(self, token: str) -> float:
         try:
             payload = jwt.decode(token, self.secret, algorithms=['HS256'])
-            return payload['exp'] - datetime.datetime.utcnow().timestamp()
+            return payload['exp'] - self._now()
         except jwt.InvalidTokenError as e:
             logger.warning("Failed to get token TTL: %s", e)
             return -1
@@ -64,3 +107,12 @@ class Authenticator:
             'client_ip': client_ip_addr
         }
         return jwt.encode(payload, self.secret, algorithm='HS256')
+
+    @staticmethod
+    def _run_inline(func: Callable, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    @staticmethod
+    def _now() -> float:
+        # Token timestamps are generated from utcnow(), so they must be compared against the same clock
+        return datetime.datetime.utcnow().timestamp()
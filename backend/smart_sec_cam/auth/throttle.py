@@ -0,0 +1,86 @@
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, Deque
+
+
+class LoginThrottledError(Exception):
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LoginThrottle:
+    """
+    Rate and concurrency limits for password hashing.
+
+    Attempts are limited per client IP, and per username from each client IP, so a client guessing one user's password
+    can't lock that user out for everyone else. Each login or registration costs a full PBKDF2 run, so at most
+    max_concurrent hashes run at once; further attempts wait up to queue_timeout seconds for a slot before being
+    rejected.
+
+    State is kept in memory. Where the limits are shared by several processes (e.g. server workers), each enforces its
+    share of them, so a client whose attempts all reach one process is limited sooner.
+    """
+    def __init__(self, max_attempts: int = 10, max_attempts_per_ip: int = 30, window_seconds: float = 60,
+                 max_concurrent_per_key: int = 1, max_concurrent: int = 2, queue_timeout: float = 5.0,
+                 processes: int = 1):
+        self.max_attempts = math.ceil(max_attempts / processes)
+        self.max_attempts_per_ip = math.ceil(max_attempts_per_ip / processes)
+        self.window_seconds = window_seconds
+        self.max_concurrent_per_key = max_concurrent_per_key
+        self.queue_timeout = queue_timeout
+        self._attempts: Dict[str, Deque[float]] = {}
+        self._in_flight: Dict[str, int] = {}
+        self._hashing_slots = threading.BoundedSemaphore(max(1, max_concurrent // processes))
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def attempt(self, client_ip_addr: str, username: str):
+        """
+        Reserve a hashing slot for this client and user, waiting for one if they're all in use. Raises
+        LoginThrottledError if limits are exceeded or no slot becomes free in time.
+        """
+        user_key = f"user:{client_ip_addr}:{username}"
+        self._acquire(f"ip:{client_ip_addr}", user_key)
+        try:
+            if not self._hashing_slots.acquire(timeout=self.queue_timeout):
+                raise LoginThrottledError("Too many concurrent login attempts")
+            try:
+                yield
+            finally:
+                self._hashing_slots.release()
+        finally:
+            self._release(user_key)
+
+    def _acquire(self, ip_key: str, user_key: str):
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            for key, max_attempts in ((ip_key, self.max_attempts_per_ip), (user_key, self.max_attempts)):
+                attempts = self._attempts.get(key)
+                if attempts and len(attempts) >= max_attempts:
+                    retry_after = int(attempts[0] + self.window_seconds - now) + 1
+                    raise LoginThrottledError(f"Too many attempts for {key}", retry_after)
+            # Clients behind the same address may log in at once, but each only needs one attempt at a time
+            if self._in_flight.get(user_key, 0) >= self.max_concurrent_per_key:
+                raise LoginThrottledError(f"Attempt already in progress for {user_key}")
+            for key in (ip_key, user_key):
+                self._attempts.setdefault(key, deque()).append(now)
+            self._in_flight[user_key] = self._in_flight.get(user_key, 0) + 1
+
+    def _release(self, user_key: str):
+        with self._lock:
+            self._in_flight[user_key] -= 1
+            if self._in_flight[user_key] <= 0:
+                del self._in_flight[user_key]
+
+    def _prune(self, now: float):
+        for key in list(self._attempts.keys()):
+            attempts = self._attempts[key]
+            while attempts and attempts[0] <= now - self.window_seconds:
+                attempts.popleft()
+            if not attempts:
+                del self._attempts[key]
@@ -0,0 +1,80 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Dict, Tuple
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of token validation results, keyed by token digest and client IP.
+
+    Valid tokens are cached until their `exp` claim. Invalid tokens are cached for `negative_ttl` seconds. Revoked
+    tokens are remembered until they would have expired, independently of the LRU, so eviction can't un-revoke them.
+    A revocation can be given a grace period, during which the token is still accepted.
+    """
+    def __init__(self, clock: Callable[[], float], max_entries: int = 1024, negative_ttl: float = 30):
+        self.clock = clock
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[Tuple[bytes, str], Tuple[bool, float]]" = OrderedDict()
+        # Token digest -> (time the revocation takes effect, token expiry)
+        self._revoked: Dict[bytes, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, token: str, client_ip_addr: str) -> Optional[bool]:
+        """Return the cached validation result, or None if the token must be verified."""
+        digest = self._digest(token)
+        key = (digest, client_ip_addr)
+        now = self.clock()
+        with self._lock:
+            revocation = self._revoked.get(digest)
+            if revocation is not None and revocation[0] <= now:
+                return False
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            is_valid, expires_at = entry
+            if expires_at <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return is_valid
+
+    def put_valid(self, token: str, client_ip_addr: str, exp: float):
+        self._put(token, client_ip_addr, True, exp)
+
+    def put_invalid(self, token: str, client_ip_addr: str):
+        self._put(token, client_ip_addr, False, self.clock() + self.negative_ttl)
+
+    def revoke(self, token: str, exp: float, grace_period: float = 0) -> Tuple[bytes, float]:
+        """
+        Reject a token once grace_period seconds have passed, e.g. after it has been exchanged for a new one. A token
+        that is already revoked keeps its original deadline. Returns the token's digest and the time the revocation
+        takes effect, so it can be shared with other processes (see add_revocation()).
+        """
+        digest = self._digest(token)
+        return digest, self.add_revocation(digest, self.clock() + grace_period, exp)
+
+    def add_revocation(self, digest: bytes, revoke_from: float, exp: float) -> float:
+        """Reject a token, given by its digest, from revoke_from. Returns the time the revocation takes effect."""
+        now = self.clock()
+        with self._lock:
+            self._revoked = {key: revocation for key, revocation in self._revoked.items() if revocation[1] > now}
+            return self._revoked.setdefault(digest, (revoke_from, exp))[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._revoked.clear()
+
+    def _put(self, token: str, client_ip_addr: str, is_valid: bool, expires_at: float):
+        key = (self._digest(token), client_ip_addr)
+        with self._lock:
+            self._entries[key] = (is_valid, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
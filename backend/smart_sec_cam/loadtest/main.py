@@ -0,0 +1,231 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+from typing import Dict, List, Optional
+
+import requests
+
+from smart_sec_cam.loadtest.monitor import ProcessMonitor, RedisMonitor
+from smart_sec_cam.loadtest.viewer import Viewer
+from smart_sec_cam.streamer.camera import SyntheticCamera
+from smart_sec_cam.streamer.sender import FrameSender
+from smart_sec_cam.streamer.streamer import Streamer, FRAMES_DISCARDED, FRAMES_SKIPPED
+
+
+CHANNEL_PREFIX = "loadtest"
+PERCENTILES = (50, 90, 99)
+
+
+class LoadTest:
+    """
+    Runs simulated cameras and viewers against a server, and measures how well it keeps up.
+
+    Each camera is a Streamer with a SyntheticCamera and its own connection to Redis, like a separate device. Viewers
+    are spread evenly across the cameras' rooms. Optionally, the CPU and memory use of the server and motion processes
+    are sampled, and Redis throughput is measured from its INFO statistics.
+    """
+    def __init__(self, server_url: str, token: str, redis_host: str, redis_port: int, redis_ssl: bool = False,
+                 camera_count: int = 1, viewer_count: int = 1, resolution=(1280, 720), fps: float = 10.0,
+                 jpeg_quality: int = 70, moving: bool = True, adaptive_quality: bool = False,
+                 process_pids: Optional[Dict[str, List[int]]] = None):
+        self.channels = [f"{CHANNEL_PREFIX}-{index}" for index in range(camera_count)]
+        self.senders = [FrameSender(redis_host, redis_port, ssl=redis_ssl) for _ in self.channels]
+        self.streamers = [Streamer(sender, SyntheticCamera(resolution, jpeg_quality, moving=moving), channel, fps=fps,
+                                   adaptive_quality=adaptive_quality)
+                          for sender, channel in zip(self.senders, self.channels)]
+        self.viewers = [Viewer(server_url, token, self.channels[index % camera_count]) for index in range(viewer_count)]
+        self.redis_monitor = RedisMonitor(redis_host, redis_port, redis_ssl)
+        self.process_monitors = [ProcessMonitor(name, pids) for name, pids in (process_pids or {}).items()]
+        # The load test's own use, to tell whether it was the bottleneck
+        self.process_monitors.append(ProcessMonitor("loadtest", [os.getpid()]))
+        self.start_time = 0.0
+        self.frames_sent_at_start = 0
+        self.frames_dropped_at_start = 0.0
+
+    def run(self, duration: float, warmup: float = 15.0) -> Dict:
+        threads = []
+        for sender in self.senders:
+            threads.append(Thread(target=sender.run, daemon=True))
+        for streamer in self.streamers:
+            threads.append(Thread(target=streamer.capture_images, daemon=True))
+            threads.append(Thread(target=streamer.encode_images, daemon=True))
+        for thread in threads:
+            thread.start()
+        # Cameras have to be publishing before the server will list their rooms
+        time.sleep(1)
+        for viewer in self.viewers:
+            viewer.connect()
+        for monitor in self.process_monitors:
+            monitor.start()
+        print(f"Warming up for {warmup}s")
+        time.sleep(warmup)
+        self._reset()
+        print(f"Measuring for {duration}s")
+        time.sleep(duration)
+        report = self._report()
+        self._stop()
+        return report
+
+    def _reset(self):
+        for viewer in self.viewers:
+            viewer.reset()
+        for monitor in self.process_monitors:
+            monitor.reset()
+        self.redis_monitor.start()
+        self.start_time = time.monotonic()
+        self.frames_sent_at_start = self._get_frames_sent()
+        self.frames_dropped_at_start = self._get_frames_dropped()
+
+    def _report(self) -> Dict:
+        elapsed_time = time.monotonic() - self.start_time
+        latencies = sorted(latency for viewer in self.viewers for latency in viewer.latencies)
+        frames_sent = self._get_frames_sent() - self.frames_sent_at_start
+        frames_received = sum(viewer.frames_received for viewer in self.viewers)
+        return {
+            "cameras": len(self.streamers),
+            "viewers": len(self.viewers),
+            "duration": elapsed_time,
+            "frames_sent_per_second": frames_sent / elapsed_time,
+            "frames_received_per_second": frames_received / elapsed_time,
+            # Frames the streamers couldn't capture or send in time, and frames that never reached a viewer
+            "frames_dropped_by_cameras": self._get_frames_dropped() - self.frames_dropped_at_start,
+            "frames_missed_by_viewers": sum(viewer.frames_missed for viewer in self.viewers),
+            "latency_seconds": {
+                **{f"p{percentile}": get_percentile(latencies, percentile) for percentile in PERCENTILES},
+                "max": latencies[-1] if latencies else None,
+            },
+            "processes": {monitor.name: monitor.summary() for monitor in self.process_monitors},
+            "redis": self.redis_monitor.summary(),
+        }
+
+    def _get_frames_sent(self) -> int:
+        return sum(streamer.sequence for streamer in self.streamers)
+
+    def _get_frames_dropped(self) -> float:
+        return sum(FRAMES_SKIPPED.labels(channel).value + FRAMES_DISCARDED.labels(channel).value
+                   for channel in self.channels)
+
+    def _stop(self):
+        for viewer in self.viewers:
+            viewer.disconnect()
+        for monitor in self.process_monitors:
+            monitor.stop()
+        for streamer in self.streamers:
+            streamer.shutdown = True
+        for sender in self.senders:
+            sender.shutdown = True
+
+
+def get_percentile(values: List[float], percentile: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def get_token(server_url: str, username: str, password: str, verify_ssl: bool = False) -> str:
+    response = requests.post(f"{server_url}/api/auth/login", json={"username": username, "password": password},
+                             verify=verify_ssl)
+    response.raise_for_status()
+    return response.json()["token"]
+
+
+def start_motion_service(redis_host: str, redis_port: int, data_dir: str) -> subprocess.Popen:
+    """Run the motion service against the load test's Redis, recording to a scratch directory."""
+    environment = dict(os.environ, DB_PATH=os.path.join(data_dir, "db", "videos.db"))
+    environment.setdefault("MOTION_THRESHOLD", "10000")
+    return subprocess.Popen([sys.executable, "-m", "smart_sec_cam.motion.main", "--redis-url", redis_host,
+                             "--redis-port", str(redis_port), "--video-dir", os.path.join(data_dir, "videos"),
+                             "--encoder", "opencv"], env=environment)
+
+
+def print_report(report: Dict):
+    latency = report["latency_seconds"]
+    print(f"{report['cameras']} cameras, {report['viewers']} viewers, {report['duration']:.0f}s")
+    print(f"  Frames sent: {report['frames_sent_per_second']:.1f}/s, received by viewers: "
+          f"{report['frames_received_per_second']:.1f}/s")
+    print(f"  Frames dropped by cameras: {report['frames_dropped_by_cameras']:.0f}, missed by viewers: "
+          f"{report['frames_missed_by_viewers']}")
+    print("  Latency: " + ", ".join(f"{name} {_format_ms(value)}" for name, value in latency.items()))
+    for name, summary in report["processes"].items():
+        print(f"  {name}: CPU {_format_number(summary['cpu_percent_mean'])}% mean, "
+              f"{_format_number(summary['cpu_percent_max'])}% max; RSS {_format_number(summary['rss_mb_max'])} MB max")
+    redis_summary = report["redis"]
+    print(f"  redis: {redis_summary['commands_per_second']:.0f} commands/s, "
+          f"{redis_summary['input_mb_per_second']:.1f} MB/s in, {redis_summary['output_mb_per_second']:.1f} MB/s out, "
+          f"CPU {redis_summary['cpu_percent']:.0f}%, {redis_summary['used_memory_mb']:.0f} MB")
+
+
+def _format_ms(value: Optional[float]) -> str:
+    return f"{value * 1000:.0f}ms" if value is not None else "n/a"
+
+
+def _format_number(value: Optional[float]) -> str:
+    return f"{value:.0f}" if value is not None else "n/a"
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Load test the server with simulated cameras and viewers",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--server-url', help='Server to connect viewers to', type=str, default='https://localhost:8443')
+    parser.add_argument('--username', help='User to log the viewers in as', type=str, default=None)
+    parser.add_argument('--password', help='Password for --username', type=str, default=None)
+    parser.add_argument('--token', help='Token to use instead of logging in', type=str, default=None)
+    parser.add_argument('--redis-url', help='Redis address to publish frames to', type=str, default='localhost')
+    parser.add_argument('--redis-port', help='Redis port to publish frames to', type=int, default=6379)
+    parser.add_argument('--redis-ssl', help='Connect to Redis over TLS (e.g. on port 6380)', action='store_true')
+    parser.add_argument('--cameras', help='Number of simulated cameras', type=int, default=1)
+    parser.add_argument('--viewers', help='Number of simulated viewers, spread across the cameras', type=int,
+                        default=1)
+    parser.add_argument('--width', help='Frame width', type=int, default=1280)
+    parser.add_argument('--height', help='Frame height', type=int, default=720)
+    parser.add_argument('--fps', help='Frame rate of each camera', type=float, default=10.0)
+    parser.add_argument('--jpeg-quality', help='JPEG quality of the synthetic frames', type=int, default=70)
+    parser.add_argument('--static', help='Send a still image, so no motion is detected', action='store_true')
+    parser.add_argument('--adaptive-quality', help='Let cameras reduce quality when Redis is congested',
+                        action='store_true')
+    parser.add_argument('--duration', help='Seconds to measure for', type=float, default=60)
+    parser.add_argument('--warmup', help='Seconds to run before measuring; with --start-motion, allow long enough for '
+                                         'the motion service to find the new cameras', type=float, default=15)
+    parser.add_argument('--server-pid', help='Server process to monitor (its worker processes are included)',
+                        type=int, action='append', default=[])
+    parser.add_argument('--motion-pid', help='Motion service process to monitor', type=int, action='append',
+                        default=[])
+    parser.add_argument('--start-motion', help='Run a motion service for the duration of the test, and monitor it',
+                        action='store_true')
+    parser.add_argument('--output', help='Write the report to this file as JSON', type=str, default=None)
+    args = parser.parse_args()
+
+    token = args.token or get_token(args.server_url, args.username, args.password)
+    process_pids = {}
+    if args.server_pid:
+        process_pids["server"] = args.server_pid
+    motion_process = None
+    data_dir = None
+    if args.start_motion:
+        data_dir = tempfile.TemporaryDirectory()
+        motion_process = start_motion_service(args.redis_url, args.redis_port, data_dir.name)
+        process_pids["motion"] = [motion_process.pid]
+    elif args.motion_pid:
+        process_pids["motion"] = args.motion_pid
+
+    load_test = LoadTest(args.server_url, token, args.redis_url, args.redis_port, args.redis_ssl, args.cameras,
+                         args.viewers, (args.width, args.height), args.fps, args.jpeg_quality, not args.static,
+                         args.adaptive_quality, process_pids)
+    try:
+        report = load_test.run(args.duration, args.warmup)
+    finally:
+        if motion_process is not None:
+            motion_process.terminate()
+            motion_process.wait()
+            data_dir.cleanup()
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
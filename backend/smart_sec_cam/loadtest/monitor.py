@@ -0,0 +1,112 @@
+import threading
+import time
+from typing import Dict, List, Optional
+
+import psutil
+import redis
+
+
+class ProcessMonitor:
+    """
+    Samples the CPU use and resident memory of a process and its children (e.g. forked server workers, or ffmpeg
+    encoders started by the motion service) in a background thread.
+    """
+    def __init__(self, name: str, pids: List[int], interval: float = 1.0):
+        self.name = name
+        self.processes = [psutil.Process(pid) for pid in pids]
+        self.interval = interval
+        # Total CPU (percent of one core) and RSS (bytes) at each sample
+        self.cpu_samples: List[float] = []
+        self.rss_samples: List[int] = []
+        self._cpu_times: Dict[int, float] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def reset(self):
+        self.cpu_samples = []
+        self.rss_samples = []
+
+    def summary(self) -> Dict:
+        return {
+            "cpu_percent_mean": _mean(self.cpu_samples),
+            "cpu_percent_max": max(self.cpu_samples, default=None),
+            "rss_mb_mean": _mean(self.rss_samples) / 1e6 if self.rss_samples else None,
+            "rss_mb_max": max(self.rss_samples) / 1e6 if self.rss_samples else None,
+        }
+
+    def _run(self):
+        last_time = time.monotonic()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            cpu_seconds, rss = self._sample()
+            self.cpu_samples.append(100 * cpu_seconds / (now - last_time))
+            self.rss_samples.append(rss)
+            last_time = now
+
+    def _sample(self):
+        """CPU seconds used since the last sample, and the current RSS, over the processes and their children."""
+        cpu_seconds = 0.0
+        rss = 0
+        for process in self._get_processes():
+            try:
+                cpu_times = process.cpu_times()
+                rss += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                continue
+            total_time = cpu_times.user + cpu_times.system
+            cpu_seconds += total_time - self._cpu_times.get(process.pid, total_time)
+            self._cpu_times[process.pid] = total_time
+        return cpu_seconds, rss
+
+    def _get_processes(self) -> List[psutil.Process]:
+        processes = []
+        for process in self.processes:
+            try:
+                processes.append(process)
+                processes.extend(process.children(recursive=True))
+            except psutil.NoSuchProcess:
+                pass
+        return processes
+
+
+class RedisMonitor:
+    """Measures Redis throughput from the difference in its INFO statistics over a period."""
+    def __init__(self, redis_host: str = "localhost", redis_port: int = 6379, ssl: bool = False):
+        self.r_conn = redis.StrictRedis(host=redis_host, port=redis_port, ssl=ssl, ssl_cert_reqs=None)
+        self.start_info: Optional[Dict] = None
+        self.start_time = 0.0
+
+    def start(self):
+        self.start_info = self.r_conn.info()
+        self.start_time = time.monotonic()
+
+    def summary(self) -> Dict:
+        info = self.r_conn.info()
+        elapsed_time = time.monotonic() - self.start_time
+
+        def rate(key: str, scale: float = 1.0) -> float:
+            return (info[key] - self.start_info[key]) / elapsed_time / scale
+
+        return {
+            "commands_per_second": rate("total_commands_processed"),
+            "input_mb_per_second": rate("total_net_input_bytes", 1e6),
+            "output_mb_per_second": rate("total_net_output_bytes", 1e6),
+            "cpu_percent": 100 * (rate("used_cpu_user") + rate("used_cpu_sys")),
+            "used_memory_mb": info["used_memory"] / 1e6,
+            "connected_clients": info["connected_clients"],
+            "pubsub_channels": info["pubsub_channels"],
+        }
+
+
+def _mean(values: List[float]) -> Optional[float]:
+    return sum(values) / len(values) if values else None
@@ -0,0 +1,56 @@
+import threading
+import time
+from typing import List, Optional
+
+import socketio
+
+from smart_sec_cam.redis import sequence_gap
+
+
+class Viewer:
+    """
+    A headless live view: connects to the server over Socket.IO, joins a room like the web UI does, and records the
+    capture-to-viewer latency of every frame it receives, and how many frames it missed.
+
+    Latency is measured against the capture time in the frame envelope, so the cameras and viewers must share a clock
+    (e.g. run on the same machine).
+    """
+    def __init__(self, server_url: str, token: str, room: str, verify_ssl: bool = False):
+        self.server_url = server_url
+        self.token = token
+        self.room = room
+        self.client = socketio.Client(ssl_verify=verify_ssl, reconnection=False)
+        self.client.on('image', self._on_image)
+        self.latencies: List[float] = []
+        self.frames_received = 0
+        self.frames_missed = 0
+        self.last_sequence: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        # Websocket only, as the web UI does, since the server may run several workers
+        self.client.connect(self.server_url, transports=['websocket'])
+        self.client.emit('join', {'token': self.token, 'room': self.room})
+
+    def disconnect(self):
+        self.client.disconnect()
+
+    def reset(self):
+        """Discard what has been recorded so far, e.g. at the end of the warmup period."""
+        with self._lock:
+            self.latencies = []
+            self.frames_received = 0
+            self.frames_missed = 0
+
+    def _on_image(self, payload: dict):
+        received_at = time.time()
+        with self._lock:
+            self.frames_received += 1
+            captured_at = payload.get('captured_at')
+            if captured_at is not None:
+                self.latencies.append(received_at - captured_at)
+            sequence = payload.get('seq')
+            if sequence is not None:
+                if self.last_sequence is not None:
+                    self.frames_missed += sequence_gap(self.last_sequence, sequence)
+                self.last_sequence = sequence
@@ -0,0 +1,3 @@
+from smart_sec_cam.metrics.registry import Counter, Gauge, Histogram, Registry, REGISTRY
+from smart_sec_cam.metrics.exporter import start_metrics_server, CONTENT_TYPE
+from smart_sec_cam.metrics.profiler import SamplingProfiler, Profile, write_profile
@@ -0,0 +1,69 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from smart_sec_cam.metrics.profiler import SamplingProfiler
+from smart_sec_cam.metrics.registry import Registry, REGISTRY
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def start_metrics_server(port: int, address: str = "0.0.0.0", registry: Optional[Registry] = REGISTRY,
+                         profiler: Optional[SamplingProfiler] = None, max_profile_seconds: float = 60,
+                         run_blocking: Optional[Callable] = None) -> ThreadingHTTPServer:
+    """
+    Serve `/metrics` from a background thread, for processes that don't otherwise run a web server, or whose metrics
+    shouldn't be served alongside the rest of their API. Pass registry=None to serve no metrics.
+
+    With a profiler, `POST /profile?seconds=<seconds>` also takes a profile and returns it as JSON. run_blocking(func,
+    *args) lets the caller take it from a real thread (e.g. eventlet.tpool.execute); by default it runs inline.
+    """
+    run_blocking = run_blocking or (lambda func, *args: func(*args))
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if registry is None or self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            self._send_body(200, CONTENT_TYPE, registry.render().encode("utf-8"))
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if profiler is None or url.path != "/profile":
+                self.send_error(404)
+                return
+            try:
+                seconds = min(float(parse_qs(url.query).get("seconds", ["10"])[0]), max_profile_seconds)
+            except ValueError:
+                self.send_error(400)
+                return
+            profile = run_blocking(profiler.profile, seconds)
+            if profile is None:
+                body = {'status': "ERROR", "error": "A profile is already being taken"}
+                self._send_body(409, "application/json", json.dumps(body).encode("utf-8"))
+                return
+            body = {'status': "OK", 'samples': profile.samples, 'duration': profile.duration,
+                    'stages': profile.stages, 'folded': profile.to_folded()}
+            self._send_body(200, "application/json", json.dumps(body).encode("utf-8"))
+
+        def _send_body(self, status: int, content_type: str, body: bytes):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes happen every few seconds; don't flood stdout with them
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    paths = (["/metrics"] if registry is not None else []) + (["/profile"] if profiler is not None else [])
+    print(f"Serving {', '.join(paths)} on {address}:{port}")
+    return server
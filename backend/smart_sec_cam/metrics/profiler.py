@@ -0,0 +1,149 @@
+import collections
+import gc
+import json
+import os
+import sys
+import threading
+import time
+import weakref
+from typing import Dict, List, NamedTuple, Optional
+
+from smart_sec_cam.metrics.registry import Histogram
+
+try:
+    import greenlet
+except ImportError:
+    greenlet = None
+
+
+MAX_STACK_DEPTH = 128
+# Suspended greenlets are found by scanning the heap, which is too slow to do for every sample
+GREENLET_SCAN_INTERVAL = 1.0
+
+
+class Profile(NamedTuple):
+    # Folded stack ("root;caller;callee") -> number of samples
+    stacks: Dict[str, int]
+    samples: int
+    duration: float
+    # Stage -> time spent in it while profiling, from the stage timers
+    stages: Dict[str, Dict]
+
+    def to_folded(self) -> str:
+        """The stacks in the folded format read by flamegraph.pl, speedscope, etc."""
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.stacks.items()))
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread and greenlet in this process, for a fixed time.
+
+    Nothing runs until profile() is called, which blocks the calling thread while it samples, so there's no overhead
+    the rest of the time. Under eventlet, profile() must be called from a real thread (e.g. with tpool.execute),
+    since the hub doesn't run while it samples.
+
+    Samples are of wall time: threads and greenlets that are waiting (e.g. on a socket) are sampled where they wait.
+    The time spent in each stage (e.g. {"decode": DECODE_SECONDS}) over the same period is read from the histograms
+    that already time them.
+    """
+    def __init__(self, interval: float = 0.01, stage_timers: Optional[Dict[str, Histogram]] = None):
+        self.interval = interval
+        self.stage_timers = stage_timers or {}
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def profile(self, duration: float) -> Optional[Profile]:
+        """Sample for duration seconds. Returns None if a profile is already being taken."""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._profile(duration)
+        finally:
+            self._lock.release()
+
+    def _profile(self, duration: float) -> Profile:
+        # Monkey-patched functions would switch greenlets (or report greenlet ids) rather than act on this thread
+        sleep = _original("time").sleep
+        own_thread_id = _original("_thread").get_ident()
+        stage_start = {name: timer.snapshot() for name, timer in self.stage_timers.items()}
+        stacks = collections.Counter()
+        greenlets = weakref.WeakSet()
+        samples = 0
+        start_time = time.monotonic()
+        last_scan_time = None
+        while time.monotonic() - start_time < duration:
+            if greenlet is not None and (last_scan_time is None
+                                         or time.monotonic() - last_scan_time >= GREENLET_SCAN_INTERVAL):
+                greenlets.update(obj for obj in gc.get_objects() if isinstance(obj, greenlet.greenlet))
+                last_scan_time = time.monotonic()
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread_id:
+                    stacks[_fold_stack(f"thread {thread_names.get(thread_id, thread_id)}", frame)] += 1
+            # A running greenlet is sampled as part of its thread; only suspended ones have a frame of their own
+            for suspended in list(greenlets):
+                frame = suspended.gr_frame
+                if frame is not None:
+                    stacks[_fold_stack("greenlets", frame)] += 1
+            samples += 1
+            sleep(self.interval)
+        elapsed_time = time.monotonic() - start_time
+        stages = {name: _get_stage_summary(stage_start[name], timer.snapshot(), elapsed_time)
+                  for name, timer in self.stage_timers.items()}
+        return Profile(dict(stacks), samples, elapsed_time, stages)
+
+
+def write_profile(profile: Profile, profile_dir: str, name: str) -> str:
+    """
+    Write a profile to `<profile_dir>/<name>-<time>.folded`, with the stage timings alongside it in
+    `.stages.json`. Returns the path of the folded stacks.
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    base_path = os.path.join(profile_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}")
+    with open(f"{base_path}.folded", 'w') as folded_file:
+        folded_file.write(profile.to_folded())
+    with open(f"{base_path}.stages.json", 'w') as stages_file:
+        json.dump({"samples": profile.samples, "duration": profile.duration, "stages": profile.stages}, stages_file,
+                  indent=2)
+    return f"{base_path}.folded"
+
+
+def _fold_stack(root: str, frame) -> str:
+    names: List[str] = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        # Keep the parent directory, so e.g. motion/main.py and server/main.py are told apart
+        file_name = os.path.join(os.path.basename(os.path.dirname(code.co_filename)),
+                                 os.path.basename(code.co_filename))
+        names.append(f"{code.co_name} ({file_name}:{code.co_firstlineno})".replace(";", ":"))
+        frame = frame.f_back
+    names.append(root)
+    return ";".join(reversed(names))
+
+
+def _get_stage_summary(start: Dict, end: Dict, duration: float) -> Dict:
+    """Time spent in a stage between two histogram snapshots, for each set of labels (e.g. each channel)."""
+    summary = {}
+    for labelvalues, (count, total) in end.items():
+        start_count, start_total = start.get(labelvalues, (0, 0.0))
+        count -= start_count
+        total -= start_total
+        if count:
+            summary[",".join(labelvalues) or "all"] = {
+                "count": count,
+                "seconds": total,
+                "mean_ms": 1000 * total / count,
+                "percent_of_wall_time": 100 * total / duration,
+            }
+    return summary
+
+
+def _original(module_name: str):
+    """A standard library module as it was before eventlet monkey-patched it, if it has."""
+    if "eventlet" in sys.modules:
+        from eventlet import patcher
+        return patcher.original(module_name)
+    return __import__(module_name)
@@ -1,15 +1,43 @@
 import queue
+import sqlite3
 import threading
 import time
-from typing import List
+from collections import deque
+from typing import Dict, List, Optional
 from math import ceil, dist
 
 import cv2
-import imutils
 import numpy as np
 
+from smart_sec_cam.metrics import Counter, Gauge, Histogram
+from smart_sec_cam.redis import unpack_frame, sequence_gap, FrameError, FLAG_REPLAYED
+from smart_sec_cam.server.video_db import VideoDatabase
+from smart_sec_cam.video.continuous import ContinuousRecorder
+from smart_sec_cam.video.encoders import FFmpegEncoder, create_encoder
+from smart_sec_cam.video.mjpeg import MjpegVideoWriter
+from smart_sec_cam.video.segments import LiveSegmentWriter
 from smart_sec_cam.video.writer import VideoWriter
-from smart_sec_cam.streamer.camera import webcam720p
+
+
+FRAME_QUEUE_DEPTH = Gauge("motion_frame_queue_depth", "Frames waiting for motion detection", ["channel"])
+FRAME_SAMPLE_RATE = Gauge("motion_frame_sample_rate", "Only every Nth frame is processed", ["channel"])
+FRAMES_PROCESSED = Counter("motion_frames_processed", "Frames run through motion detection", ["channel"])
+FRAMES_DROPPED = Counter("motion_frames_dropped", "Frames skipped by sampling to reduce backlog", ["channel"])
+DECODE_SECONDS = Histogram("motion_decode_seconds", "Time spent decoding a frame", ["channel"])
+DETECT_SECONDS = Histogram("motion_detect_seconds", "Time spent comparing two frames for motion", ["channel"])
+ENCODE_SECONDS = Histogram("motion_encode_seconds", "Time spent encoding a recorded video", ["channel"],
+                           buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+RECORDINGS = Counter("motion_recordings", "Completed recordings by outcome", ["channel", "result"])
+FRAMES_LOST = Counter("motion_frames_lost", "Frames missing from the sequence sent by the streamer", ["channel"])
+FRAME_LATENCY_SECONDS = Histogram("motion_frame_latency_seconds", "Time from capture to arrival at motion detection",
+                                  ["channel"])
+# Settings used at full resolution; they're scaled to the detection resolution
+BLUR_KERNEL_SIZE = 21
+DILATE_ITERATIONS = 2
+PIXEL_DELTA_THRESHOLD = 25
+# JPEG can be decoded directly at these reduced scales, which is much cheaper than a full decode
+REDUCED_GREYSCALE_DECODES = ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                             (2, cv2.IMREAD_REDUCED_GRAYSCALE_2))
 
 
 class MotionDetector:
@@ -20,7 +48,15 @@ class MotionDetector:
         cumulative_motion_threshold: int = 50, # px
         video_duration_seconds: int = 60,
         video_dir: str = "data/videos",
-        initial_frame_sample_rate: int = 2
+        initial_frame_sample_rate: int = 2,
+        live_segments: bool = False,
+        detection_width: int = 320,
+        passthrough_recording: bool = False,
+        encoder: str = "opencv",
+        encoder_options: Optional[Dict] = None,
+        continuous_recorder: Optional[ContinuousRecorder] = None,
+        video_db: Optional[VideoDatabase] = None,
+        index_motion: bool = False
     ):
         self.channel_name = channel_name
         self.motion_area_threshold = motion_area_threshold
@@ -29,7 +65,40 @@ class MotionDetector:
         self.cumulative_motion_threshold = cumulative_motion_threshold # pixels
         self.video_duration = video_duration_seconds
         self.video_dir = video_dir
-        self.video_writer = VideoWriter(self.channel_name, path=self.video_dir)
+        # In passthrough mode frames are recorded as the JPEGs received from the camera, so they're never decoded to
+        # full colour images or re-encoded; the recordings are transcoded later
+        self.passthrough_recording = passthrough_recording
+        # In continuous mode every frame is recorded to segments by the continuous recorder, and motion is marked on
+        # the timeline in the video database rather than written as separate clips
+        self.continuous_recorder = continuous_recorder
+        self.video_db = video_db
+        # Whether the areas in which motion was seen are saved to the video database, for motion search
+        self.index_motion = index_motion
+        if self.continuous_recorder:
+            self.video_writer = None
+        elif self.passthrough_recording:
+            self.video_writer = MjpegVideoWriter(self.channel_name, path=self.video_dir)
+        else:
+            self.video_writer = VideoWriter(self.channel_name, path=self.video_dir,
+                                            encoder=create_encoder(encoder, **(encoder_options or {})))
+        self.recording = False
+        self.event_start_time = None
+        self.event_last_time = None
+        # Bounding boxes of the motion in the most recent frame, normalized to the frame as (x1, y1, x2, y2)
+        self.motion_regions = []
+        # The area in which motion was seen during the current event, for each second: second -> (x1, y1, x2, y2)
+        self.event_motion_boxes: Dict[int, List[float]] = {}
+        # Optionally write HLS segments while recording so events can be watched as they happen
+        self.live_writer = None
+        if live_segments:
+            self.live_writer = LiveSegmentWriter(self.channel_name, path=self.video_dir,
+                                                 encoder=FFmpegEncoder(**(encoder_options or {})))
+        # Motion is detected on frames downscaled to this width (or at full resolution if 0). Thresholds are given in
+        # full resolution pixels, and are scaled to match.
+        self.detection_width = detection_width
+        self.detection_scale = 1.0
+        self.source_width = None
+        self.recent_frame_times = deque(maxlen=30)
         self.frame_queue = queue.Queue()
         self.frame_time_queue = queue.Queue()
         self.detection_thread = threading.Thread(target=self.run, daemon=True)
@@ -38,16 +107,37 @@ class MotionDetector:
         # Frame sampling
         self.frame_sample_rate = initial_frame_sample_rate
         self.frame_count = 0
+        self.last_sequence = None
 
     def add_frame(self, frame: bytes):
-        self.frame_queue.put(frame)
-        self.frame_time_queue.put(time.monotonic())
+        """Queue a frame message. Frames are timestamped with their capture time when the streamer provides one."""
+        try:
+            header, payload = unpack_frame(frame)
+        except FrameError as e:
+            print(f"Dropping unreadable frame for channel {self.channel_name}: {e}")
+            return
+        arrival_time = time.time()
+        if header is None:
+            timestamp = arrival_time
+        else:
+            timestamp = header.capture_time
+            # Replayed frames are late by design, so would only skew the latency metric
+            if not header.flags & FLAG_REPLAYED:
+                FRAME_LATENCY_SECONDS.labels(self.channel_name).observe(arrival_time - header.capture_time)
+            if self.last_sequence is not None:
+                missing_frames = sequence_gap(self.last_sequence, header.sequence)
+                if missing_frames:
+                    FRAMES_LOST.labels(self.channel_name).inc(missing_frames)
+            self.last_sequence = header.sequence
+        self.frame_queue.put(payload)
+        self.frame_time_queue.put(timestamp)
+        self.recent_frame_times.append(timestamp)
 
     def run(self):
         last_frame = None
         last_frame_greyscale = None
         recorded_video = False
-        while not self.shutdown:
+        while not self.shutdown or not self.frame_queue.empty():
             # Adjust frame sample rate based on queue size
             self._adjust_sample_rate()
 
@@ -59,8 +149,10 @@ class MotionDetector:
                 else:
                     self.frame_count += 1
 
-                # Only process frames based on the sample rate
-                if self.frame_count % self.frame_sample_rate == 0:
+                # Only process frames based on the sample rate; skipped frames are discarded to reduce the backlog
+                if self.frame_count % self.frame_sample_rate != 0:
+                    self._drop_frame()
+                else:
                     decoded_frame, decoded_grey, timestamp = self._get_decoded_frame_tuple()
                     if last_frame is not None:
                         if self._detect_motion(last_frame_greyscale, decoded_grey, track_path=False):
@@ -83,11 +175,14 @@ class MotionDetector:
                         recorded_video = False
             else:
                 time.sleep(0.01)
+        if self.continuous_recorder:
+            self.continuous_recorder.finish()
 
     def run_in_background(self):
         self.detection_thread.start()
 
     def stop(self):
+        """Stop once the queued frames have been processed, completing any recording in progress."""
         self.shutdown = True
 
     def _has_decoded_frame(self) -> bool:
@@ -100,44 +195,106 @@ class MotionDetector:
             self.frame_sample_rate = 1
         else:
             self.frame_sample_rate = ceil((backlog - 400)/100)
-            print(f"Queue size {self.frame_queue.qsize()}; sampling rate set to {self.frame_sample_rate}")
-            
+        FRAME_QUEUE_DEPTH.labels(self.channel_name).set(backlog)
+        FRAME_SAMPLE_RATE.labels(self.channel_name).set(self.frame_sample_rate)
+
+    def _drop_frame(self):
+        frame = self.frame_queue.get()
+        timestamp = self.frame_time_queue.get()
+        # Frames skipped by motion detection are still part of the continuous recording
+        if self.continuous_recorder:
+            self.continuous_recorder.add_frame(frame, timestamp)
+        FRAMES_DROPPED.labels(self.channel_name).inc()
 
     def _get_decoded_frame_tuple(self):
         new_frame = self.frame_queue.get()
         timestamp = self.frame_time_queue.get()
-        return self._decode_frame(new_frame), self._decode_frame_greyscale(new_frame), timestamp
+        if self.continuous_recorder:
+            self.continuous_recorder.add_frame(new_frame, timestamp)
+        with DECODE_SECONDS.labels(self.channel_name).time():
+            # Only the greyscale frame is needed unless frames are recorded decoded
+            if self.video_writer is None or self.passthrough_recording:
+                decoded_frame = new_frame
+                decoded_grey = self._decode_jpeg_greyscale(new_frame)
+            else:
+                decoded_frame = self._decode_frame(new_frame)
+                decoded_grey = self._decode_frame_greyscale(decoded_frame)
+        FRAMES_PROCESSED.labels(self.channel_name).inc()
+        return decoded_frame, decoded_grey, timestamp
 
     def _detect_motion(self, old_frame_greyscale, new_frame_greyscale, track_path=False) -> bool:
-        """Detection motion between two frames using contours."""
+        """Detect motion between two frames from the largest connected region of changed pixels."""
         if old_frame_greyscale is None:
             return False
+        if old_frame_greyscale.shape != new_frame_greyscale.shape:
+            # The camera changed resolution (e.g. it restarted with different settings); the frames can't be compared,
+            # so the new frame becomes the reference
+            return False
+        with DETECT_SECONDS.labels(self.channel_name).time():
+            return self._detect_motion_in_delta(old_frame_greyscale, new_frame_greyscale, track_path)
+
+    def _detect_motion_in_delta(self, old_frame_greyscale, new_frame_greyscale, track_path: bool) -> bool:
+        motion_mask = self._get_motion_mask(old_frame_greyscale, new_frame_greyscale)
+        # The dilated mask's pixel count bounds the area of any region in it, so skip labelling if it's too small
+        scaled_area_threshold = self.motion_area_threshold * self.detection_scale ** 2
+        if cv2.countNonZero(motion_mask) <= scaled_area_threshold:
+            return False
+        # Find the largest connected region of changed pixels
+        region_count, _, stats, centroids = cv2.connectedComponentsWithStats(motion_mask, connectivity=8)
+        if region_count < 2:
+            return False
+        # Label 0 is the background
+        largest_region = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        if stats[largest_region, cv2.CC_STAT_AREA] <= scaled_area_threshold:
+            return False
+        self.motion_regions = self._get_motion_regions(stats[1:region_count], scaled_area_threshold,
+                                                       motion_mask.shape)
+        if self.false_alarm is True and track_path:
+            # Centroids are tracked in full resolution pixels, like cumulative_motion_threshold
+            centroid_x, centroid_y = centroids[largest_region] / self.detection_scale
+            self.principal_contour_centroids.append((int(centroid_x), int(centroid_y)))
+            if len(self.principal_contour_centroids) > 1:
+                self._check_max_distance_to_set_false_alarm()
+        return True
+
+    @staticmethod
+    def _get_motion_regions(stats: np.ndarray, area_threshold: float, shape) -> List:
+        """Normalized bounding boxes of the regions larger than area_threshold."""
+        height, width = shape[:2]
+        return [(x / width, y / height, (x + w) / width, (y + h) / height)
+                for x, y, w, h, area in stats if area > area_threshold]
+
+    def _add_event_motion(self, timestamp: float):
+        """Add the latest motion regions to the area in which motion has been seen this second."""
+        second = int(timestamp)
+        box = self.event_motion_boxes.get(second)
+        for x1, y1, x2, y2 in self.motion_regions:
+            if box is None:
+                box = [x1, y1, x2, y2]
+            else:
+                box = [min(box[0], x1), min(box[1], y1), max(box[2], x2), max(box[3], y2)]
+        if box is not None:
+            self.event_motion_boxes[second] = box
+
+    def _save_event_motion(self):
+        """Index where motion was seen during the event, so it can be found by searching an area of the frame."""
+        if not self.index_motion or not self.video_db or not self.event_motion_boxes:
+            return
+        video = self.video_writer.video_file_name if self.video_writer else None
+        boxes = [(x1, y1, x2, y2, second, second + 1)
+                 for second, (x1, y1, x2, y2) in self.event_motion_boxes.items()]
+        try:
+            self.video_db.add_motion_boxes(self.channel_name, video, self.event_start_time, boxes)
+        except sqlite3.Error as e:
+            print(f"Failed to save motion boxes for channel {self.channel_name}: {e}")
+
+    def _get_motion_mask(self, old_frame_greyscale, new_frame_greyscale):
+        """Threshold and dilate the difference between two frames."""
         # Calculate background subtraction
         frame_delta = cv2.absdiff(old_frame_greyscale, new_frame_greyscale)
         # Calculate and dilate threshold
-        threshold = cv2.threshold(frame_delta, 25, 255, cv2.THRESH_BINARY)[1]
-        threshold = cv2.dilate(threshold, None, iterations=2)
-        # Extract contours from the threshold image
-        contours = cv2.findContours(threshold.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        contours = imutils.grab_contours(contours)
-        # Iterate over contours and determine if any are large enough to count as motion
-        largest_contour, largest_area = max(
-            ((contour, cv2.contourArea(contour)) for contour in contours),
-            key=lambda x: x[1],
-            default=(None, 0)
-        )
-        if largest_area > self.motion_area_threshold:
-            if self.false_alarm is True and track_path:
-                M = cv2.moments(largest_contour)
-                if M["m00"] != 0:
-                    cX = int(M["m10"] / M["m00"])
-                    cY = int(M["m01"] / M["m00"])
-                    self.principal_contour_centroids.append((cX, cY))
-                    if len(self.principal_contour_centroids) > 1:
-                        self._check_max_distance_to_set_false_alarm()
-            return True
-        else:
-            return False
+        threshold = cv2.threshold(frame_delta, PIXEL_DELTA_THRESHOLD, 255, cv2.THRESH_BINARY)[1]
+        return cv2.dilate(threshold, None, iterations=max(1, round(DILATE_ITERATIONS * self.detection_scale)))
 
     def _check_max_distance_to_set_false_alarm(self):
         """
@@ -154,22 +311,14 @@ class MotionDetector:
     def _draw_motion_areas_on_frame(self, old_frame, new_frame):
         if old_frame is None:
             return new_frame
-        # Convert frames to greyscale
-        old_frame_greyscale = cv2.cvtColor(old_frame, cv2.COLOR_BGR2GRAY)
-        new_frame_greyscale = cv2.cvtColor(new_frame, cv2.COLOR_BGR2GRAY)
-        # Calculate background subtraction
-        frame_delta = cv2.absdiff(old_frame_greyscale, new_frame_greyscale)
-        # Calculate and dilate threshold
-        threshold = cv2.threshold(frame_delta, 25, 255, cv2.THRESH_BINARY)[1]
-        threshold = cv2.dilate(threshold, None, iterations=2)
-        # Extract contours from the threshold image
-        contours = cv2.findContours(threshold.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        contours = imutils.grab_contours(contours)
-        # Iterate over contours and determine if any are large enough to count as motion
+        motion_mask = self._get_motion_mask(self._decode_frame_greyscale(old_frame),
+                                            self._decode_frame_greyscale(new_frame))
+        region_count, _, stats, _ = cv2.connectedComponentsWithStats(motion_mask, connectivity=8)
+        # Iterate over regions and determine if any are large enough to count as motion
         modified_frame = new_frame.copy()
-        for contour in contours:
-            if cv2.contourArea(contour) >= self.motion_area_threshold:
-                x, y, w, h = cv2.boundingRect(contour)
+        for x, y, w, h, area in stats[1:region_count]:
+            if area >= self.motion_area_threshold * self.detection_scale ** 2:
+                x, y, w, h = (int(value / self.detection_scale) for value in (x, y, w, h))
                 cv2.rectangle(modified_frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
         return modified_frame
 
@@ -179,15 +328,23 @@ class MotionDetector:
         self.false_alarm = True
 
     def _record_video(self, first_frames: List, first_frames_greyscale: List, timestamp):
-        start_time = time.monotonic()
-        self.video_writer.reset()
+        self.recording = True
+        self.event_start_time = None
+        self.event_last_time = None
+        self.event_motion_boxes = {}
+        # The motion that started the event
+        self._add_event_motion(timestamp)
+        if self.video_writer:
+            self.video_writer.reset()
+        if self.live_writer:
+            self.live_writer.reset(self._estimate_fps())
         self.reset_tracking()
         old_frame = None
         frame_counter = 0
 
         # Add initial frames
         for frame in first_frames:
-            self.video_writer.add_frame(frame, timestamp)
+            self._add_recorded_frame(frame, timestamp)
             old_frame = frame
         
         old_grey = first_frames_greyscale[-1]
@@ -198,38 +355,105 @@ class MotionDetector:
             if self._has_decoded_frame():
                 new_frame, new_grey, timestamp = self._get_decoded_frame_tuple()
                 # new_frame = self._draw_motion_areas_on_frame(old_frame, new_frame)
-                self.video_writer.add_frame(new_frame, timestamp)
+                self._add_recorded_frame(new_frame, timestamp)
                 # check for continued motion
                 if self._detect_motion(old_grey, new_grey, track_path=True):
+                    self._add_event_motion(timestamp)
                     motionless_frames = 0
                 else:
                     motionless_frames += 1
                 # cycle frames
                 old_frame = new_frame
                 old_grey = new_grey
+            elif self.shutdown:
+                # No more frames are coming (e.g. a replay has ended), so end the recording with what it has
+                break
             else:
                 time.sleep(0.001)
 
         # Finalize video if not a false alarm (no motion)
         if self.false_alarm is False:
-            self.video_writer.write()
+            if self.live_writer:
+                self.live_writer.finish()
+            if self.video_writer:
+                with ENCODE_SECONDS.labels(self.channel_name).time():
+                    self.video_writer.write()
+            if self.continuous_recorder and self.video_db:
+                self.video_db.add_motion_event(self.channel_name, self.event_start_time, self.event_last_time)
+            self._save_event_motion()
+            RECORDINGS.labels(self.channel_name, "saved").inc()
             print(f"Video recording complete for channel: {self.channel_name}")
         else:
+            if self.video_writer:
+                self.video_writer.discard()
+            if self.live_writer:
+                self.live_writer.discard()
+            RECORDINGS.labels(self.channel_name, "false_alarm").inc()
             print("False alarm detected; discarding video")
+        self.recording = False
+
+    def _add_recorded_frame(self, frame, timestamp):
+        if self.event_start_time is None:
+            self.event_start_time = timestamp
+        self.event_last_time = timestamp
+        if self.video_writer:
+            self.video_writer.add_frame(frame, timestamp)
+        if self.live_writer:
+            self.live_writer.add_frame(frame, timestamp)
+
+    def _estimate_fps(self) -> float:
+        """Estimate the incoming frame rate from recent frame timestamps."""
+        if len(self.recent_frame_times) < 2:
+            return 10
+        elapsed_time = self.recent_frame_times[-1] - self.recent_frame_times[0]
+        if elapsed_time <= 0:
+            return 10
+        return (len(self.recent_frame_times) - 1) / elapsed_time
 
     def _recording_timeout(self) -> bool:
-        if self.video_writer.last_frame_time is None:
+        if self.event_start_time is None:
             return False
         else:
-            elapsed_time = self.video_writer.last_frame_time - self.video_writer.first_frame_time
+            elapsed_time = self.event_last_time - self.event_start_time
         return elapsed_time > self.video_duration
 
     @staticmethod
     def _decode_frame(frame: bytes):
         return cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR)
 
-    @staticmethod
-    def _decode_frame_greyscale(frame: bytes):
-        """Convert frame to greyscale and blur it."""
-        greyscale_frame = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
-        return cv2.GaussianBlur(greyscale_frame, (21, 21), 0)
+    def _decode_frame_greyscale(self, frame: np.ndarray):
+        """Downscale a decoded frame to the detection resolution, convert it to greyscale and blur it."""
+        self.source_width = frame.shape[1]
+        if self.detection_width and frame.shape[1] > self.detection_width:
+            # Resizing before converting means the colour conversion and blur only touch the small frame
+            frame = self._resize_to_detection_width(frame)
+        else:
+            self.detection_scale = 1.0
+        return self._blur(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    def _decode_jpeg_greyscale(self, frame: bytes):
+        """Decode a JPEG straight to a blurred greyscale frame at the detection resolution."""
+        decode_flag, reduction = cv2.IMREAD_GRAYSCALE, 1
+        if self.detection_width and self.source_width:
+            # Decode at the smallest reduced scale that is still at least the detection width
+            for scale_reduction, reduced_flag in REDUCED_GREYSCALE_DECODES:
+                if self.source_width / scale_reduction >= self.detection_width:
+                    decode_flag, reduction = reduced_flag, scale_reduction
+                    break
+        greyscale_frame = cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), decode_flag)
+        self.source_width = greyscale_frame.shape[1] * reduction
+        if self.detection_width and greyscale_frame.shape[1] > self.detection_width:
+            greyscale_frame = self._resize_to_detection_width(greyscale_frame)
+        else:
+            self.detection_scale = greyscale_frame.shape[1] / self.source_width
+        return self._blur(greyscale_frame)
+
+    def _resize_to_detection_width(self, frame: np.ndarray) -> np.ndarray:
+        height = round(frame.shape[0] * self.detection_width / frame.shape[1])
+        self.detection_scale = self.detection_width / self.source_width
+        return cv2.resize(frame, (self.detection_width, height), interpolation=cv2.INTER_AREA)
+
+    def _blur(self, greyscale_frame: np.ndarray) -> np.ndarray:
+        # The kernel is scaled with the frame, and must be odd
+        kernel_size = max(3, int(BLUR_KERNEL_SIZE * self.detection_scale) | 1)
+        return cv2.GaussianBlur(greyscale_frame, (kernel_size, kernel_size), 0)
@@ -1,15 +1,36 @@
 import os
+import signal
+import threading
 import time
+from typing import Dict, List, Optional
 
-from smart_sec_cam.motion.detection import MotionDetector
-from smart_sec_cam.redis import RedisImageReceiver
+from smart_sec_cam.metrics import SamplingProfiler, start_metrics_server, write_profile
+from smart_sec_cam.motion.detection import MotionDetector, DECODE_SECONDS, DETECT_SECONDS, ENCODE_SECONDS
+from smart_sec_cam.redis import RedisImageReceiver, is_replayed
+from smart_sec_cam.server.video_db import VideoDatabase
+from smart_sec_cam.video.continuous import ContinuousRecorder
+from smart_sec_cam.video.benchmark import select_encoder
+from smart_sec_cam.video.encoders import FFmpegEncoder
+from smart_sec_cam.video.transcode import Transcoder, TRANSCODE_NICENESS
 
 
 CHANNEL_LIST_INTERVAL = 10
 SLEEP_TIME = 0.01
+# Recordings are only transcoded while fewer frames than this are waiting for each detector
+IDLE_BACKLOG = 10
+# A replay of a streamer's spool has ended once no replayed frames have arrived from it for this long
+REPLAY_IDLE_SECONDS = 30
 
 
-def main(redis_url: str, redis_port: int, video_dir: str, motion_threshold: int):
+def main(redis_url: str, redis_port: int, video_dir: str, motion_threshold: int, live_segments: bool = False,
+         detection_width: int = 320, passthrough_recording: bool = False, encoder: str = "auto",
+         encoder_options: Optional[Dict] = None, continuous_channels: Optional[List[str]] = None,
+         segment_seconds: int = 60, retention_hours: float = 24, index_motion: bool = False):
+    encoder_options = encoder_options or {}
+    # Passthrough recordings are only ever encoded by ffmpeg, so there's nothing to choose between
+    if encoder == "auto":
+        encoder = "ffmpeg" if passthrough_recording else select_encoder(ffmpeg_options=encoder_options)
+        print(f"Using {encoder} encoder")
     # Fetch list of channels
     # Subscribe to each channel to get frames
     image_receiver = RedisImageReceiver(redis_url, redis_port)
@@ -17,20 +38,60 @@ def main(redis_url: str, redis_port: int, video_dir: str, motion_threshold: int)
     last_channel_check_time = time.monotonic()
     image_receiver.set_channels(active_channels)
     image_receiver.start_listener_thread()
-    # Create and start MotionDetection instance for each channel
-    motion_detectors = {channel: MotionDetector(channel, motion_area_threshold=motion_threshold, video_dir=video_dir)
-                        for channel in active_channels}
-    for detector in motion_detectors.values():
+    # Continuous recording and the areas in which motion was seen are indexed in the same database the server uses
+    video_db = None
+    if continuous_channels is not None or index_motion:
+        video_db = VideoDatabase(os.environ.get('DB_PATH', 'data/db/videos.db'))
+
+    def create_detector(channel: str, replay: bool = False) -> MotionDetector:
+        continuous_recorder = None
+        # An empty list enables continuous recording for every channel
+        if continuous_channels is not None and (not continuous_channels or channel in continuous_channels):
+            continuous_recorder = ContinuousRecorder(channel, video_dir, segment_seconds=segment_seconds,
+                                                     retention_hours=retention_hours, video_db=video_db)
+        detector = MotionDetector(channel, motion_area_threshold=motion_threshold, video_dir=video_dir,
+                                  live_segments=live_segments and not replay, detection_width=detection_width,
+                                  passthrough_recording=passthrough_recording, encoder=encoder,
+                                  encoder_options=encoder_options, continuous_recorder=continuous_recorder,
+                                  video_db=video_db, index_motion=index_motion)
         detector.run_in_background()
+        return detector
+
+    # Create and start MotionDetection instance for each channel
+    motion_detectors = {channel: create_detector(channel) for channel in active_channels}
+    # Frames replayed from a streamer's spool after it reconnects arrive interleaved with its live frames, but are
+    # older, so they're run through a separate detector for the channel (created when the first one arrives, and
+    # stopped when the replay ends)
+    replay_detectors: Dict[str, MotionDetector] = {}
+    last_replayed_frame_times: Dict[str, float] = {}
+    # Passthrough recordings are transcoded to webm when no live detector is busy; replays aren't time critical
+    if passthrough_recording:
+        transcoder = Transcoder(video_dir, is_idle=lambda: all(
+            not detector.recording and detector.frame_queue.qsize() < IDLE_BACKLOG
+            for detector in list(motion_detectors.values())),
+            encoder=FFmpegEncoder(niceness=TRANSCODE_NICENESS, **encoder_options))
+        transcoder.run_in_background()
     while True:
         # Check for new frames from each channel and push to the corresponding MotionDetection instance
         if image_receiver.has_message():
             message = image_receiver.get_message()
             frame = message.get("data")
             channel = message.get("channel").decode("utf-8")
-            motion_detectors.get(channel).add_frame(frame)
+            if is_replayed(frame):
+                if channel not in replay_detectors:
+                    replay_detectors[channel] = create_detector(channel, replay=True)
+                replay_detectors[channel].add_frame(frame)
+                last_replayed_frame_times[channel] = time.monotonic()
+            else:
+                motion_detectors.get(channel).add_frame(frame)
         else:
             time.sleep(SLEEP_TIME)
+        # Finish the recordings (and continuous segments) of replays that have ended
+        for channel in list(replay_detectors):
+            if time.monotonic() - last_replayed_frame_times[channel] > REPLAY_IDLE_SECONDS:
+                print(f"Replay ended for channel: {channel}")
+                replay_detectors.pop(channel).stop()
+                del last_replayed_frame_times[channel]
         # Periodically check for updated channel list in background thread
         if time.monotonic() - last_channel_check_time > CHANNEL_LIST_INTERVAL:
             active_channels = image_receiver.get_all_channels()
@@ -40,23 +101,47 @@ def main(redis_url: str, redis_port: int, video_dir: str, motion_threshold: int)
                 if channel not in motion_detectors.keys():
                     print(f"Detected new channel: {channel}")
                     new_channels.append(channel)
-                    motion_detectors[channel] = MotionDetector(channel,
-                                                               motion_area_threshold=motion_threshold,
-                                                               video_dir=video_dir)
+                    motion_detectors[channel] = create_detector(channel)
             # Check for removed channels
             removed_channels = []
-            for channel in motion_detectors.keys():
+            for channel in list(motion_detectors.keys()):
                 if channel not in active_channels:
                     print(f"Removing channel: {channel}")
                     removed_channels.append(channel)
                     motion_detectors.get(channel).stop()
                     del motion_detectors[channel]
+                    if channel in replay_detectors:
+                        replay_detectors.pop(channel).stop()
+                        del last_replayed_frame_times[channel]
             # If the active channel list changed, update the redis subscription list
             if new_channels or removed_channels:
                 image_receiver.set_channels(active_channels)
             last_channel_check_time = time.monotonic()
 
 
+def enable_profiling(profile_seconds: float, profile_dir: str):
+    """
+    Take a profile when the process receives SIGUSR1 (e.g. `docker kill --signal=USR1 <container>`), writing the
+    folded stacks and stage timings to profile_dir.
+    """
+    profiler = SamplingProfiler(stage_timers={"decode": DECODE_SECONDS, "detect": DETECT_SECONDS,
+                                              "encode": ENCODE_SECONDS})
+
+    def take_profile():
+        profile = profiler.profile(profile_seconds)
+        if profile is not None:
+            print(f"Wrote profile to {write_profile(profile, profile_dir, 'motion')}")
+
+    def on_signal(signum, frame):
+        if profiler.running:
+            print("A profile is already being taken")
+            return
+        print(f"Profiling for {profile_seconds}s")
+        threading.Thread(target=take_profile, daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, on_signal)
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -65,8 +150,46 @@ if __name__ == '__main__':
     parser.add_argument('--redis-port', help='Server port to stream images to', type=int, default=6379)
     parser.add_argument('--video-dir', help='Directory in which video files are stored', type=str,
                         default="data/videos")
+    parser.add_argument('--live-segments', help='Write HLS segments while recording so events can be watched live',
+                        action='store_true')
+    parser.add_argument('--detection-width', help='Width in pixels that frames are downscaled to for motion detection '
+                                                  '(0 to use full resolution)', type=int, default=320)
+    parser.add_argument('--passthrough-recording', help='Record the JPEG frames from cameras without re-encoding them, '
+                                                        'and transcode recordings to webm when idle',
+                        action='store_true')
+    parser.add_argument('--continuous-recording', help='Record these channels continuously to fixed-length segments, '
+                                                       'marking motion on the timeline instead of saving clips (all '
+                                                       'channels if none are given)', nargs='*', metavar='CHANNEL',
+                        default=None)
+    parser.add_argument('--index-motion', help='Index the area of the frame in which motion was seen during each event '
+                                               'in the video database, so it can be searched', action='store_true')
+    parser.add_argument('--segment-seconds', help='Length of each continuous recording segment', type=int, default=60)
+    parser.add_argument('--retention-hours', help='How long continuous recording segments are kept', type=float,
+                        default=24)
+    parser.add_argument('--encoder', help='Video encoder backend for recordings; auto benchmarks each one at startup '
+                                          'and uses the fastest', choices=["auto", "opencv", "ffmpeg"], default="auto")
+    parser.add_argument('--encoder-preset', help='ffmpeg encoder speed preset', choices=FFmpegEncoder.PRESETS,
+                        default="veryfast")
+    parser.add_argument('--encoder-threads', help='ffmpeg encoder threads (0 for automatic)', type=int, default=0)
+    parser.add_argument('--encoder-crf', help='ffmpeg constant rate factor; lower is better quality (defaults to a '
+                                              'value suited to each codec)', type=int, default=None)
+    parser.add_argument('--metrics-port', help='Port to serve Prometheus metrics on (disabled if not set)', type=int,
+                        default=None)
+    parser.add_argument('--enable-profiling', help='Write a sampling profile to --profile-dir on SIGUSR1',
+                        action='store_true')
+    parser.add_argument('--profile-seconds', help='How long each profile samples for', type=float, default=10)
+    parser.add_argument('--profile-dir', help='Directory in which profiles are written', type=str,
+                        default="data/profiles")
     args = parser.parse_args()
 
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    if args.enable_profiling:
+        enable_profiling(args.profile_seconds, args.profile_dir)
+
     motion_threshold = int(os.environ.get("MOTION_THRESHOLD"))
 
-    main(args.redis_url, args.redis_port, args.video_dir, motion_threshold)
+    main(args.redis_url, args.redis_port, args.video_dir, motion_threshold, args.live_segments, args.detection_width,
+         args.passthrough_recording, args.encoder,
+         {"preset": args.encoder_preset, "threads": args.encoder_threads, "crf": args.encoder_crf},
+         args.continuous_recording, args.segment_seconds, args.retention_hours, args.index_motion)
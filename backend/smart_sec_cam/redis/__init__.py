@@ -1,2 +1,4 @@
 from smart_sec_cam.redis.image_receiver import RedisImageReceiver
-from smart_sec_cam.redis.image_sender import RedisImageSender
\ No newline at end of file
+from smart_sec_cam.redis.image_sender import RedisImageSender
+from smart_sec_cam.redis.frame import FrameHeader, pack_frame, pack_frame_into, packed_frame_length, unpack_frame, \
+    sequence_gap, mark_replayed, is_frame, is_replayed, FrameError, FLAG_REPLAYED
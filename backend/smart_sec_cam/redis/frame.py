@@ -0,0 +1,110 @@
+import struct
+from typing import NamedTuple, Optional, Tuple, Union
+
+
+FRAME_MAGIC = b"SSCF"
+# Streamers that predate the envelope send plain JPEGs
+JPEG_START = b"\xff\xd8"
+FRAME_VERSION = 1
+# magic, version, flags, camera id length, sequence number, capture time (unix seconds), width, height
+HEADER_STRUCT = struct.Struct("!4sBBHIdHH")
+SEQUENCE_MODULUS = 2 ** 32
+FLAGS_OFFSET = 5
+# The frame was stored while the server was unreachable and is being sent late
+FLAG_REPLAYED = 0x01
+
+
+class FrameHeader(NamedTuple):
+    camera_id: str
+    sequence: int
+    capture_time: float
+    width: int
+    height: int
+    flags: int = 0
+
+
+def pack_frame(header: FrameHeader, payload: Union[bytes, memoryview]) -> bytes:
+    """Prefix a JPEG payload with a frame header."""
+    camera_id = header.camera_id.encode("utf-8")
+    fixed_header = HEADER_STRUCT.pack(FRAME_MAGIC, FRAME_VERSION, header.flags, len(camera_id),
+                                      header.sequence % SEQUENCE_MODULUS, header.capture_time,
+                                      header.width, header.height)
+    return b"".join((fixed_header, camera_id, payload))
+
+
+def packed_frame_length(header: FrameHeader, payload_length: int) -> int:
+    return HEADER_STRUCT.size + len(header.camera_id.encode("utf-8")) + payload_length
+
+
+def pack_frame_into(buffer: bytearray, header: FrameHeader, payload: Union[bytes, memoryview]) -> memoryview:
+    """
+    Like pack_frame(), but writes into an existing buffer (of at least packed_frame_length() bytes), so the payload
+    is copied exactly once. Returns a view of the packed frame.
+    """
+    camera_id = header.camera_id.encode("utf-8")
+    camera_id_end = HEADER_STRUCT.size + len(camera_id)
+    frame_end = camera_id_end + len(payload)
+    HEADER_STRUCT.pack_into(buffer, 0, FRAME_MAGIC, FRAME_VERSION, header.flags, len(camera_id),
+                            header.sequence % SEQUENCE_MODULUS, header.capture_time, header.width, header.height)
+    buffer[HEADER_STRUCT.size:camera_id_end] = camera_id
+    buffer[camera_id_end:frame_end] = payload
+    return memoryview(buffer)[:frame_end]
+
+
+class FrameError(ValueError):
+    """A message has a frame envelope that can't be read (e.g. from a newer streamer, or truncated)."""
+    pass
+
+
+def unpack_frame(data: Union[bytes, memoryview]) -> Tuple[Optional[FrameHeader], memoryview]:
+    """
+    Split a message into its header and a view of the JPEG payload; the payload is not copied.
+
+    Messages from streamers that predate the envelope are plain JPEG bytes, and are returned with a header of None.
+    Raises FrameError if the envelope can't be read; consumers should drop the frame rather than stop.
+    """
+    view = memoryview(data)
+    if len(view) < HEADER_STRUCT.size or view[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+        return None, view
+    magic, version, flags, camera_id_length, sequence, capture_time, width, height = \
+        HEADER_STRUCT.unpack_from(view)
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame envelope version: {version}")
+    camera_id_end = HEADER_STRUCT.size + camera_id_length
+    if camera_id_end > len(view):
+        raise FrameError("Frame envelope is truncated")
+    try:
+        camera_id = bytes(view[HEADER_STRUCT.size:camera_id_end]).decode("utf-8")
+    except UnicodeDecodeError:
+        raise FrameError("Frame envelope has an invalid camera id")
+    return FrameHeader(camera_id, sequence, capture_time, width, height, flags), view[camera_id_end:]
+
+
+def mark_replayed(data: Union[bytes, memoryview]) -> bytes:
+    """Return a copy of an enveloped frame with the replayed flag set. Legacy frames are returned unchanged."""
+    if data[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+        return data
+    marked = bytearray(data)
+    marked[FLAGS_OFFSET] |= FLAG_REPLAYED
+    return bytes(marked)
+
+
+def is_frame(data: Union[bytes, memoryview]) -> bool:
+    """Whether a message (or at least its first 4 bytes) is a frame, enveloped or a legacy JPEG."""
+    return data[:len(FRAME_MAGIC)] == FRAME_MAGIC or data[:len(JPEG_START)] == JPEG_START
+
+
+def is_replayed(data: Union[bytes, memoryview]) -> bool:
+    """Whether a message is a frame replayed from a streamer's spool, without unpacking it."""
+    return (len(data) >= HEADER_STRUCT.size and data[:len(FRAME_MAGIC)] == FRAME_MAGIC
+            and bool(data[FLAGS_OFFSET] & FLAG_REPLAYED))
+
+
+def sequence_gap(last_sequence: int, sequence: int) -> int:
+    """
+    Number of frames missing between two consecutive sequence numbers, accounting for wraparound.
+
+    Returns 0 if the sequence went backwards by a large amount, which happens when a streamer restarts.
+    """
+    gap = (sequence - last_sequence - 1) % SEQUENCE_MODULUS
+    return gap if gap < SEQUENCE_MODULUS // 2 else 0
@@ -1,10 +1,18 @@
 import queue
 import threading
 import time
-from typing import List, Dict
+from typing import Callable, List, Dict
 
 import redis
 
+from smart_sec_cam.metrics import Counter, Gauge
+from smart_sec_cam.redis.frame import FRAME_MAGIC, is_frame
+
+
+MESSAGES_RECEIVED = Counter("redis_messages_received", "Messages received from Redis pub/sub", ["channel"])
+BYTES_RECEIVED = Counter("redis_bytes_received", "Payload bytes received from Redis pub/sub", ["channel"])
+RECEIVE_ERRORS = Counter("redis_receive_errors", "Errors while reading from Redis pub/sub")
+RECEIVE_QUEUE_DEPTH = Gauge("redis_receive_queue_depth", "Received messages waiting to be consumed")
 
 class RedisImageReceiver:
     def __init__(self, redis_host: str = "localhost", redis_port: int = 6379, listener_sleep_time: float = 0.01):
@@ -16,8 +24,13 @@ class RedisImageReceiver:
         self.pubsub = self.r_conn.pubsub()
         self.listener_thread = None
         self.listener_sleep_time = listener_sleep_time
+        # Set while there's at least one subscription, so listen() can wait for one without polling
+        self.has_subscriptions = threading.Event()
 
     def set_channels(self, channels: List[str]):
+        removed_channels = [channel for channel in self.subscribed_channels if channel not in channels]
+        if removed_channels:
+            self.pubsub.unsubscribe(*removed_channels)
         self.subscribed_channels = channels
         self._subscribe()
 
@@ -29,10 +42,23 @@ class RedisImageReceiver:
 
     def remove_channel(self, channel: str):
         self.subscribed_channels.remove(channel)
-        self._subscribe()
+        self.pubsub.unsubscribe(channel)
+        if not self.subscribed_channels:
+            self.has_subscriptions.clear()
 
     def get_all_channels(self) -> List[str]:
-        return [key.decode("utf-8") for key in self.r_conn.keys()]
+        """
+        Channels with a latest frame in Redis. Other keys (e.g. written by other applications sharing the database)
+        are ignored, by reading the start of each key's value.
+        """
+        keys = list(self.r_conn.scan_iter())
+        pipeline = self.r_conn.pipeline(transaction=False)
+        for key in keys:
+            pipeline.getrange(key, 0, len(FRAME_MAGIC) - 1)
+        # Keys that don't hold strings fail with an error, which is returned in place of a value
+        prefixes = pipeline.execute(raise_on_error=False)
+        return [key.decode("utf-8", errors="replace") for key, prefix in zip(keys, prefixes)
+                if isinstance(prefix, bytes) and is_frame(prefix)]
 
     def has_message(self) -> bool:
         return not self.message_queue.empty()
@@ -44,9 +70,38 @@ class RedisImageReceiver:
         listener_thread = threading.Thread(target=self._listen_for_messages)
         listener_thread.start()
 
+    def listen(self, on_message: Callable[[str, bytes], None]):
+        """
+        Call on_message(channel, data) for each message as soon as it arrives, instead of queueing it for
+        get_message().
+
+        This blocks on the pubsub socket rather than polling, so it's intended to run in a green thread (e.g. with
+        eventlet), where waiting for the socket yields to other green threads. Channels may be changed from other green
+        threads while it runs.
+        """
+        while True:
+            self.has_subscriptions.wait()
+            try:
+                # listen() returns once every channel has been unsubscribed from
+                for message in self.pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    channel = message.get("channel").decode("utf-8")
+                    data = message.get("data")
+                    MESSAGES_RECEIVED.labels(channel).inc()
+                    BYTES_RECEIVED.labels(channel).inc(len(data))
+                    on_message(channel, data)
+            except redis.exceptions.RedisError as e:
+                RECEIVE_ERRORS.inc()
+                print(e)
+                time.sleep(1)
+
     def _subscribe(self):
         if self.subscribed_channels:
             self.pubsub.subscribe(*self.subscribed_channels)
+            self.has_subscriptions.set()
+        else:
+            self.has_subscriptions.clear()
 
     def _redis_message_handler(self, message: any):
         self.message_queue.put(message)
@@ -56,10 +111,19 @@ class RedisImageReceiver:
             new_message = self.pubsub.get_message(ignore_subscribe_messages=True)
             if new_message:
                 self.message_queue.put(new_message)
+                channel = new_message.get("channel")
+                if isinstance(channel, bytes):
+                    channel = channel.decode("utf-8")
+                MESSAGES_RECEIVED.labels(channel).inc()
+                BYTES_RECEIVED.labels(channel).inc(len(new_message.get("data") or b""))
+                RECEIVE_QUEUE_DEPTH.set(self.message_queue.qsize())
         except (redis.exceptions.RedisError, RuntimeError) as e:
+            RECEIVE_ERRORS.inc()
             print(e)
 
     def _listen_for_messages(self):
         while True:
-            self._get_new_pubsub_message()
+            # The pubsub connection isn't opened until something is subscribed to
+            if self.subscribed_channels:
+                self._get_new_pubsub_message()
             time.sleep(self.listener_sleep_time)
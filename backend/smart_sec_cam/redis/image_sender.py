@@ -1,16 +1,53 @@
-from typing import Union
+from typing import Union, List, Tuple
 
 import redis
 
+from smart_sec_cam.metrics import Counter
+
+
+MESSAGES_PUBLISHED = Counter("redis_messages_published", "Messages published to Redis", ["channel"])
+BYTES_PUBLISHED = Counter("redis_bytes_published", "Payload bytes published to Redis", ["channel"])
 
 class RedisImageSender:
-    def __init__(self, redis_channel: str, redis_host: str = "localhost", redis_port: int = 6380):
+    def __init__(self, redis_channel: str, redis_host: str = "localhost", redis_port: int = 6380, ssl: bool = True):
         self.redis_channel = redis_channel
         self.redis_host = redis_host
         self.redis_port = redis_port
-        self.r_conn = redis.StrictRedis(host=self.redis_host, port=self.redis_port, ssl=True, ssl_cert_reqs=None)
+        # Streamers connect to the TLS port; ssl can be disabled to publish to a local Redis (e.g. for load testing)
+        self.r_conn = redis.StrictRedis(host=self.redis_host, port=self.redis_port, ssl=ssl, ssl_cert_reqs=None)
         self.pubsub = self.r_conn.pubsub()
 
     def send_message(self, message: Union[str, bytes]):
         self.r_conn.set(self.redis_channel, message)
         self.r_conn.publish(self.redis_channel, message)
+        MESSAGES_PUBLISHED.labels(self.redis_channel).inc()
+        BYTES_PUBLISHED.labels(self.redis_channel).inc(len(message))
+
+    def send_messages(self, messages: List[Union[str, bytes]]):
+        """
+        Publish several messages in one round trip.
+
+        Unlike send_message(), this doesn't update the latest-frame key, since batches are used to send old frames.
+        """
+        self.send_batch([(self.redis_channel, message) for message in messages], update_latest=False)
+
+    def send_batch(self, messages: List[Tuple[str, Union[str, bytes]]], update_latest: bool = True):
+        """
+        Publish (channel, message) pairs, which may be for different channels, in one pipelined round trip.
+
+        If update_latest is set, each channel's latest-frame key is set to the last of its messages in the batch.
+        """
+        pipeline = self.r_conn.pipeline(transaction=False)
+        if update_latest:
+            latest_messages = dict(messages)
+            for channel, message in latest_messages.items():
+                pipeline.set(channel, message)
+        for channel, message in messages:
+            pipeline.publish(channel, message)
+        pipeline.execute()
+        for channel, message in messages:
+            MESSAGES_PUBLISHED.labels(channel).inc()
+            BYTES_PUBLISHED.labels(channel).inc(len(message))
+
+    def ping(self) -> bool:
+        return self.r_conn.ping()
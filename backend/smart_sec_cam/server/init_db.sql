@@ -14,4 +14,40 @@ CREATE TABLE IF NOT EXISTS videos (
 CREATE INDEX IF NOT EXISTS idx_videos_filename ON videos(filename);
 CREATE INDEX IF NOT EXISTS idx_videos_created_at ON videos(created_at);
 CREATE INDEX IF NOT EXISTS idx_videos_room ON videos(room);
-CREATE INDEX IF NOT EXISTS idx_videos_starred ON videos(starred); 
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_videos_starred ON videos(starred); 
+
+-- Continuous recording segments, and motion events marked on the same timeline. Times are unix timestamps.
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    filename TEXT NOT NULL UNIQUE,
+    room TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL,     -- NULL while the segment is being written
+    frame_count INTEGER,
+    filesize INTEGER,  -- Size in bytes
+    deleted_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS motion_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    room TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_segments_room_start_time ON segments(room, start_time);
+CREATE INDEX IF NOT EXISTS idx_motion_events_room_start_time ON motion_events(room, start_time);
+
+-- Where motion was seen during each event, as an R*Tree so regions can be searched by area and time. Boxes are
+-- normalized to the frame, in units of 1/10000 of its width and height, and times are whole unix seconds. video is the
+-- file name of the clip the event was recorded to, as served (e.g. <clip>.webm), or NULL if it's part of a continuous
+-- recording.
+CREATE VIRTUAL TABLE IF NOT EXISTS motion_boxes USING rtree_i32(
+    id,
+    min_x, max_x,
+    min_y, max_y,
+    min_time, max_time,
+    +room TEXT,
+    +video TEXT,
+    +event_start REAL
+);
@@ -1,38 +1,81 @@
 import json
 import os
 import time
+from urllib.parse import urlencode
 from functools import wraps
 import sqlite3
 import logging
+import signal
+from typing import Dict, List, Optional, Set, Tuple
 
 import eventlet
+import eventlet.tpool
+import eventlet.wsgi
 import jwt.exceptions
-from flask import Flask, send_from_directory, render_template, request, jsonify
+import redis
+from flask import Flask, render_template, request, jsonify, send_file, Response
+from werkzeug.security import safe_join
 from flask_cors import CORS
 from flask_socketio import SocketIO, join_room
 
 from smart_sec_cam.auth.authentication import Authenticator
 from smart_sec_cam.auth.database import AuthDatabase
 from smart_sec_cam.auth.models import User
-from smart_sec_cam.redis import RedisImageReceiver
+from smart_sec_cam.auth.throttle import LoginThrottle, LoginThrottledError
+from smart_sec_cam.metrics import Counter, Gauge, Histogram, SamplingProfiler, start_metrics_server, REGISTRY
+from smart_sec_cam.redis import RedisImageReceiver, unpack_frame, FrameError, FLAG_REPLAYED
+from smart_sec_cam.video.cache import TranscodeCache
+from smart_sec_cam.video.continuous import CONTINUOUS_DIR_NAME
 from smart_sec_cam.video.manager import VideoManager
-from smart_sec_cam.server.video_db import VideoDatabase, TOTAL_SPACE_LIMIT, STARRED_SPACE_LIMIT
+from smart_sec_cam.video.segments import get_live_events, rewrite_playlist_uris, LIVE_DIR_NAME, PLAYLIST_NAME, \
+    SEGMENT_EXTENSION
+from smart_sec_cam.server.video_db import VideoDatabase, TOTAL_SPACE_LIMIT, STARRED_SPACE_LIMIT, DB_QUERY_SECONDS
+from smart_sec_cam.server.snapshots import SnapshotCache
+from smart_sec_cam.server.video_response import FileWrapperMiddleware, send_video
 
 # SocketIO & CORS
 eventlet.monkey_patch()
 app = Flask(__name__, static_url_path='', static_folder='/backend/build', template_folder='/backend/build')
+app.wsgi_app = FileWrapperMiddleware(app.wsgi_app)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
-# Authentication
-auth_db = AuthDatabase()
-authenticator = Authenticator(auth_db)
+# Initialised once the worker processes have started, since each needs its own connection to the message queue
+socketio = SocketIO()
+# Authentication and the video database are opened by init_worker() in each server process, after forking, so
+# workers never share a SQLite connection
+auth_db: Optional[AuthDatabase] = None
+authenticator: Optional[Authenticator] = None
+video_db: Optional[VideoDatabase] = None
+# With several workers, tokens revoked by one (e.g. when they're refreshed) are broadcast to the others on this channel
+TOKEN_REVOCATION_CHANNEL = "server:token-revocations"
+revocation_conn: Optional[redis.StrictRedis] = None
 # Application-specific data
 VIDEO_DIR = "data/videos"
+# Transcodes clips to formats that weren't recorded, on request (e.g. mp4 for Safari)
+transcode_cache: Optional[TranscodeCache] = None
+# Time the last frame was received for each room (by this worker)
 rooms = {}
+# Connected clients (session ids) in each room, on this worker. Each worker subscribes only to the rooms its own
+# clients are watching.
+watched_rooms: Dict[str, Set[str]] = {}
+image_receiver: Optional[RedisImageReceiver] = None
+# Browsers may reuse a snapshot for this long before asking for a newer one
+SNAPSHOT_MAX_AGE = 1
+# The rooms with a latest frame in Redis are listed at most this often, for checking room names from requests
+ROOM_LIST_INTERVAL = 5
+room_list_cache: Tuple[List[str], float] = ([], 0.0)
 ENABLE_USER_REGISTRATION = False
-
-# After VIDEO_DIR definition
-video_db = VideoDatabase(os.environ.get('DB_PATH', 'data/videos.db'))
+ENABLE_METRICS = False
+ENABLE_PROFILING = False
+METRICS_PORT = 9100
+METRICS_ADDRESS = "127.0.0.1"
+MAX_PROFILE_SECONDS = 60
+# Metrics
+FRAMES_EMITTED = Counter("server_frames_emitted", "Frames emitted to Socket.IO rooms", ["room"])
+EMIT_SECONDS = Histogram("server_emit_seconds", "Time spent emitting a frame to a Socket.IO room", ["room"])
+CONNECTED_CLIENTS = Gauge("server_connected_clients", "Connected Socket.IO clients")
+FRAME_LATENCY_SECONDS = Histogram("server_frame_latency_seconds", "Time from capture to emit", ["room"])
+# Only samples while a profile is being taken (see start_local_listener)
+profiler = SamplingProfiler(stage_timers={"emit": EMIT_SECONDS, "db_query": DB_QUERY_SECONDS})
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -58,11 +101,47 @@ def require_token(f):
     return decorated
 
 
+def require_media_token(f):
+    """
+    Like require_token, for URLs loaded by media elements, which can't set headers. The token is passed as a query
+    param, or as a cookie so that the URL (and therefore the browser cache key) does not change every time the token
+    is refreshed. The x-access-token header is accepted too.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = request.headers.get('x-access-token') or request.args.get("token") or request.cookies.get("token")
+        client_ip_addr = request.remote_addr
+        if not token:
+            return json.dumps({'status': "ERROR", "error": "Missing token"}), 401, {'ContentType': 'application/json'}
+        try:
+            if not authenticator.validate_token(token, client_ip_addr):
+                return json.dumps({'status': "ERROR", "error": "Invalid token"}), 401, {'ContentType': 'application/json'}
+        except (jwt.exceptions.InvalidSignatureError, jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError):
+            return json.dumps({'status': "ERROR", "error": "Invalid token"}), 401, {'ContentType': 'application/json'}
+        return f(*args, **kwargs)
+    return decorated
+
+
 """
 SocketIO endpoints
 """
 
 
+@socketio.on('connect')
+def on_connect():
+    CONNECTED_CLIENTS.inc()
+
+
+@socketio.on('disconnect')
+def on_disconnect():
+    CONNECTED_CLIENTS.dec()
+    for room, session_ids in list(watched_rooms.items()):
+        session_ids.discard(request.sid)
+        if not session_ids:
+            del watched_rooms[room]
+    update_subscriptions()
+
+
 @socketio.on('join')
 def on_join(data):
     # Validate token
@@ -76,6 +155,8 @@ def on_join(data):
     # Join room
     room = data['room']
     join_room(room)
+    watched_rooms.setdefault(room, set()).add(request.sid)
+    update_subscriptions()
 
 
 """
@@ -105,6 +186,9 @@ def authenticate():
     # Authenticate request
     try:
         token = authenticator.authenticate(username, password, client_ip_addr)
+    except LoginThrottledError as e:
+        return json.dumps({'status': "ERROR", "error": "Too many login attempts"}), 429, \
+               {'ContentType': 'application/json', 'Retry-After': str(e.retry_after)}
     except ValueError:
         return json.dumps({'status': "ERROR", "error": "Incorrect username or password"}), 401, \
                {'ContentType': 'application/json'}
@@ -128,9 +212,14 @@ def register():
     # Create new user
     username = request.json.get("username")
     password = request.json.get("password")
+    client_ip_addr = request.remote_addr
     new_user = User(username)
     new_user.generate_id()
-    new_user.set_password(password)
+    try:
+        authenticator.set_password(new_user, password, client_ip_addr)
+    except LoginThrottledError as e:
+        return json.dumps({'status': "ERROR", "error": "Too many registration attempts"}), 429, \
+               {'ContentType': 'application/json', 'Retry-After': str(e.retry_after)}
     try:
         auth_db.add_user(new_user)
     except ValueError:
@@ -182,39 +271,117 @@ def refresh_token():
 @require_token
 def get_rooms():
     global rooms
-    return json.dumps({'rooms': rooms}), 200, {'ContentType': 'application/json'}
+    # Every worker sees the same rooms: one for each camera with a latest frame in Redis
+    room_list = get_room_list(refresh=True)
+    return json.dumps({'rooms': {room: rooms.get(room) for room in room_list}}), 200, \
+        {'ContentType': 'application/json'}
+
+
+@app.route("/api/video/rooms/<room>/snapshot", methods=["GET"])
+@require_media_token
+def get_snapshot(room: str):
+    # The latest frame from a room as a JPEG, for a first paint before the stream starts or for status polling. Only
+    # rooms with frames are read from Redis, so the endpoint can't be used to read other keys.
+    snapshot = snapshots.get(room) if room in rooms or room in get_room_list() else None
+    if snapshot is None:
+        return json.dumps({'status': "ERROR"}), 404, {'ContentType': 'application/json'}
+    response = Response(snapshot.jpeg, mimetype='image/jpeg')
+    response.set_etag(snapshot.etag)
+    response.last_modified = snapshot.captured_at
+    response.cache_control.max_age = SNAPSHOT_MAX_AGE
+    response.cache_control.private = True
+    # Responds with 304 Not Modified if the client already has this frame
+    return response.make_conditional(request)
 
 
 @app.route("/api/video/video-list", methods=["GET"])
 @require_token
 def get_video_list():
-    video_type = request.args.get("video-format")  # "webm" or "mp4"
+    video_type = request.args.get("video-format", "webm")  # "webm" or "mp4"
     global VIDEO_DIR
     video_manager = VideoManager(video_dir=VIDEO_DIR)
     return json.dumps({'videos': video_manager.get_video_filenames(video_type)}), 200, {'ContentType': 'application/json'}
 
 
 @app.route("/api/video/<file_name>", methods=["GET"])
+@require_media_token
 def get_video(file_name: str):
-    # Validate token
-    token = request.args.get("token")
-    client_ip_addr = request.remote_addr
-    if not token:
-        return json.dumps({'status': "ERROR", "error": "Missing token"}), 401, {'ContentType': 'application/json'}
-    try:
-        if not authenticator.validate_token(token, client_ip_addr):
-            return json.dumps({'status': "ERROR", "error": "Invalid token"}), 401, {'ContentType': 'application/json'}
-    except (jwt.exceptions.InvalidSignatureError, jwt.exceptions.DecodeError, jwt.exceptions.ExpiredSignatureError):
-        return json.dumps({'status': "ERROR", "error": "Invalid token"}), 401, {'ContentType': 'application/json'}
-    # Return video
     global VIDEO_DIR
-    if "webm" in file_name:
-        mime_type = 'video/webm'
-    elif "mp4" in file_name:
-        mime_type = 'video/mp4'
-    else:
+    response = send_video(VIDEO_DIR, file_name)
+    if response is None and transcode_cache is not None and transcode_cache.get(file_name):
+        response = send_video(transcode_cache.cache_dir, file_name)
+    if response is None:
+        return json.dumps({'status': "ERROR"}), 404, {'ContentType': 'application/json'}
+    return response
+
+
+@app.route("/api/video/timeline/<room>", methods=["GET"])
+@require_token
+def get_timeline(room: str):
+    # Continuous recording segments and motion events between two unix times, by default the last day
+    end_time = request.args.get("end", default=time.time(), type=float)
+    start_time = request.args.get("start", default=end_time - 24 * 3600, type=float)
+    timeline = video_db.get_timeline(room, start_time, end_time)
+    return json.dumps(timeline), 200, {'ContentType': 'application/json'}
+
+
+@app.route("/api/video/motion-search", methods=["GET"])
+@require_token
+def search_motion():
+    # Motion events in which something moved within an area of the frame, given as fractions of the frame's width and
+    # height (x1, y1 to x2, y2), between two unix times. By default, the whole frame over the last day in every room.
+    end_time = request.args.get("end", default=time.time(), type=float)
+    start_time = request.args.get("start", default=end_time - 24 * 3600, type=float)
+    x1 = request.args.get("x1", default=0.0, type=float)
+    y1 = request.args.get("y1", default=0.0, type=float)
+    x2 = request.args.get("x2", default=1.0, type=float)
+    y2 = request.args.get("y2", default=1.0, type=float)
+    events = video_db.search_motion(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2), start_time, end_time,
+                                    room=request.args.get("room"))
+    return json.dumps({'events': events}), 200, {'ContentType': 'application/json'}
+
+
+@app.route("/api/video/segments/<room>/<file_name>", methods=["GET"])
+@require_media_token
+def get_segment(room: str, file_name: str):
+    # Segments are recorded as MJPEG, and transcoded to the requested format (e.g. <segment>.webm) when first watched
+    global VIDEO_DIR
+    segment_dir = safe_join(VIDEO_DIR, CONTINUOUS_DIR_NAME, room)
+    if segment_dir is None or transcode_cache is None or not transcode_cache.get(file_name, source_dir=segment_dir):
+        return json.dumps({'status': "ERROR"}), 404, {'ContentType': 'application/json'}
+    response = send_video(transcode_cache.cache_dir, file_name)
+    if response is None:
+        return json.dumps({'status': "ERROR"}), 404, {'ContentType': 'application/json'}
+    return response
+
+
+@app.route("/api/video/live-events", methods=["GET"])
+@require_token
+def get_live_event_list():
+    global VIDEO_DIR
+    return json.dumps({'events': get_live_events(VIDEO_DIR)}), 200, {'ContentType': 'application/json'}
+
+
+@app.route("/api/video/live/<event_name>/<file_name>", methods=["GET"])
+@require_media_token
+def get_live_event_file(event_name: str, file_name: str):
+    # Return playlist or segment
+    global VIDEO_DIR
+    file_path = safe_join(VIDEO_DIR, LIVE_DIR_NAME, event_name, file_name)
+    if file_path is None or not os.path.isfile(file_path):
         return json.dumps({'status': "ERROR"}), 404, {'ContentType': 'application/json'}
-    return send_from_directory(VIDEO_DIR, file_name, as_attachment=True, mimetype=mime_type)
+    if file_name == PLAYLIST_NAME:
+        # The playlist changes as segments are written, so it must never be cached. Segment URIs are relative, so
+        # a token passed as a query param has to be forwarded to them explicitly.
+        with open(file_path, "r") as playlist_file:
+            playlist = playlist_file.read()
+        query = urlencode({'token': request.args["token"]}) if request.args.get("token") else None
+        return rewrite_playlist_uris(playlist, query), 200, {'Content-Type': 'application/vnd.apple.mpegurl',
+                                                             'Cache-Control': 'no-cache'}
+    if file_name.endswith(SEGMENT_EXTENSION):
+        # Segments are immutable once they appear in the playlist
+        return send_file(file_path, mimetype='video/mp2t', conditional=True, max_age=3600)
+    return json.dumps({'status': "ERROR"}), 404, {'ContentType': 'application/json'}
 
 
 @app.route('/api/video/<video_name>', methods=['DELETE'])
@@ -224,6 +391,8 @@ def delete_video(video_name):
     video_manager = VideoManager(video_dir=VIDEO_DIR)
     try:
         video_manager.delete_video(video_name)
+        if transcode_cache is not None:
+            transcode_cache.remove(video_name)
         video_db.mark_video_deleted(video_name)
         return jsonify({"message": f"Video '{video_name}' and its alternate formats deleted successfully."}), 200
     except FileNotFoundError:
@@ -240,17 +409,18 @@ def toggle_star(video_name):
         data = request.get_json()
         starred = data.get('starred', False)
         
-        conn = sqlite3.connect(os.environ.get('DB_PATH', 'data/videos.db'))
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            UPDATE videos 
-            SET starred = ?
-            WHERE filename = ? AND deleted_at IS NULL
-        """, (starred, video_name))
-        
-        conn.commit()
-        conn.close()
+        with DB_QUERY_SECONDS.labels("toggle_star").time():
+            conn = sqlite3.connect(os.environ.get('DB_PATH', 'data/videos.db'))
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                UPDATE videos
+                SET starred = ?
+                WHERE filename = ? AND deleted_at IS NULL
+            """, (starred, video_name))
+
+            conn.commit()
+            conn.close()
         
         return jsonify({"message": "Star status updated", "starred": starred}), 200
     except Exception as e:
@@ -304,17 +474,18 @@ def upload_video():
 @app.route('/api/video/<video_name>/info', methods=['GET'])
 def get_video_info(video_name):
     try:
-        conn = sqlite3.connect(os.environ.get('DB_PATH', 'data/db/videos.db'))
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT starred 
-            FROM videos 
-            WHERE filename = ? AND deleted_at IS NULL
-        """, (video_name,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        with DB_QUERY_SECONDS.labels("get_video_starred").time():
+            conn = sqlite3.connect(os.environ.get('DB_PATH', 'data/db/videos.db'))
+            cursor = conn.cursor()
+
+            cursor.execute("""
+                SELECT starred
+                FROM videos
+                WHERE filename = ? AND deleted_at IS NULL
+            """, (video_name,))
+
+            result = cursor.fetchone()
+            conn.close()
         
         if result is not None:
             return jsonify({
@@ -328,26 +499,167 @@ def get_video_info(video_name):
         return jsonify({"error": str(e)}), 500
 
 
+def build_image_payload(room: str, data: bytes) -> Optional[dict]:
+    """
+    Strip the frame envelope; capture time and sequence number are sent alongside the JPEG for latency tracing.
+
+    Returns None for frames replayed from a streamer's spool, which are only of interest to the motion detector.
+    """
+    header, payload = unpack_frame(data)
+    if header is None:
+        return {'room': room, 'data': data}
+    if header.flags & FLAG_REPLAYED:
+        return None
+    FRAME_LATENCY_SECONDS.labels(room).observe(time.time() - header.capture_time)
+    return {'room': room, 'data': bytes(payload), 'seq': header.sequence, 'captured_at': header.capture_time}
+
+
+def emit_image(room: str, data: bytes):
+    payload = build_image_payload(room, data)
+    if payload is None:
+        return
+    with EMIT_SECONDS.labels(room).time():
+        # Every worker receives frames from Redis for the rooms its clients are in, so frames go straight to this
+        # worker's clients rather than through the message queue
+        socketio.emit('image', payload, room=room, ignore_queue=True)
+    FRAMES_EMITTED.labels(room).inc()
+
+
+def handle_image(room: str, data: bytes):
+    try:
+        snapshots.update(room, data)
+        emit_image(room, data)
+    except FrameError as e:
+        # A bad frame is dropped, rather than stopping the listener (and every live stream on this worker)
+        print(f"Dropping unreadable frame for room {room}: {e}")
+        return
+    rooms[room] = time.time()
+
+
+def get_room_list(refresh: bool = False) -> List[str]:
+    """Rooms with a latest frame in Redis, listed at most every ROOM_LIST_INTERVAL seconds unless refresh is set."""
+    global room_list_cache
+    room_list, listed_at = room_list_cache
+    if image_receiver is None:
+        return list(rooms)
+    if refresh or time.monotonic() - listed_at >= ROOM_LIST_INTERVAL:
+        try:
+            room_list = image_receiver.get_all_channels()
+        except redis.exceptions.RedisError as e:
+            print(f"Failed to list rooms: {e}")
+            return room_list
+        room_list_cache = (room_list, time.monotonic())
+    return room_list
+
+
+def fetch_latest_frame(room: str) -> Optional[bytes]:
+    if image_receiver is None:
+        return None
+    try:
+        return image_receiver.r_conn.get(room)
+    except redis.exceptions.RedisError as e:
+        print(f"Failed to read the latest frame for room {room}: {e}")
+        return None
+
+
+snapshots = SnapshotCache(fetch_latest_frame, refresh_interval=SNAPSHOT_MAX_AGE)
+
+
+def update_subscriptions():
+    """Subscribe to frames for exactly the rooms this worker's clients are watching."""
+    if image_receiver is not None and set(watched_rooms) != set(image_receiver.subscribed_channels):
+        image_receiver.set_channels(list(watched_rooms))
+
+
 def listen_for_images(redis_url: str, redis_port: int):
-    global rooms
-    started_listener_thread = False
+    """
+    Emit frames as they arrive from Redis. This runs in a green thread that blocks on the pubsub socket, so each frame
+    goes from Redis to the Socket.IO clients without polling or passing through a queue.
+    """
+    global image_receiver
     image_receiver = RedisImageReceiver(redis_url, redis_port)
+    update_subscriptions()
+    image_receiver.listen(handle_image)
+
+
+def init_worker(db_path: str, jwt_secret: bytes, worker_count: int, redis_url: str, redis_port: int):
+    """
+    Open this server process's databases. Every worker is given the same JWT secret, so each accepts the tokens the
+    others issue.
+    """
+    global auth_db, authenticator, video_db, revocation_conn
+    auth_db = AuthDatabase()
+    on_revoke = None
+    if worker_count > 1:
+        revocation_conn = redis.StrictRedis(host=redis_url, port=redis_port)
+        on_revoke = publish_revocation
+    # Password hashing runs in eventlet's native thread pool so it doesn't block the hub (and every live stream)
+    authenticator = Authenticator(auth_db, run_blocking=eventlet.tpool.execute, secret=jwt_secret,
+                                  login_throttle=LoginThrottle(processes=worker_count), on_revoke=on_revoke)
+    video_db = VideoDatabase(db_path)
+
+
+def publish_revocation(digest: bytes, revoke_from: float, exp: float):
+    try:
+        revocation_conn.publish(TOKEN_REVOCATION_CHANNEL, json.dumps([digest.hex(), revoke_from, exp]))
+    except redis.exceptions.ConnectionError as e:
+        print(f"Failed to share token revocation with other workers: {e}")
+
+
+def listen_for_revocations(redis_url: str, redis_port: int):
+    """Apply tokens revoked by other workers to this worker's token cache."""
     while True:
-        # Check for new channels
-        # TODO: This should only be done every N seconds
-        channel_list = image_receiver.get_all_channels()
-        if channel_list != image_receiver.subscribed_channels:
-            image_receiver.set_channels(channel_list)
-            if not started_listener_thread:
-                image_receiver.start_listener_thread()
-        # Check for new messages
-        if image_receiver.has_message() and image_receiver.subscribed_channels:
-            message = image_receiver.get_message()
-            image = message.get("data")
-            room = str(message.get("channel"))
-            rooms[room] = time.time()
-            socketio.emit('image', {'room': room, 'data': image}, room=room)
-        time.sleep(0.01)
+        try:
+            pubsub = redis.StrictRedis(host=redis_url, port=redis_port).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(TOKEN_REVOCATION_CHANNEL)
+            for message in pubsub.listen():
+                digest, revoke_from, exp = json.loads(message["data"])
+                authenticator.token_cache.add_revocation(bytes.fromhex(digest), revoke_from, exp)
+        except redis.exceptions.ConnectionError as e:
+            print(f"Lost connection to Redis while listening for token revocations: {e}")
+            eventlet.sleep(1)
+
+
+def start_local_listener(worker_index: int = 0):
+    """
+    Serve metrics and profiles on their own port, away from the public API: metrics reveal room names and when each
+    camera is active, and a profile holds a thread for up to MAX_PROFILE_SECONDS and returns stack dumps. The port only
+    accepts local connections unless METRICS_ADDRESS says otherwise.
+
+    Each worker has its own port, METRICS_PORT + worker_index, so each one's metrics can be scraped and each one can be
+    profiled.
+    """
+    if ENABLE_METRICS or ENABLE_PROFILING:
+        # The profiler samples from a real thread, so this worker keeps serving requests while it runs
+        start_metrics_server(METRICS_PORT + worker_index, METRICS_ADDRESS, registry=REGISTRY if ENABLE_METRICS else None,
+                             profiler=profiler if ENABLE_PROFILING else None, max_profile_seconds=MAX_PROFILE_SECONDS,
+                             run_blocking=eventlet.tpool.execute)
+
+
+def fork_workers(count: int) -> Tuple[int, List[int]]:
+    """
+    Fork count - 1 more server processes, which share the listening socket. Returns the index of this worker (0 for
+    the parent process, 1 to count - 1 for the children), and the child pids in the parent or an empty list in the
+    children.
+    """
+    child_pids = []
+    for worker_index in range(1, count):
+        pid = os.fork()
+        if pid == 0:
+            return worker_index, []
+        child_pids.append(pid)
+
+    def stop_workers(signum, frame):
+        for child_pid in child_pids:
+            try:
+                os.kill(child_pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    return 0, child_pids
 
 
 if __name__ == '__main__':
@@ -358,26 +670,53 @@ if __name__ == '__main__':
     parser.add_argument('--redis-port', help='Server port to stream images to', type=int, default=6379)
     parser.add_argument('--video-dir', help='Directory in which video files are stored', type=str,
                         default="data/videos")
+    parser.add_argument('--workers', help='Number of server processes', type=int, default=1)
+    parser.add_argument('--transcode-cache-mb', help='Disk space for clips transcoded to formats that weren\'t '
+                                                     'recorded (0 to disable transcoding)', type=int, default=1024)
     args = parser.parse_args()
 
     VIDEO_DIR = args.video_dir
+    if args.transcode_cache_mb > 0:
+        transcode_cache = TranscodeCache(VIDEO_DIR, max_bytes=args.transcode_cache_mb * 1024 * 1024,
+                                         run_blocking=eventlet.tpool.execute)
     ENABLE_USER_REGISTRATION = bool(int(os.environ.get("ENABLE_REGISTRATION")))
+    ENABLE_METRICS = bool(int(os.environ.get("ENABLE_METRICS", "0")))
+    # Metrics and profiles are served on their own port (see start_local_listener)
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+    METRICS_ADDRESS = os.environ.get("METRICS_ADDRESS", "127.0.0.1")
+    ENABLE_PROFILING = bool(int(os.environ.get("ENABLE_PROFILING", "0")))
 
     # Ensure database directory exists
     db_path = os.environ.get('DB_PATH', '/backend/data/db/videos.db')
     logger.info(f"Using database path: {db_path}")
     
     try:
-        video_db = VideoDatabase(db_path)
-        logger.info("Successfully initialized VideoDatabase")
-        
-        # Sync database with video directory
-        added_files, removed_files = video_db.sync_with_directory(VIDEO_DIR)
+        # Synced once, before forking; each worker then opens the database itself
+        added_files, removed_files = VideoDatabase(db_path).sync_with_directory(VIDEO_DIR)
         logger.info(f"Database sync complete. Added: {len(added_files)}, Removed: {len(removed_files)}")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
         raise
-
-    socketio.start_background_task(listen_for_images, args.redis_url, args.redis_port)
-    socketio.run(app, host='0.0.0.0', port="8443", debug=True, certfile='certs/sec-cam-server.cert',
-                 keyfile='certs/sec-cam-server.key')
+    # Generated before forking, so every worker signs and verifies tokens with the same secret
+    jwt_secret = os.urandom(Authenticator.JWT_SECRET_LENGTH)
+
+    if args.workers > 1:
+        # Workers share one listening socket; the kernel hands each new connection to one of them. Clients must
+        # connect with the websocket transport, since long-polling requests for a session could reach any worker.
+        listen_socket = eventlet.wrap_ssl(eventlet.listen(('0.0.0.0', 8443)), certfile='certs/sec-cam-server.cert',
+                                          keyfile='certs/sec-cam-server.key', server_side=True)
+        worker_index, _ = fork_workers(args.workers)
+        init_worker(db_path, jwt_secret, args.workers, args.redis_url, args.redis_port)
+        start_local_listener(worker_index)
+        socketio.init_app(app, cors_allowed_origins="*",
+                          message_queue=f"redis://{args.redis_url}:{args.redis_port}")
+        socketio.start_background_task(listen_for_images, args.redis_url, args.redis_port)
+        socketio.start_background_task(listen_for_revocations, args.redis_url, args.redis_port)
+        eventlet.wsgi.server(listen_socket, app, log_output=False)
+    else:
+        init_worker(db_path, jwt_secret, args.workers, args.redis_url, args.redis_port)
+        start_local_listener()
+        socketio.init_app(app, cors_allowed_origins="*")
+        socketio.start_background_task(listen_for_images, args.redis_url, args.redis_port)
+        socketio.run(app, host='0.0.0.0', port="8443", debug=True, certfile='certs/sec-cam-server.cert',
+                     keyfile='certs/sec-cam-server.key')
@@ -0,0 +1,72 @@
+import time
+import zlib
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from smart_sec_cam.metrics import Counter
+from smart_sec_cam.redis import unpack_frame, is_frame, FrameError, FLAG_REPLAYED
+
+
+SNAPSHOT_REQUESTS = Counter("server_snapshot_requests", "Snapshot lookups, by where the frame came from", ["source"])
+
+
+class Snapshot(NamedTuple):
+    jpeg: bytes
+    etag: str
+    captured_at: float
+
+
+class SnapshotCache:
+    """
+    The latest frame for each room, for serving still images without a Socket.IO stream.
+
+    Frames for the rooms this worker is subscribed to are stored as they arrive; nothing is parsed or copied until a
+    snapshot is requested. Other rooms are read from their latest-frame key in Redis with fetch_latest(room), and the
+    result is reused for refresh_interval seconds, so frequent polling doesn't reach Redis every time.
+    """
+    def __init__(self, fetch_latest: Callable[[str], Optional[bytes]], refresh_interval: float = 1.0):
+        self.fetch_latest = fetch_latest
+        self.refresh_interval = refresh_interval
+        # room -> (message, time it was stored)
+        self._messages: Dict[str, Tuple[bytes, float]] = {}
+        # room -> (message the snapshot was built from, snapshot)
+        self._snapshots: Dict[str, Tuple[bytes, Snapshot]] = {}
+
+    def update(self, room: str, data: bytes):
+        header, _ = unpack_frame(data)
+        # Replayed frames are from the past, so are never the latest
+        if header is None or not header.flags & FLAG_REPLAYED:
+            self._messages[room] = (data, time.monotonic())
+
+    def get(self, room: str) -> Optional[Snapshot]:
+        message, stored_at = self._messages.get(room, (None, 0.0))
+        if message is None or time.monotonic() - stored_at >= self.refresh_interval:
+            message = self.fetch_latest(room)
+            if message is None or not is_frame(message):
+                # Forget the room, so the cache only holds rooms that have frames
+                self._messages.pop(room, None)
+                self._snapshots.pop(room, None)
+                SNAPSHOT_REQUESTS.labels("missing").inc()
+                return None
+            self._messages[room] = (message, time.monotonic())
+            SNAPSHOT_REQUESTS.labels("redis").inc()
+        else:
+            SNAPSHOT_REQUESTS.labels("cache").inc()
+        built_from, snapshot = self._snapshots.get(room, (None, None))
+        # Snapshots are only built when a new frame has arrived since the last request
+        if built_from is not message:
+            try:
+                snapshot = self._build_snapshot(message)
+            except FrameError as e:
+                print(f"Latest frame for room {room} is unreadable: {e}")
+                return None
+            self._snapshots[room] = (message, snapshot)
+        return snapshot
+
+    @staticmethod
+    def _build_snapshot(message: bytes) -> Snapshot:
+        header, payload = unpack_frame(message)
+        if header is not None:
+            # The sequence number and capture time identify a frame without hashing it
+            etag = f"{header.sequence:x}-{int(header.capture_time * 1000):x}"
+            return Snapshot(bytes(payload), etag, header.capture_time)
+        return Snapshot(bytes(payload), f"{zlib.crc32(payload):08x}", time.time())
@@ -1,19 +1,40 @@
 import json
+import math
 import os
 import sqlite3
 from datetime import datetime
+from functools import wraps
 from typing import Optional, Dict, List, Tuple
 from pkg_resources import resource_string
 import logging
 
+from smart_sec_cam.metrics import Histogram
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Motion boxes are stored in the R*Tree as integers, in units of 1/MOTION_BOX_SCALE of the frame
+MOTION_BOX_SCALE = 10000
+
 # Constants for space management (in bytes)
 GB = 1024 * 1024 * 1024
 TOTAL_SPACE_LIMIT = 30 * GB
 STARRED_SPACE_LIMIT = 20 * GB
 ALERT_THRESHOLD = 0.9  # Alert at 90% capacity
+# The server and motion service write to the database at once, so a write waits up to this long for another to finish
+BUSY_TIMEOUT_SECONDS = 30
+
+DB_QUERY_SECONDS = Histogram("server_db_query_seconds", "Time spent in video database operations", ["query"])
+
+
+def timed_query(f):
+    """Record how long a database operation takes, labelled with the method name"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with DB_QUERY_SECONDS.labels(f.__name__).time():
+            return f(*args, **kwargs)
+    return decorated
+
 
 class VideoDatabase:
     def __init__(self, db_path: str):
@@ -45,7 +66,9 @@ class VideoDatabase:
                 logger.info("Successfully read SQL content from file")
 
             logger.info("Connecting to database")
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
+            # Readers don't block the writer (or vice versa) in WAL mode, which is a property of the database file
+            conn.execute("PRAGMA journal_mode=WAL")
             logger.info("Executing SQL script")
             conn.executescript(sql_content)
             conn.commit()
@@ -62,6 +85,10 @@ class VideoDatabase:
             logger.error(f"Error during database initialization: {e}")
             raise
 
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_SECONDS)
+
+    @timed_query
     def sync_with_directory(self, video_dir: str) -> tuple[List[str], List[str]]:
         """
         Synchronize the database with the actual files in the video directory.
@@ -69,7 +96,7 @@ class VideoDatabase:
         """
         logger.info(f"Syncing database with directory: {video_dir}")
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self._connect()
             cursor = conn.cursor()
 
             # Get list of files from directory
@@ -123,10 +150,11 @@ class VideoDatabase:
             logger.error(f"Error during database sync: {e}")
             raise
 
+    @timed_query
     def update_video_metadata(self, filename: str, duration: Optional[float] = None, 
                             metadata: Optional[Dict] = None):
         """Update video metadata such as duration"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         updates = []
@@ -150,9 +178,10 @@ class VideoDatabase:
 
         conn.close()
 
+    @timed_query
     def get_video_info(self, filename: str) -> Optional[Dict]:
         """Get all information about a specific video"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
 
@@ -168,9 +197,10 @@ class VideoDatabase:
             return dict(row)
         return None
 
+    @timed_query
     def mark_video_deleted(self, filename: str):
         """Mark a video as deleted in the database"""
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
         
         cursor.execute("""
@@ -182,11 +212,12 @@ class VideoDatabase:
         conn.commit()
         conn.close()
 
+    @timed_query
     def get_space_usage(self) -> Tuple[int, int]:
         """
         Returns tuple of (total_space_used, starred_space_used) in bytes
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         # Get total space usage
@@ -208,6 +239,7 @@ class VideoDatabase:
         conn.close()
         return (total_space, starred_space)
 
+    @timed_query
     def manage_disk_space(self) -> Dict[str, List[str]]:
         """
         Manages disk space by removing videos when limits are approached.
@@ -223,7 +255,7 @@ class VideoDatabase:
         if starred_space > ALERT_THRESHOLD * STARRED_SPACE_LIMIT:
             warnings.append(f"Approaching starred space limit ({starred_space / GB:.1f}GB / {STARRED_SPACE_LIMIT / GB}GB)")
 
-        conn = sqlite3.connect(self.db_path)
+        conn = self._connect()
         cursor = conn.cursor()
 
         try:
@@ -298,4 +330,130 @@ class VideoDatabase:
         return {
             "removed_videos": removed_videos,
             "warnings": warnings
-        } 
\ No newline at end of file
+        } 
+
+    @timed_query
+    def add_segment(self, room: str, filename: str, start_time: float):
+        """Index a continuous recording segment when it starts"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT OR REPLACE INTO segments (filename, room, start_time)
+            VALUES (?, ?, ?)
+        """, (filename, room, start_time))
+        conn.commit()
+        conn.close()
+
+    @timed_query
+    def finish_segment(self, filename: str, end_time: float, frame_count: int, filesize: int):
+        """Record the end of a continuous recording segment once it has been written"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE segments
+            SET end_time = ?, frame_count = ?, filesize = ?
+            WHERE filename = ?
+        """, (end_time, frame_count, filesize, filename))
+        conn.commit()
+        conn.close()
+
+    @timed_query
+    def mark_segments_deleted(self, filenames: List[str]):
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.executemany("""
+            UPDATE segments
+            SET deleted_at = ?
+            WHERE filename = ?
+        """, [(datetime.now(), filename) for filename in filenames])
+        conn.commit()
+        conn.close()
+
+    @timed_query
+    def add_motion_event(self, room: str, start_time: float, end_time: float):
+        """Mark motion on a room's continuous recording timeline"""
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO motion_events (room, start_time, end_time)
+            VALUES (?, ?, ?)
+        """, (room, start_time, end_time))
+        conn.commit()
+        conn.close()
+
+    @timed_query
+    def get_timeline(self, room: str, start_time: float, end_time: float) -> Dict[str, List[Dict]]:
+        """
+        Segments and motion events for a room that overlap the given time range, in time order.
+        Segments that are still being written have an end_time of None.
+        """
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        cursor.execute("""
+            SELECT filename, start_time, end_time, frame_count, filesize
+            FROM segments
+            WHERE room = ? AND deleted_at IS NULL AND start_time < ? AND (end_time IS NULL OR end_time > ?)
+            ORDER BY start_time ASC
+        """, (room, end_time, start_time))
+        segments = [dict(row) for row in cursor.fetchall()]
+
+        cursor.execute("""
+            SELECT start_time, end_time
+            FROM motion_events
+            WHERE room = ? AND start_time < ? AND end_time > ?
+            ORDER BY start_time ASC
+        """, (room, end_time, start_time))
+        events = [dict(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return {"segments": segments, "events": events}
+
+    @timed_query
+    def add_motion_boxes(self, room: str, video: Optional[str], event_start: float,
+                         boxes: List[Tuple[float, float, float, float, float, float]]):
+        """
+        Index where motion was seen during an event. Each box is (min_x, min_y, max_x, max_y, start_time, end_time),
+        with coordinates normalized to the frame (0 to 1) and unix times.
+        """
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.executemany("""
+            INSERT INTO motion_boxes (min_x, max_x, min_y, max_y, min_time, max_time, room, video, event_start)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(int(min_x * MOTION_BOX_SCALE), math.ceil(max_x * MOTION_BOX_SCALE),
+               int(min_y * MOTION_BOX_SCALE), math.ceil(max_y * MOTION_BOX_SCALE),
+               int(start_time), math.ceil(end_time), room, video, event_start)
+              for min_x, min_y, max_x, max_y, start_time, end_time in boxes])
+        conn.commit()
+        conn.close()
+
+    @timed_query
+    def search_motion(self, min_x: float, min_y: float, max_x: float, max_y: float, start_time: float,
+                      end_time: float, room: Optional[str] = None) -> List[Dict]:
+        """
+        Motion events with motion inside a rectangle (normalized to the frame) between two unix times, most recent
+        first. The R*Tree finds the matching boxes without scanning every event.
+        """
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+
+        query = """
+            SELECT room, video, event_start, MIN(min_time) AS start_time, MAX(max_time) AS end_time
+            FROM motion_boxes
+            WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ? AND max_time >= ? AND min_time <= ?
+        """
+        params = [int(min_x * MOTION_BOX_SCALE), math.ceil(max_x * MOTION_BOX_SCALE),
+                  int(min_y * MOTION_BOX_SCALE), math.ceil(max_y * MOTION_BOX_SCALE),
+                  int(start_time), math.ceil(end_time)]
+        if room is not None:
+            query += " AND room = ?"
+            params.append(room)
+        query += " GROUP BY room, event_start ORDER BY event_start DESC"
+        cursor.execute(query, params)
+        results = [dict(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return results
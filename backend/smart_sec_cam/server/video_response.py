@@ -0,0 +1,64 @@
+import os
+from typing import Optional
+
+from flask import send_file, Response
+from werkzeug.security import safe_join
+from werkzeug.wsgi import FileWrapper
+
+
+VIDEO_MIME_TYPES = {
+    ".webm": "video/webm",
+    ".mp4": "video/mp4",
+}
+# Recorded clips never change once written, so browsers may reuse them for an hour before revalidating
+VIDEO_CACHE_MAX_AGE = 3600
+# Block size used when streaming files through servers that do not provide a native file wrapper
+FILE_WRAPPER_BLOCK_SIZE = 256 * 1024
+
+
+class LargeBlockFileWrapper(FileWrapper):
+    """
+    File wrapper that streams in large blocks.
+
+    Werkzeug defaults to 8 KiB reads, which means thousands of small writes (and green thread switches) per clip.
+    """
+    def __init__(self, file, buffer_size: int = 8192):
+        super().__init__(file, max(buffer_size, FILE_WRAPPER_BLOCK_SIZE))
+
+
+class FileWrapperMiddleware:
+    """
+    Provides `wsgi.file_wrapper` for WSGI servers that do not offer one.
+
+    Servers that ship their own wrapper (e.g. gunicorn, which uses sendfile on plain sockets) keep theirs, so file
+    responses are handed to the kernel whenever the server supports it.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        environ.setdefault("wsgi.file_wrapper", LargeBlockFileWrapper)
+        return self.wsgi_app(environ, start_response)
+
+
+def get_video_mime_type(file_name: str) -> Optional[str]:
+    return VIDEO_MIME_TYPES.get(os.path.splitext(file_name)[1].lower())
+
+
+def send_video(video_dir: str, file_name: str) -> Optional[Response]:
+    """
+    Build a response for a recorded video that supports byte ranges and conditional requests.
+
+    Returns None if the file does not exist or is not a supported video type.
+    """
+    mime_type = get_video_mime_type(file_name)
+    file_path = safe_join(video_dir, file_name)
+    if mime_type is None or file_path is None or not os.path.isfile(file_path):
+        return None
+    # conditional=True handles Range/If-Range (206), If-None-Match and If-Modified-Since (304)
+    response = send_file(file_path, mimetype=mime_type, as_attachment=False, download_name=file_name,
+                         conditional=True, etag=True, max_age=VIDEO_CACHE_MAX_AGE)
+    # Clips are only available to authenticated users, so shared caches must not store them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
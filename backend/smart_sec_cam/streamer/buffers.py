@@ -0,0 +1,64 @@
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+class FramePool:
+    """
+    Reusable image buffers, so capturing a frame doesn't allocate a new array every time.
+
+    Buffers are kept per shape (e.g. a rotated frame has a different shape to the captured one). A frame must be
+    released once nothing refers to it any more, after which it may be overwritten by a later capture.
+    """
+    def __init__(self, max_free: int = 4):
+        self.max_free = max_free
+        self._free: Dict[Tuple[int, ...], List[np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: Tuple[int, ...]) -> np.ndarray:
+        with self._lock:
+            free_buffers = self._free.get(shape)
+            if free_buffers:
+                return free_buffers.pop()
+        return np.empty(shape, dtype=np.uint8)
+
+    def release(self, frame: Optional[np.ndarray]):
+        if frame is None or frame.base is not None:
+            # Views of other buffers (e.g. JPEG frames from a passthrough camera) aren't pooled
+            return
+        with self._lock:
+            free_buffers = self._free.setdefault(frame.shape, [])
+            if len(free_buffers) < self.max_free:
+                free_buffers.append(frame)
+
+
+class BytePool:
+    """
+    Reusable bytearrays for encoded frames.
+
+    acquire() returns a buffer at least as large as requested; callers work with a memoryview of the part they use.
+    Buffers are allocated with some headroom, since JPEG sizes vary from frame to frame.
+    """
+    HEADROOM = 1.25
+
+    def __init__(self, max_free: int = 64):
+        self.max_free = max_free
+        self._free: List[bytearray] = []
+        self._lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        with self._lock:
+            for index, buffer in enumerate(self._free):
+                if len(buffer) >= size:
+                    return self._free.pop(index)
+        return bytearray(int(size * self.HEADROOM))
+
+    def release(self, data: Union[bytes, bytearray, memoryview]):
+        """Return a buffer, or a memoryview of one, to the pool. Anything not from a pool is ignored."""
+        buffer = data.obj if isinstance(data, memoryview) else data
+        if not isinstance(buffer, bytearray):
+            return
+        with self._lock:
+            if len(self._free) < self.max_free:
+                self._free.append(buffer)
@@ -1,78 +1,210 @@
+import mmap
+import time
 from abc import ABC, abstractmethod
 from typing import Tuple
 
 import cv2
 import numpy as np
-# from picamera import PiCamera # install prior to use
+
+from smart_sec_cam.streamer.buffers import FramePool
 
 
 class Camera(ABC):
-    """Abstract base class for camera implementations."""
-    
+    """
+    Abstract base class for camera implementations.
+
+    Frames are normally BGR images. Cameras that capture JPEG directly may instead return the encoded frame as a 1-D
+    array, which encode_frame() passes through unchanged where it can.
+    """
+    # (width, height) of the most recently captured frame
+    frame_size: Tuple[int, int] = (0, 0)
+    encode_params = (int(cv2.IMWRITE_JPEG_QUALITY), 70)
+    image_rotation = 0
+    # JPEG frames from the camera are passed through unless a lower quality than this is requested
+    passthrough_jpeg_quality = 0
+    _frame_pool = None
+
+    @property
+    def frame_pool(self) -> FramePool:
+        """Buffers that frames are captured into, reused once they have been released with release_frame()."""
+        if self._frame_pool is None:
+            self._frame_pool = FramePool()
+        return self._frame_pool
+
     @abstractmethod
+    def read_frame(self) -> np.ndarray:
+        """
+        Read a frame from the sensor, either BGR or JPEG encoded. The frame should be passed to release_frame() once
+        it's been used.
+        """
+        pass
+
+    def get_frame_size(self, frame: np.ndarray) -> Tuple[int, int]:
+        """(width, height) of a frame returned by read_frame()."""
+        if is_encoded(frame):
+            return self.frame_size
+        return frame.shape[1], frame.shape[0]
+
+    def release_frame(self, frame: np.ndarray):
+        """Allow a frame's buffer to be reused by a later read_frame()."""
+        self.frame_pool.release(frame)
+
+    def encode_frame(self, frame: np.ndarray, scale: float = 1.0) -> memoryview:
+        """
+        Encode a frame returned by read_frame() as JPEG, optionally downscaling it first.
+
+        Returns a view of the encoder's output rather than copying it to bytes; it's copied once, into the message.
+        Frames that are already JPEG are returned as is, unless they need to be downscaled or have their quality
+        reduced.
+        """
+        if is_encoded(frame):
+            if scale == 1.0 and self.jpeg_quality >= self.passthrough_jpeg_quality:
+                return memoryview(frame)
+            if scale <= 0.5:
+                # JPEG can be decoded straight to half size, which is much cheaper than a full decode
+                frame = cv2.imdecode(frame, cv2.IMREAD_REDUCED_COLOR_2)
+                scale *= 2
+            else:
+                frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+        if scale != 1.0:
+            frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return memoryview(cv2.imencode('.jpeg', frame, self.encode_params)[1].reshape(-1))
+
+    @property
+    def jpeg_quality(self) -> int:
+        return self.encode_params[1]
+
+    def set_jpeg_quality(self, jpeg_quality: int):
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), int(jpeg_quality)]
+
     def capture_image(self) -> bytes:
         """Capture an image and return it as JPEG bytes."""
-        pass
+        frame = self.read_frame()
+        image = bytes(self.encode_frame(frame))
+        self.release_frame(frame)
+        return image
 
     @abstractmethod
     def close(self):
         """Release the camera resources."""
         pass
 
+    def _rotate_image(self, frame: np.ndarray) -> np.ndarray:
+        height, width = frame.shape[:2]
+        if self.image_rotation == 90:
+            return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE,
+                              self.frame_pool.acquire((width, height) + frame.shape[2:]))
+        elif self.image_rotation == -90 or self.image_rotation == 270:
+            return cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE,
+                              self.frame_pool.acquire((width, height) + frame.shape[2:]))
+        elif self.image_rotation == 180:
+            return cv2.rotate(frame, cv2.ROTATE_180, self.frame_pool.acquire(frame.shape))
+        else:
+            print(f"Invalid rotation value: {self.image_rotation}")
+            return frame
+
+    def _rotate_encoded_frame(self, frame: np.ndarray) -> np.ndarray:
+        """Decode and rotate a JPEG frame. Rotated frames are re-encoded by encode_frame()."""
+        rotated_frame = self._rotate_image(cv2.imdecode(frame, cv2.IMREAD_COLOR))
+        self.frame_size = (rotated_frame.shape[1], rotated_frame.shape[0])
+        return rotated_frame
+
+
+def is_encoded(frame: np.ndarray) -> bool:
+    """Whether a frame is JPEG data rather than an image."""
+    return frame.ndim == 1
+
 
 class UsbCamera(Camera):
-    """Generic USB camera class"""
+    """
+    Generic USB camera class
+
+    With mjpeg_passthrough, the camera is asked for MJPEG and its JPEG frames are sent as they are, rather than being
+    decoded to BGR by OpenCV and then re-encoded. Most UVC cameras support this. Frames are still decoded if they need
+    to be rotated.
+    """
     def __init__(self, usb_port: int = 0, resolution: Tuple[int, int] = (640, 480), jpeg_quality: int = 70,
-                 image_rotation: int = 0):
+                 image_rotation: int = 0, mjpeg_passthrough: bool = False):
         self.usb_port = usb_port
         self.resolution = resolution
         self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
         self.camera = cv2.VideoCapture(int(self.usb_port))
+        self.mjpeg_passthrough = mjpeg_passthrough
+        if self.mjpeg_passthrough:
+            self._enable_mjpeg_passthrough()
+            self.passthrough_jpeg_quality = jpeg_quality
         self._set_resolution()
         self.image_rotation = image_rotation
+        # Shape of captured frames, known after the first read
+        self._capture_shape = None
 
-    def capture_image(self) -> bytes:
-        ret, frame = self.camera.read()
+    def read_frame(self) -> np.ndarray:
+        if self.mjpeg_passthrough:
+            return self._read_encoded_frame()
+        # Read into a reused buffer once the frame shape is known, rather than allocating a new frame every time
+        buffer = self.frame_pool.acquire(self._capture_shape) if self._capture_shape else None
+        ret, frame = self.camera.read(buffer)
         if not ret:
+            self.release_frame(buffer)
             raise RuntimeError('Failed to capture image - check camera port value')
+        self._capture_shape = frame.shape
         if self.image_rotation:
-            frame = self._rotate_image(frame)
-        processed_image_data = (cv2.imencode('.jpeg', frame, self.encode_params)[1]).tobytes()
-        return processed_image_data
+            rotated_frame = self._rotate_image(frame)
+            if rotated_frame is not frame:
+                self.release_frame(frame)
+            frame = rotated_frame
+        self.frame_size = (frame.shape[1], frame.shape[0])
+        return frame
 
     def close(self):
         self.camera.release()
 
+    def _read_encoded_frame(self) -> np.ndarray:
+        # JPEG sizes vary, so these aren't read into pooled buffers
+        ret, frame = self.camera.read()
+        if not ret:
+            raise RuntimeError('Failed to capture image - check camera port value')
+        if frame.ndim == 3:
+            # Already decoded, so the camera (or OpenCV backend) doesn't support MJPEG passthrough
+            print("Camera didn't provide MJPEG frames; disabling passthrough")
+            self.mjpeg_passthrough = False
+            self.passthrough_jpeg_quality = 0
+            self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+            self.frame_size = (frame.shape[1], frame.shape[0])
+            return frame
+        frame = frame.reshape(-1)
+        if self.image_rotation:
+            return self._rotate_encoded_frame(frame)
+        self.frame_size = (int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                           int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        return frame
+
+    def _enable_mjpeg_passthrough(self):
+        self.camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        # Return the camera's compressed frames rather than decoding them to BGR
+        self.camera.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+
     def _set_resolution(self):
         # OpenCV is (height, width), not (width, height)
         self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, self.resolution[1])
         self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, self.resolution[0])
 
-    def _rotate_image(self, frame):
-        if self.image_rotation == 90:
-            return cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
-        elif self.image_rotation == -90 or self.image_rotation == 270:
-            return cv2.rotate(frame, cv2.ROTATE_90_COUNTERCLOCKWISE)
-        elif self.image_rotation == 180:
-            return cv2.rotate(frame, cv2.ROTATE_180)
-        else:
-            print(f"Invalid rotation value: {self.image_rotation}")
-            return frame
-
 
 class RPiCamera(Camera):
     """Raspberry Pi camera class"""
     def __init__(self, resolution: Tuple[int, int] = (640, 480), jpeg_quality: int = 70, image_rotation: int = 0):
+        # Imported here so picamera is only required on devices that use this camera
+        from picamera import PiCamera
         self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
         self.camera = PiCamera()
         self._set_resolution(resolution)
         self._set_rotation(image_rotation)
 
-    def capture_image(self) -> bytes:
-        frame = np.empty((self.camera.resolution[1], self.camera.resolution[0], 3), dtype=np.uint8)
+    def read_frame(self) -> np.ndarray:
+        frame = self.frame_pool.acquire((self.camera.resolution[1], self.camera.resolution[0], 3))
         self.camera.capture(frame, format='bgr', use_video_port=True)
-        processed_image_data = (cv2.imencode('.jpeg', frame, self.encode_params)[1]).tobytes()
-        return processed_image_data
+        self.frame_size = (frame.shape[1], frame.shape[0])
+        return frame
 
     def close(self):
         self.camera.close()
@@ -86,8 +218,98 @@ class RPiCamera(Camera):
 
 class WebCam720p(UsbCamera):
     """720p USB camera class"""
-    def __init__(self, usb_port: int = 0, jpeg_quality: int = 70, image_rotation: int = 0):
-        super().__init__(usb_port=usb_port, resolution=(720, 1280), jpeg_quality=jpeg_quality, image_rotation=image_rotation)
+    def __init__(self, usb_port: int = 0, jpeg_quality: int = 70, image_rotation: int = 0,
+                 mjpeg_passthrough: bool = False):
+        super().__init__(usb_port=usb_port, resolution=(720, 1280), jpeg_quality=jpeg_quality, image_rotation=image_rotation,
+                         mjpeg_passthrough=mjpeg_passthrough)
 
 
-webcam720p = WebCam720p(usb_port=0, jpeg_quality=70, image_rotation=0)
\ No newline at end of file
+class MjpegFileCamera(Camera):
+    """
+    Plays back an MJPEG file (concatenated JPEG frames, e.g. from `ffmpeg -i video.mp4 -c:v mjpeg -f mjpeg out.mjpeg`)
+    as if it were a camera in MJPEG passthrough mode. Useful for testing the streamer and server without camera
+    hardware.
+    """
+    def __init__(self, path: str, fps: float = 10.0, loop: bool = True, jpeg_quality: int = 70,
+                 image_rotation: int = 0):
+        self.path = path
+        self.fps = fps
+        self.loop = loop
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+        self.passthrough_jpeg_quality = jpeg_quality
+        self.image_rotation = image_rotation
+        with open(self.path, 'rb') as mjpeg_file:
+            self._map = mmap.mmap(mjpeg_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._frame_offsets = self._find_frames()
+        if not self._frame_offsets:
+            raise ValueError(f"No JPEG frames found in {self.path}")
+        self._next_frame = 0
+        self._next_frame_time = time.monotonic()
+        first_frame = cv2.imdecode(self._get_frame(0), cv2.IMREAD_COLOR)
+        self.frame_size = (first_frame.shape[1], first_frame.shape[0])
+
+    def read_frame(self) -> np.ndarray:
+        if self._next_frame >= len(self._frame_offsets):
+            if not self.loop:
+                raise RuntimeError(f"Reached the end of {self.path}")
+            self._next_frame = 0
+        # Frames are produced no faster than the file's frame rate, like a real camera
+        delay = self._next_frame_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._next_frame_time = max(self._next_frame_time, time.monotonic() - 1.0) + 1.0 / self.fps
+        frame = self._get_frame(self._next_frame)
+        self._next_frame += 1
+        if self.image_rotation:
+            return self._rotate_encoded_frame(frame)
+        return frame
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # Frames still refer to the file; it's closed once they've been garbage collected
+            pass
+
+    def _get_frame(self, index: int) -> np.ndarray:
+        # A view of the memory-mapped file, so frames aren't copied
+        start, end = self._frame_offsets[index]
+        return np.frombuffer(self._map, dtype=np.uint8, count=end - start, offset=start)
+
+    def _find_frames(self):
+        offsets = []
+        start = self._map.find(b'\xff\xd8')
+        while start != -1:
+            end = self._map.find(b'\xff\xd9', start + 2)
+            if end == -1:
+                break
+            offsets.append((start, end + 2))
+            start = self._map.find(b'\xff\xd8', end + 2)
+        return offsets
+
+
+class SyntheticCamera(Camera):
+    """
+    Generates frames rather than capturing them: a noisy gradient with a block moving across it (or standing still,
+    with moving=False), at any resolution. A loop of frame_count frames is JPEG encoded up front and then returned in
+    turn, as if from a camera in MJPEG passthrough mode, so producing frames costs next to nothing. Used for load
+    testing; the frame rate is set by the Streamer.
+    """
+    def __init__(self, resolution: Tuple[int, int] = (1280, 720), jpeg_quality: int = 70, frame_count: int = 30,
+                 moving: bool = True):
+        # Imported here so the streamer doesn't depend on the video package unless this camera is used
+        from smart_sec_cam.video.benchmark import generate_frames
+        self.encode_params = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
+        self.passthrough_jpeg_quality = jpeg_quality
+        self.frame_size = tuple(resolution)
+        frames = generate_frames(self.frame_size, frame_count if moving else 1)
+        self._frames = [cv2.imencode('.jpeg', frame, self.encode_params)[1].reshape(-1) for frame in frames]
+        self._next_frame = 0
+
+    def read_frame(self) -> np.ndarray:
+        frame = self._frames[self._next_frame]
+        self._next_frame = (self._next_frame + 1) % len(self._frames)
+        return frame
+
+    def close(self):
+        pass
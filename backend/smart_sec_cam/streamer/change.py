@@ -0,0 +1,49 @@
+import time
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+class SceneChangeDetector:
+    """
+    Cheap check for whether a frame differs enough from the last frame that was sent to be worth sending.
+
+    Frames are compared as small greyscale thumbnails, which also averages out sensor noise. Comparing against the last
+    sent frame (not the previous captured frame) means slow changes still accumulate until they are sent. A heartbeat
+    frame is always sent every `heartbeat_interval` seconds so the live view and channel list stay current.
+    """
+    def __init__(self, heartbeat_interval: float = 10.0, thumbnail_width: int = 64, pixel_threshold: int = 25,
+                 changed_fraction: float = 0.005):
+        self.heartbeat_interval = heartbeat_interval
+        self.thumbnail_width = thumbnail_width
+        self.pixel_threshold = pixel_threshold
+        self.changed_fraction = changed_fraction
+        self.reference_thumbnail: Optional[np.ndarray] = None
+        self.last_sent_time = None
+
+    def should_send(self, frame: np.ndarray, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        thumbnail = self._make_thumbnail(frame)
+        if (self.reference_thumbnail is None or self.reference_thumbnail.shape != thumbnail.shape
+                or now - self.last_sent_time >= self.heartbeat_interval
+                or self._has_changed(thumbnail)):
+            self.reference_thumbnail = thumbnail
+            self.last_sent_time = now
+            return True
+        return False
+
+    def _has_changed(self, thumbnail: np.ndarray) -> bool:
+        frame_delta = cv2.absdiff(self.reference_thumbnail, thumbnail)
+        changed_pixels = np.count_nonzero(frame_delta > self.pixel_threshold)
+        return changed_pixels >= self.changed_fraction * thumbnail.size
+
+    def _make_thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        if frame.ndim == 1:
+            # JPEG frames (from passthrough cameras) can be decoded at 1/8 scale for little more than parsing them
+            frame = cv2.imdecode(frame, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+        height = max(1, int(frame.shape[0] * self.thumbnail_width / frame.shape[1]))
+        thumbnail = cv2.resize(frame, (self.thumbnail_width, height), interpolation=cv2.INTER_AREA)
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+        return thumbnail
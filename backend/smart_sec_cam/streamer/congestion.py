@@ -0,0 +1,86 @@
+import time
+from typing import NamedTuple, List, Optional
+
+
+class StreamLevel(NamedTuple):
+    jpeg_quality: int
+    fps_factor: float  # Fraction of the target capture frame rate
+
+
+def build_levels(base_quality: int) -> List[StreamLevel]:
+    """
+    Quality ladder from the camera's configured settings down to the cheapest stream that is still useful.
+
+    The resolution is never changed, since consumers (motion detection, recordings, live segments) expect every frame
+    from a camera to be the same size.
+    """
+    return [
+        StreamLevel(base_quality, 1.0),
+        StreamLevel(int(base_quality * 0.8), 1.0),
+        StreamLevel(int(base_quality * 0.65), 0.75),
+        StreamLevel(int(base_quality * 0.55), 0.5),
+        StreamLevel(int(base_quality * 0.45), 0.33),
+    ]
+
+
+class CongestionController:
+    """
+    Chooses a stream level from send latency and send queue depth.
+
+    Steps down a level after `step_down_after` consecutive congested updates, and back up once the link has been
+    healthy for `step_up_after_seconds`. Healthy means well below the congestion thresholds, so the level doesn't
+    oscillate around them. After stepping down, the level is held for `cooldown_seconds` while the queue drains, so a
+    short blip costs one level rather than all of them.
+    """
+    def __init__(self, levels: List[StreamLevel], latency_threshold: float = 0.25, queue_threshold: float = 0.5,
+                 step_down_after: int = 3, step_up_after_seconds: float = 10.0, latency_smoothing: float = 0.2,
+                 cooldown_seconds: float = 5.0):
+        self.levels = levels
+        self.latency_threshold = latency_threshold
+        self.queue_threshold = queue_threshold
+        self.step_down_after = step_down_after
+        self.step_up_after_seconds = step_up_after_seconds
+        self.latency_smoothing = latency_smoothing
+        self.cooldown_seconds = cooldown_seconds
+        self.level_index = 0
+        self.send_latency = 0.0
+        self._congested_updates = 0
+        self._healthy_since: Optional[float] = None
+        self._stepped_down_at: Optional[float] = None
+
+    @property
+    def level(self) -> StreamLevel:
+        return self.levels[self.level_index]
+
+    def record_send(self, latency: float):
+        """Record the time taken to send one frame."""
+        self.send_latency += self.latency_smoothing * (latency - self.send_latency)
+
+    def update(self, queue_fill: float, now: Optional[float] = None) -> StreamLevel:
+        """Update the level given the fraction (0-1) of the send queue in use."""
+        now = time.monotonic() if now is None else now
+        congested = queue_fill > self.queue_threshold or self.send_latency > self.latency_threshold
+        healthy = queue_fill < self.queue_threshold / 2 and self.send_latency < self.latency_threshold / 2
+        if self._stepped_down_at is not None and now - self._stepped_down_at < self.cooldown_seconds:
+            # Give the last step down time to take effect before judging the link again
+            self._congested_updates = 0
+            self._healthy_since = None
+        elif congested:
+            self._healthy_since = None
+            self._congested_updates += 1
+            if self._congested_updates >= self.step_down_after and self.level_index < len(self.levels) - 1:
+                self.level_index += 1
+                self._congested_updates = 0
+                self._stepped_down_at = now
+                print(f"Link congested; stepping down to stream level {self.level_index}: {self.level}")
+        else:
+            self._congested_updates = 0
+            if not healthy:
+                self._healthy_since = None
+            elif self._healthy_since is None:
+                self._healthy_since = now
+            elif now - self._healthy_since >= self.step_up_after_seconds and self.level_index > 0:
+                self.level_index -= 1
+                self._healthy_since = now
+                print(f"Link recovered; stepping up to stream level {self.level_index}: {self.level}")
+        return self.level
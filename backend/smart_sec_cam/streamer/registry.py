@@ -0,0 +1,65 @@
+import importlib
+import json
+from typing import Dict, Type, Union
+
+from smart_sec_cam.streamer.camera import Camera
+
+
+# Camera classes are referenced by "module:Class" path and only imported when a camera is created, so optional
+# dependencies (e.g. picamera) are only needed by the process that actually uses that camera.
+_CAMERA_CLASSES: Dict[str, Union[str, Type[Camera]]] = {
+    'UsbCamera': 'smart_sec_cam.streamer.camera:UsbCamera',
+    'WebCam720p': 'smart_sec_cam.streamer.camera:WebCam720p',
+    'RPiCamera': 'smart_sec_cam.streamer.camera:RPiCamera',
+    'MjpegFileCamera': 'smart_sec_cam.streamer.camera:MjpegFileCamera',
+    'SyntheticCamera': 'smart_sec_cam.streamer.camera:SyntheticCamera',
+}
+
+
+def register_camera(name: str, camera_class: Union[str, Type[Camera]]):
+    """Register a Camera class, or a "module:Class" path to one, under a name usable with create_camera()."""
+    _CAMERA_CLASSES[name] = camera_class
+
+
+def get_camera_names():
+    return sorted(_CAMERA_CLASSES)
+
+
+def get_camera_class(name: str) -> Type[Camera]:
+    """
+    Look up a registered camera class. Names that aren't registered are treated as a "module:Class" path, so camera
+    classes defined outside this package can be used without code changes.
+    """
+    camera_class = _CAMERA_CLASSES.get(name, name)
+    if isinstance(camera_class, str):
+        camera_class = _import_class(camera_class)
+    if not (isinstance(camera_class, type) and issubclass(camera_class, Camera)):
+        raise ValueError(f"{name} is not a Camera class")
+    return camera_class
+
+
+def create_camera(name: str, **kwargs) -> Camera:
+    """Instantiate (and so open) a camera by name, passing kwargs to its constructor."""
+    return get_camera_class(name)(**kwargs)
+
+
+def load_camera_config(config: str) -> Union[dict, list]:
+    """Parse camera configuration from a JSON string, or from a JSON file if config is a path."""
+    if not config:
+        return {}
+    if config.lstrip().startswith(('{', '[')):
+        return json.loads(config)
+    with open(config, 'r') as config_file:
+        return json.load(config_file)
+
+
+def _import_class(path: str) -> type:
+    module_name, separator, class_name = path.partition(':')
+    if not separator:
+        raise ValueError(f"Invalid camera class: {path}. Registered cameras are {', '.join(get_camera_names())}, "
+                         f"or use a module:Class path.")
+    module = importlib.import_module(module_name)
+    try:
+        return getattr(module, class_name)
+    except AttributeError:
+        raise ValueError(f"Module {module_name} has no camera class {class_name}")
@@ -0,0 +1,218 @@
+import os
+import queue
+import socket
+import time
+from typing import Callable, Dict, List, Tuple, Union
+
+import redis.exceptions
+
+from smart_sec_cam.metrics import Counter, Gauge, Histogram
+from smart_sec_cam.redis import RedisImageSender, unpack_frame, mark_replayed, FrameError
+from smart_sec_cam.streamer.buffers import BytePool
+from smart_sec_cam.streamer.spool import FrameSpool
+
+
+SEND_SECONDS = Histogram("streamer_send_seconds", "Time spent sending a batch of frames to the server")
+SEND_BATCH_SIZE = Histogram("streamer_send_batch_size", "Frames sent per pipelined batch",
+                            buckets=(1, 2, 4, 8, 16, 32, 64))
+SEND_QUEUE_DEPTH = Gauge("streamer_send_queue_depth", "Captured frames waiting to be sent")
+RECONNECTS = Counter("streamer_reconnects", "Reconnections to the server after a connection error")
+FRAMES_SPOOLED = Counter("streamer_frames_spooled", "Frames written to the disk spool while the server was unreachable")
+FRAMES_SPOOL_DROPPED = Counter("streamer_frames_spool_dropped", "Frames lost because the disk spool was full")
+FRAMES_REPLAYED = Counter("streamer_frames_replayed", "Spooled frames sent after reconnecting")
+SPOOL_BYTES = Gauge("streamer_spool_bytes", "Size of the disk spool")
+RECONNECT_INTERVAL = 1.0
+SPOOL_REPLAY_BATCH_SIZE = 25
+# How long to wait for live frames between replayed batches
+SPOOL_POLL_INTERVAL = 0.05
+MAX_SEND_BATCH_SIZE = 16
+
+
+class FrameSender:
+    """
+    Sends frames from any number of cameras over one Redis connection.
+
+    Cameras put (channel, frame) pairs on a shared queue with put_frame(). The sending thread (run()) takes everything
+    that is waiting and publishes it in a single pipelined round trip, so several cameras share one TLS session and
+    frames that queue up while a send is in flight go out together.
+
+    Frames packed into buffers from buffer_pool are returned to it once they have been sent, spooled or dropped.
+    """
+    def __init__(self, server_address: str, server_port: int, spool_dir: str = None, spool_max_mb: int = 512,
+                 spool_replay_rate: float = 50.0, ssl: bool = True):
+        self.server_address = server_address
+        self.server_port = int(server_port)
+        self.ssl = ssl
+        # Bounded once cameras are added; each camera reserves space for its own frames
+        self.frame_queue = queue.Queue()
+        self.buffer_pool = BytePool()
+        self.image_sender = RedisImageSender(socket.gethostname(), self.server_address, self.server_port, self.ssl)
+        self.connected = True
+        self.last_reconnect_attempt = 0.0
+        self.shutdown = False
+        # Called with the batch send time after each send, e.g. so cameras can adapt to congestion
+        self.send_callbacks: Dict[str, Callable[[float], None]] = {}
+        # Optionally store frames on disk while the server is unreachable, and replay them (at up to
+        # spool_replay_rate frames/s per camera) alongside the live frames once it's back
+        self.spool = FrameSpool(os.path.join(spool_dir, f"{socket.gethostname()}.spool"),
+                                spool_max_mb * 1024 * 1024) if spool_dir else None
+        self.spool_replay_rate = spool_replay_rate
+        self.channel_count = 0
+        self.replay_allowance = 0.0
+        self.last_replay_time = time.monotonic()
+
+    def add_channel(self, channel: str, max_queued_frames: int, on_send: Callable[[float], None] = None):
+        """Add a camera's channel, growing the queue by max_queued_frames."""
+        self.frame_queue.maxsize += max(1, max_queued_frames)
+        self.channel_count += 1
+        if on_send:
+            self.send_callbacks[channel] = on_send
+
+    @property
+    def queue_fill(self) -> float:
+        """Fraction (0-1) of the queue in use."""
+        if not self.frame_queue.maxsize:
+            return 0.0
+        return self.frame_queue.qsize() / self.frame_queue.maxsize
+
+    def put_frame(self, channel: str, frame: Union[bytes, memoryview]) -> bool:
+        """
+        Queue a frame for sending, discarding the oldest queued frame if the queue is full (staying live beats falling
+        behind). Returns True if a frame was discarded.
+        """
+        dropped = False
+        while True:
+            try:
+                self.frame_queue.put_nowait((channel, frame))
+                break
+            except queue.Full:
+                try:
+                    _, dropped_frame = self.frame_queue.get_nowait()
+                    self.buffer_pool.release(dropped_frame)
+                    dropped = True
+                except queue.Empty:
+                    pass
+        SEND_QUEUE_DEPTH.set(self.frame_queue.qsize())
+        return dropped
+
+    def run(self):
+        print("Started image sending thread.")
+        while not self.shutdown:
+            # While spooled frames are waiting, don't block on the queue for long, so they keep draining
+            batch = self._get_batch(SPOOL_POLL_INTERVAL if self._is_replaying() else 1)
+            # While offline, frames go to the spool; live frames are sent as usual once reconnected, with the spooled
+            # ones replayed alongside them
+            if self.spool and not self.connected:
+                self._spool_batch(batch)
+                self._try_reconnect()
+                continue
+            if batch:
+                self._send_batch(batch)
+            if self._is_replaying():
+                self._replay_spool()
+        print("Exited image sending thread")
+
+    def _send_batch(self, batch: List[Tuple[str, Union[bytes, memoryview]]]):
+        try:
+            send_start_time = time.perf_counter()
+            self.image_sender.send_batch(batch)
+            send_time = time.perf_counter() - send_start_time
+            SEND_SECONDS.observe(send_time)
+            SEND_BATCH_SIZE.observe(len(batch))
+            for channel in {channel for channel, _ in batch}:
+                if channel in self.send_callbacks:
+                    self.send_callbacks[channel](send_time)
+            self._release_batch(batch)
+        except redis.exceptions.ConnectionError as e:
+            print(f"Caught connection error to server {e}, trying to reconnect...")
+            RECONNECTS.inc()
+            if self.spool:
+                self.connected = False
+                self._spool_batch(batch)
+            else:
+                self._release_batch(batch)
+                time.sleep(1)
+                self.reconnect()
+
+    def reconnect(self):
+        self.image_sender = RedisImageSender(socket.gethostname(), self.server_address, self.server_port, self.ssl)
+
+    def _get_batch(self, timeout: float = 1) -> List[Tuple[str, Union[bytes, memoryview]]]:
+        """Wait up to timeout seconds for a frame, then take whatever else is already queued."""
+        try:
+            batch = [self.frame_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < MAX_SEND_BATCH_SIZE:
+            try:
+                batch.append(self.frame_queue.get_nowait())
+            except queue.Empty:
+                break
+        SEND_QUEUE_DEPTH.set(self.frame_queue.qsize())
+        return batch
+
+    def _try_reconnect(self):
+        if time.monotonic() - self.last_reconnect_attempt < RECONNECT_INTERVAL:
+            return
+        self.last_reconnect_attempt = time.monotonic()
+        self.reconnect()
+        try:
+            self.connected = self.image_sender.ping()
+        except redis.exceptions.ConnectionError:
+            self.connected = False
+        if self.connected:
+            print(f"Reconnected to server; replaying {self.spool.size} bytes of spooled frames")
+
+    def _spool_batch(self, batch: List[Tuple[str, Union[bytes, memoryview]]]):
+        for _, frame in batch:
+            if self.spool.append(mark_replayed(frame)):
+                FRAMES_SPOOLED.inc()
+            else:
+                FRAMES_SPOOL_DROPPED.inc()
+        SPOOL_BYTES.set(self.spool.size)
+        self._release_batch(batch)
+
+    def _release_batch(self, batch: List[Tuple[str, Union[bytes, memoryview]]]):
+        for _, frame in batch:
+            self.buffer_pool.release(frame)
+
+    def _is_replaying(self) -> bool:
+        return bool(self.spool) and self.connected and self.spool.has_pending()
+
+    def _replay_spool(self):
+        """Send a batch of spooled frames, pipelined, if the replay rate allows it."""
+        now = time.monotonic()
+        # The rate is per camera, so the spool drains as fast with several cameras sharing it as with one. Up to a
+        # batch's worth of allowance builds up between calls.
+        replay_rate = self.spool_replay_rate * max(1, self.channel_count)
+        self.replay_allowance = min(SPOOL_REPLAY_BATCH_SIZE,
+                                    self.replay_allowance + (now - self.last_replay_time) * replay_rate)
+        self.last_replay_time = now
+        if self.replay_allowance < 1:
+            return
+        frames, next_offset = self.spool.read_batch(int(self.replay_allowance))
+        if not frames:
+            return
+        self.replay_allowance -= len(frames)
+        # Frames from all cameras share the spool; the channel is recovered from each frame's envelope
+        batch = []
+        for frame in frames:
+            try:
+                header, _ = unpack_frame(frame)
+            except FrameError:
+                header = None
+            if header is None:
+                FRAMES_SPOOL_DROPPED.inc()
+                continue
+            batch.append((header.camera_id, frame))
+        if batch:
+            # Replayed frames are older than the live ones, so mustn't replace them as each channel's latest frame
+            try:
+                self.image_sender.send_batch(batch, update_latest=False)
+            except redis.exceptions.ConnectionError as e:
+                print(f"Lost connection to server while replaying spool: {e}")
+                self.connected = False
+                return
+        self.spool.advance(next_offset)
+        FRAMES_REPLAYED.inc(len(batch))
+        SPOOL_BYTES.set(self.spool.size)
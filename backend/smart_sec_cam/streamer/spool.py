@@ -0,0 +1,84 @@
+import mmap
+import os
+import struct
+from typing import List, Tuple
+
+
+class FrameSpool:
+    """
+    Append-only, memory-mapped file of frames that couldn't be sent to the server.
+
+    Frames are stored as length-prefixed records. Frames are appended while the server is unreachable, then read back
+    in order via a memory map while the spool is replayed. Once it has been fully replayed the file is truncated.
+    """
+    RECORD_HEADER = struct.Struct("!I")
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(path, "ab")
+        self._map = None
+        self._read_offset = 0
+
+    @property
+    def size(self) -> int:
+        return self._file.tell()
+
+    def has_pending(self) -> bool:
+        return self._read_offset < self.size
+
+    def append(self, frame: bytes) -> bool:
+        """Append a frame. Returns False if the spool is full and the frame was not stored."""
+        if self.size + self.RECORD_HEADER.size + len(frame) > self.max_bytes:
+            return False
+        self._file.write(self.RECORD_HEADER.pack(len(frame)))
+        self._file.write(frame)
+        # Flush so the data is visible through the memory map
+        self._file.flush()
+        return True
+
+    def read_batch(self, max_frames: int) -> Tuple[List[bytes], int]:
+        """Read up to max_frames pending frames. Returns the frames and the offset to pass to advance()."""
+        end = self.size
+        if self._map is None or len(self._map) < end:
+            self._remap()
+        frames = []
+        offset = self._read_offset
+        while len(frames) < max_frames and offset + self.RECORD_HEADER.size <= end:
+            (length,) = self.RECORD_HEADER.unpack_from(self._map, offset)
+            record_end = offset + self.RECORD_HEADER.size + length
+            if record_end > end:
+                break
+            frames.append(self._map[offset + self.RECORD_HEADER.size:record_end])
+            offset = record_end
+        return frames, offset
+
+    def advance(self, offset: int):
+        """Mark frames up to offset as sent. The spool is truncated once everything has been sent."""
+        self._read_offset = offset
+        if self._read_offset >= self.size:
+            self.clear()
+
+    def clear(self):
+        self._close_map()
+        self._file.truncate(0)
+        self._file.seek(0)
+        self._read_offset = 0
+
+    def close(self):
+        self._close_map()
+        self._file.close()
+
+    def _remap(self):
+        self._close_map()
+        if self.size:
+            with open(self.path, "rb") as spool_file:
+                self._map = mmap.mmap(spool_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -2,60 +2,151 @@ import queue
 import time
 import socket
 from threading import Thread
+from typing import List, Tuple
 
-import redis.exceptions
+from smart_sec_cam.metrics import Counter, Gauge, Histogram, start_metrics_server
+from smart_sec_cam.redis import FrameHeader, pack_frame_into, packed_frame_length
+from smart_sec_cam.streamer.camera import Camera
+from smart_sec_cam.streamer.change import SceneChangeDetector
+from smart_sec_cam.streamer.congestion import CongestionController, build_levels
+from smart_sec_cam.streamer.registry import create_camera, get_camera_names, load_camera_config
+from smart_sec_cam.streamer.sender import FrameSender
 
-from camera import Camera, webcam720p
-from smart_sec_cam.redis import RedisImageSender
 
-shutdown = False
+FRAMES_CAPTURED = Counter("streamer_frames_captured", "Frames captured from the camera", ["channel"])
+FRAMES_SKIPPED = Counter("streamer_frames_skipped", "Captured frames dropped because the encoder fell behind",
+                         ["channel"])
+CAPTURE_FPS = Gauge("streamer_capture_fps", "Measured capture frame rate", ["channel"])
+CAPTURE_SECONDS = Histogram("streamer_capture_seconds", "Time spent reading a frame from the camera", ["channel"])
+ENCODE_SECONDS = Histogram("streamer_encode_seconds", "Time spent JPEG encoding a frame", ["channel"])
+FRAMES_DISCARDED = Counter("streamer_frames_discarded", "Encoded frames dropped because the send queue was full",
+                           ["channel"])
+STREAM_LEVEL = Gauge("streamer_stream_level", "Current adaptive quality level (0 is full quality)", ["channel"])
+FRAMES_SUPPRESSED = Counter("streamer_frames_suppressed", "Frames not sent because the scene had not changed",
+                            ["channel"])
+FPS_UPDATE_INTERVAL = 5.0
 
 
 class Streamer:
-    def __init__(self, server_address: str, server_port: int, capture_delay: float = 0.1,
-                 camera: Camera = None):
+    """Captures and encodes frames from one camera, and hands them to a (possibly shared) FrameSender."""
+    def __init__(self, sender: FrameSender, camera: Camera, channel: str = None, capture_delay: float = 0.1,
+                 fps: float = None, adaptive_quality: bool = True, suppress_static_frames: bool = False,
+                 heartbeat_interval: float = 10.0):
         assert camera is not None, "Camera object must be provided"
         self.cap_delay = capture_delay
+        # Capture is paced to a target frame rate; capture_delay is kept as the default for compatibility
+        self.base_fps = fps or 1.0 / capture_delay
+        self.target_fps = self.base_fps
         self.camera = camera
-        # Image data queues
-        self.image_queue = queue.Queue(maxsize=int(5.0/capture_delay))  # Only queue 5 seconds of video
-        # Image sending client
-        self.server_address = server_address
-        self.server_port = int(server_port)
-        self.image_sender = RedisImageSender(socket.gethostname(), self.server_address, self.server_port)
+        self.channel = channel or socket.gethostname()
+        self.shutdown = False
+        # Steps quality and frame rate down when the link to the server can't keep up
+        self.congestion_controller = CongestionController(build_levels(camera.jpeg_quality)) \
+            if adaptive_quality else None
+        # Optionally skip frames where nothing has changed, sending a keyframe every heartbeat_interval seconds
+        self.change_detector = SceneChangeDetector(heartbeat_interval) if suppress_static_frames else None
+        # Frames waiting to be encoded
+        self.raw_frame_queue = queue.Queue(maxsize=2)
+        # Encoded frames are sent by the sender, which queues up to 5 seconds of video per camera
+        self.sender = sender
+        self.sender.add_channel(self.channel, int(5.0 * self.target_fps),
+                                self.congestion_controller.record_send if self.congestion_controller else None)
+        # Sequence number of the next frame, used by consumers to detect dropped frames
+        self.sequence = 0
 
     def capture_images(self):
-        global shutdown
+        """
+        Read frames from the camera at the target frame rate.
+
+        Encoding happens in encode_images(), so reading the next frame overlaps with encoding the previous one.
+        Frames are scheduled against a fixed clock, so the rate doesn't drift with capture time.
+        """
         print('Starting image capture thread')
-        while not shutdown:
+        fps_window_start = time.monotonic()
+        fps_window_frames = 0
+        next_capture_time = time.monotonic()
+        while not self.shutdown:
             try:
-                # print('Image capturing...')
-                self.image_queue.put(self.camera.capture_image())
-                # print('image_queue size', self.image_queue.qsize())
-                time.sleep(self.cap_delay)  # Prevents capture from eating cpu time
+                capture_time = time.time()
+                with CAPTURE_SECONDS.labels(self.channel).time():
+                    frame = self.camera.read_frame()
+                skipped = self._put_latest(self.raw_frame_queue, (frame, capture_time))
+                if skipped:
+                    self.camera.release_frame(skipped[0])
+                    FRAMES_SKIPPED.labels(self.channel).inc()
+                FRAMES_CAPTURED.labels(self.channel).inc()
+                fps_window_frames += 1
+                if time.monotonic() - fps_window_start > FPS_UPDATE_INTERVAL:
+                    CAPTURE_FPS.labels(self.channel).set(fps_window_frames / (time.monotonic() - fps_window_start))
+                    fps_window_start = time.monotonic()
+                    fps_window_frames = 0
+                # Sleep until the next frame is due
+                next_capture_time += 1.0 / self.target_fps
+                delay = next_capture_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind; reset the schedule rather than capturing a burst of frames to catch up
+                    next_capture_time = time.monotonic()
             except RuntimeError as e:
                 print(e)
-                shutdown = True
+                self.shutdown = True
                 break
         self.camera.close()
         print('Exited image capture thread')
 
-    def send_images(self):
-        global shutdown
-        print("Started image sending thread.")
-        while not shutdown:
-            image_data = self.image_queue.get()
+    def encode_images(self):
+        print('Starting image encoding thread')
+        while not self.shutdown:
             try:
-                # print('Image sending...')
-                self.image_sender.send_message(image_data)
-            except redis.exceptions.ConnectionError as e:
-                print(f"Caught connection error to server {e}, trying to reconnect...")
-                time.sleep(1)
-                self.reconnect()
-        print("Exited image sending thread")
+                frame, capture_time = self.raw_frame_queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            if self.change_detector and not self.change_detector.should_send(frame):
+                self.camera.release_frame(frame)
+                FRAMES_SUPPRESSED.labels(self.channel).inc()
+                continue
+            self._adapt_to_congestion()
+            with ENCODE_SECONDS.labels(self.channel).time():
+                image = self.camera.encode_frame(frame)
+            frame_size = self.camera.get_frame_size(frame)
+            self.camera.release_frame(frame)
+            if self.sender.put_frame(self.channel, self._wrap_frame(image, capture_time, frame_size)):
+                FRAMES_DISCARDED.labels(self.channel).inc()
+        print('Exited image encoding thread')
+
+    def _adapt_to_congestion(self):
+        if not self.congestion_controller:
+            return
+        level = self.congestion_controller.update(self.sender.queue_fill)
+        if level.jpeg_quality != self.camera.jpeg_quality:
+            self.camera.set_jpeg_quality(level.jpeg_quality)
+        self.target_fps = self.base_fps * level.fps_factor
+        STREAM_LEVEL.labels(self.channel).set(self.congestion_controller.level_index)
 
-    def reconnect(self):
-        self.image_sender = RedisImageSender(socket.gethostname(), self.server_address, self.server_port)
+    @staticmethod
+    def _put_latest(frame_queue: queue.Queue, item):
+        """
+        Put an item on a bounded queue, discarding the oldest item if it is full. Returns the discarded item, if any.
+        """
+        dropped = None
+        while True:
+            try:
+                frame_queue.put_nowait(item)
+                return dropped
+            except queue.Full:
+                try:
+                    dropped = frame_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def _wrap_frame(self, image: memoryview, capture_time: float, frame_size: Tuple[int, int]) -> memoryview:
+        """Pack the encoded image into a pooled buffer, which the sender releases once the frame has been sent."""
+        width, height = frame_size
+        header = FrameHeader(self.channel, self.sequence, capture_time, width, height)
+        self.sequence += 1
+        buffer = self.sender.buffer_pool.acquire(packed_frame_length(header, len(image)))
+        return pack_frame_into(buffer, header, image)
 
 
 if __name__ == '__main__':
@@ -63,16 +154,59 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--redis-url', help='Server address to stream images to', default='localhost')
     parser.add_argument('--redis-port', help='Server port to stream images to', default=6380)
-    parser.add_argument('--capture-delay', help="Delay between capturing a new frame", default=0.1)
-    parser.add_argument('--cam-class', help="Choose a defined Camera class from camera.py", default='WebCam720p')
+    parser.add_argument('--capture-delay', help="Delay between capturing a new frame", type=float, default=0.1)
+    parser.add_argument('--fps', help="Target capture frame rate (overrides --capture-delay)", type=float,
+                        default=None)
+    parser.add_argument('--disable-adaptive-quality', help="Don't reduce quality when the link is congested",
+                        action='store_true')
+    parser.add_argument('--suppress-static-frames', help="Only send frames when the scene changes",
+                        action='store_true')
+    parser.add_argument('--heartbeat-interval', help="With --suppress-static-frames, send a frame at least this "
+                                                     "often (seconds)", type=float, default=10.0)
+    parser.add_argument('--spool-dir', help="Directory in which to store frames while the server is unreachable "
+                                            "(disabled if not set)", default=None)
+    parser.add_argument('--spool-max-mb', help="Max size of the spool in MB", type=int, default=512)
+    parser.add_argument('--spool-replay-rate', help="Max frames/s per camera to send when replaying the spool",
+                        type=float, default=50.0)
+    parser.add_argument('--cam-class', help=f"Camera to use: one of {', '.join(get_camera_names())}, or a "
+                                            f"module:Class path", default='WebCam720p')
+    parser.add_argument('--cam-config', help="Camera constructor arguments, as a JSON object or the path to a JSON "
+                                             "file (e.g. '{\"usb_port\": 1, \"image_rotation\": 180}')", default=None)
+    parser.add_argument('--cameras', help="Stream several cameras from this process: a JSON list, or the path to a JSON "
+                                          "file, of objects with a name and optionally class, config (constructor "
+                                          "arguments), channel and fps. Overrides --cam-class and --cam-config",
+                        default=None)
+    parser.add_argument('--metrics-port', help='Port to serve Prometheus metrics on (disabled if not set)', type=int,
+                        default=None)
     args = parser.parse_args()
-    # Setup streamer and start threads
-    if args.cam_class == 'WebCam720p':
-        streamer = Streamer(args.redis_url, args.redis_port, args.capture_delay, webcam720p)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    # All cameras share one connection to the server
+    sender = FrameSender(args.redis_url, args.redis_port, args.spool_dir, args.spool_max_mb, args.spool_replay_rate)
+    # Setup streamers and start threads
+    streamers: List[Streamer] = []
+    if args.cameras:
+        for index, camera_config in enumerate(load_camera_config(args.cameras)):
+            camera_name = camera_config.get('name', str(index))
+            camera = create_camera(camera_config.get('class', args.cam_class), **camera_config.get('config', {}))
+            channel = camera_config.get('channel', f"{socket.gethostname()}-{camera_name}")
+            streamers.append(Streamer(sender, camera, channel, args.capture_delay, camera_config.get('fps', args.fps),
+                                      not args.disable_adaptive_quality, args.suppress_static_frames,
+                                      args.heartbeat_interval))
     else:
-        raise ValueError(f"Invalid camera class: {args.cam_class}. Add a new camera class to camera.py and streamer.py.")
-    
-    captureThread = Thread(target=streamer.capture_images)
-    senderThread = Thread(target=streamer.send_images)
-    captureThread.start()
+        camera = create_camera(args.cam_class, **load_camera_config(args.cam_config))
+        streamers.append(Streamer(sender, camera, None, args.capture_delay, args.fps, not args.disable_adaptive_quality,
+                                  args.suppress_static_frames, args.heartbeat_interval))
+
+    camera_threads = []
+    for streamer in streamers:
+        camera_threads.append(Thread(target=streamer.capture_images))
+        camera_threads.append(Thread(target=streamer.encode_images))
+    senderThread = Thread(target=sender.run)
+    for thread in camera_threads:
+        thread.start()
     senderThread.start()
+    # Keep sending until every camera has stopped
+    for thread in camera_threads:
+        thread.join()
+    sender.shutdown = True
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from smart_sec_cam.metrics import Gauge
+from smart_sec_cam.video.encoders import Encoder, EncoderError, FFmpegEncoder, OpenCVEncoder, create_encoder
+
+
+ENCODER_FPS = Gauge("encoder_benchmark_fps", "Frames per second each encoder managed when benchmarked", ["encoder"])
+
+BENCHMARK_RESOLUTION = (1280, 720)
+BENCHMARK_FRAMES = 30
+
+
+def generate_frames(resolution: Tuple[int, int], count: int) -> List[np.ndarray]:
+    """
+    Synthetic frames that are roughly as hard to encode as camera footage: a gradient background with sensor-like
+    noise, and a block moving across it.
+    """
+    width, height = resolution
+    background = np.tile(np.linspace(0, 200, width, dtype=np.uint8)[np.newaxis, :, np.newaxis], (height, 1, 3))
+    rng = np.random.default_rng(0)
+    block_size = max(1, height // 4)
+    frames = []
+    for index in range(count):
+        frame = background + rng.integers(0, 16, size=background.shape, dtype=np.uint8)
+        x = (index * width // max(1, count)) % max(1, width - block_size)
+        frame[height // 3:height // 3 + block_size, x:x + block_size] = (40, 80, 240)
+        frames.append(frame)
+    return frames
+
+
+def benchmark_encoder(encoder: Encoder, file_type: str = "webm", resolution: Tuple[int, int] = BENCHMARK_RESOLUTION,
+                      frame_count: int = BENCHMARK_FRAMES, frames: Optional[List[np.ndarray]] = None,
+                      ) -> Optional[float]:
+    """Encode synthetic frames and return the throughput in frames per second, or None if the encoder doesn't work."""
+    if frames is None:
+        frames = generate_frames(resolution, frame_count)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, f"benchmark.{file_type}")
+        start_time = time.monotonic()
+        try:
+            encoder.encode(path, file_type, 10, resolution, frames)
+        except (EncoderError, KeyError) as e:
+            print(f"Encoder {encoder.name} failed: {e}")
+            return None
+        elapsed_time = time.monotonic() - start_time
+        # OpenCV doesn't always report a codec it can't use, so check something was written
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            print(f"Encoder {encoder.name} didn't write any video")
+            return None
+    fps = len(frames) / elapsed_time
+    ENCODER_FPS.labels(encoder.name).set(fps)
+    return fps
+
+
+def get_candidate_encoders(ffmpeg_options: Optional[Dict] = None) -> Dict[str, Encoder]:
+    return {"opencv": OpenCVEncoder(), "ffmpeg": FFmpegEncoder(**(ffmpeg_options or {}))}
+
+
+def select_encoder(file_type: str = "webm", ffmpeg_options: Optional[Dict] = None,
+                   resolution: Tuple[int, int] = BENCHMARK_RESOLUTION, frame_count: int = BENCHMARK_FRAMES) -> str:
+    """Benchmark each encoder backend and return the name of the fastest one that works."""
+    frames = generate_frames(resolution, frame_count)
+    results = {}
+    for name, encoder in get_candidate_encoders(ffmpeg_options).items():
+        fps = benchmark_encoder(encoder, file_type, resolution, frames=frames)
+        if fps is not None:
+            print(f"Encoder {encoder.name}: {fps:.1f} fps")
+            results[name] = fps
+    if not results:
+        print("No encoder passed the benchmark; falling back to opencv")
+        return "opencv"
+    return max(results, key=results.get)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the video encoder backends",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--file-type', help='Video format to encode', choices=["webm", "mp4"], default="webm")
+    parser.add_argument('--width', help='Frame width', type=int, default=BENCHMARK_RESOLUTION[0])
+    parser.add_argument('--height', help='Frame height', type=int, default=BENCHMARK_RESOLUTION[1])
+    parser.add_argument('--frames', help='Number of frames to encode', type=int, default=BENCHMARK_FRAMES)
+    parser.add_argument('--encoder', help='Encoder to benchmark, or auto to compare them all',
+                        choices=["auto", "opencv", "ffmpeg"], default="auto")
+    parser.add_argument('--encoder-codec', help='ffmpeg codec (defaults to libvpx-vp9 for webm, libx264 for mp4)',
+                        type=str, default=None)
+    parser.add_argument('--encoder-preset', help='ffmpeg speed preset', choices=FFmpegEncoder.PRESETS,
+                        default="veryfast")
+    parser.add_argument('--encoder-threads', help='ffmpeg encoder threads (0 for automatic)', type=int, default=0)
+    parser.add_argument('--encoder-crf', help='ffmpeg constant rate factor (lower is better quality)', type=int,
+                        default=None)
+    args = parser.parse_args()
+
+    options = {"codec": args.encoder_codec, "preset": args.encoder_preset, "threads": args.encoder_threads,
+               "crf": args.encoder_crf}
+    if args.encoder == "auto":
+        print(f"Fastest encoder: {select_encoder(args.file_type, options, (args.width, args.height), args.frames)}")
+    else:
+        result = benchmark_encoder(create_encoder(args.encoder, **options), args.file_type, (args.width, args.height),
+                                   args.frames)
+        print(f"{args.encoder}: {result:.1f} fps" if result is not None else f"{args.encoder}: failed")
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from smart_sec_cam.metrics import Counter, Gauge, Histogram
+from smart_sec_cam.video.encoders import EncoderError, FFmpegEncoder
+from smart_sec_cam.video.manager import VideoManager
+from smart_sec_cam.video.mjpeg import MJPEG_EXTENSION
+
+
+CACHE_DIR_NAME = "transcoded"
+
+CACHE_REQUESTS = Counter("transcode_cache_requests", "Requests for a video format that wasn't recorded, by outcome",
+                         ["result"])
+CACHE_BYTES = Gauge("transcode_cache_bytes", "Size of the transcoded video cache")
+CACHE_TRANSCODE_SECONDS = Histogram("transcode_cache_transcode_seconds", "Time spent transcoding a requested video",
+                                    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+
+
+class TranscodeCache:
+    """
+    Transcodes recordings to formats that weren't recorded, the first time each one is requested.
+
+    Transcoded files are kept in `<video_dir>/transcoded/`, and the least recently used are evicted once the cache
+    grows beyond max_bytes. Concurrent requests for the same file share a single transcode. Use is recorded in each
+    file's access time (so it's shared by all server workers); the modification time is left alone, since responses'
+    ETags and Last-Modified headers are derived from it.
+    """
+    # Recorded formats to transcode from, in order of preference. MJPEG recordings that haven't been transcoded yet
+    # are the best source, since they've not been compressed twice.
+    SOURCE_EXTENSIONS = [MJPEG_EXTENSION, *VideoManager.VIDEO_FORMATS]
+
+    def __init__(self, video_dir: str, max_bytes: int = 1 << 30, encoder: Optional[FFmpegEncoder] = None,
+                 run_blocking: Optional[Callable] = None):
+        self.video_dir = video_dir
+        self.cache_dir = os.path.join(video_dir, CACHE_DIR_NAME)
+        self.max_bytes = max_bytes
+        self.encoder = encoder if encoder is not None else FFmpegEncoder()
+        # run_blocking(func, *args) lets the caller wait for ffmpeg off its event loop (e.g. eventlet.tpool.execute)
+        self.run_blocking = run_blocking or (lambda func, *args: func(*args))
+        self._in_flight: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get(self, file_name: str, source_dir: Optional[str] = None) -> Optional[str]:
+        """
+        Path to a cached copy of `file_name` (e.g. `<clip>.mp4`), transcoding it if necessary. Recordings are looked
+        for in source_dir, which defaults to the video directory. Returns None if there's no recording of the clip to
+        transcode from, or transcoding fails.
+        """
+        base_name, extension = os.path.splitext(file_name)
+        file_type = extension[1:]
+        if file_type not in VideoManager.VIDEO_FORMATS or os.path.basename(file_name) != file_name:
+            return None
+        cached_path = os.path.join(self.cache_dir, file_name)
+        while True:
+            if os.path.isfile(cached_path):
+                self._mark_used(cached_path)
+                CACHE_REQUESTS.labels("hit").inc()
+                return cached_path
+            with self._lock:
+                in_flight = self._in_flight.get(file_name)
+                if in_flight is None:
+                    self._in_flight[file_name] = threading.Event()
+                    break
+            # Another request is transcoding this file; wait for it and use the result
+            in_flight.wait()
+            if not os.path.isfile(cached_path):
+                CACHE_REQUESTS.labels("failed").inc()
+                return None
+        try:
+            return self._transcode(source_dir or self.video_dir, base_name, file_type, cached_path)
+        finally:
+            with self._lock:
+                self._in_flight.pop(file_name).set()
+
+    def remove(self, video_name: str):
+        """Delete any cached copies of a clip (e.g. when the recording is deleted)."""
+        base_name = os.path.splitext(video_name)[0]
+        for file_type in VideoManager.VIDEO_FORMATS:
+            cached_path = os.path.join(self.cache_dir, f"{base_name}.{file_type}")
+            if os.path.isfile(cached_path):
+                os.remove(cached_path)
+
+    def _transcode(self, source_dir: str, base_name: str, file_type: str, cached_path: str) -> Optional[str]:
+        source_path = self._find_source(source_dir, base_name, file_type)
+        if source_path is None:
+            CACHE_REQUESTS.labels("missing").inc()
+            return None
+        # Named per process, since several server workers may transcode the same file
+        temp_path = f"{cached_path}.{os.getpid()}.tmp"
+        start_time = time.monotonic()
+        try:
+            self.run_blocking(self.encoder.transcode, source_path, temp_path, file_type)
+        except EncoderError as e:
+            print(f"Failed to transcode {source_path} to {file_type}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            CACHE_REQUESTS.labels("failed").inc()
+            return None
+        os.rename(temp_path, cached_path)
+        CACHE_TRANSCODE_SECONDS.observe(time.monotonic() - start_time)
+        CACHE_REQUESTS.labels("miss").inc()
+        self._evict(keep=cached_path)
+        return cached_path
+
+    def _find_source(self, source_dir: str, base_name: str, file_type: str) -> Optional[str]:
+        for extension in self.SOURCE_EXTENSIONS:
+            if extension == file_type:
+                continue
+            source_path = os.path.join(source_dir, f"{base_name}.{extension}")
+            if os.path.isfile(source_path):
+                return source_path
+        return None
+
+    @staticmethod
+    def _mark_used(path: str):
+        # Set explicitly, since access times often aren't updated on reads (e.g. on noatime or relatime mounts)
+        try:
+            stat = os.stat(path)
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, keep: str):
+        """Delete the least recently used files until the cache fits in max_bytes. `keep` is never deleted."""
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            if file_name.endswith(".tmp") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        CACHE_BYTES.set(total_bytes)
@@ -0,0 +1,74 @@
+import os
+import time
+from typing import Union
+
+from smart_sec_cam.video.mjpeg import MjpegVideoWriter, MJPEG_EXTENSION, TIMESTAMPS_EXTENSION
+
+
+CONTINUOUS_DIR_NAME = "continuous"
+
+
+class ContinuousRecorder:
+    """
+    Records every frame from a camera to back-to-back MJPEG segments of a fixed length.
+
+    Frames are appended to the current segment file as they arrive (see MjpegVideoWriter), so memory use doesn't
+    grow with the segment length. Segments are written to `<video_dir>/continuous/<channel>/`, and their start and end
+    times are indexed in the video database (if given) so they can be looked up by time. Segments older than the
+    retention period are deleted.
+    """
+    def __init__(self, channel: str, video_dir: str = "data/videos", segment_seconds: int = 60,
+                 retention_hours: float = 24, video_db=None):
+        self.channel = channel
+        self.segment_dir = get_segment_dir(video_dir, channel)
+        self.segment_seconds = segment_seconds
+        self.retention_seconds = retention_hours * 3600
+        # A VideoDatabase, or None to record without an index
+        self.video_db = video_db
+        self.writer = MjpegVideoWriter(channel, path=self.segment_dir)
+        self.segment_name = None
+        self.frame_count = 0
+
+    def add_frame(self, frame: Union[bytes, memoryview], timestamp: float):
+        if self.writer.first_frame_time is not None and timestamp - self.writer.first_frame_time >= self.segment_seconds:
+            self.finish()
+        self.writer.add_frame(frame, timestamp)
+        self.frame_count += 1
+        if self.segment_name is None:
+            self.segment_name = os.path.basename(self.writer.video_path)
+            if self.video_db is not None:
+                self.video_db.add_segment(self.channel, self.segment_name, timestamp)
+
+    def finish(self):
+        """Complete the current segment, so the next frame starts a new one."""
+        if self.segment_name is None:
+            return
+        end_time = self.writer.last_frame_time or self.writer.first_frame_time
+        video_path = self.writer.video_path
+        self.writer.write()
+        if self.video_db is not None:
+            self.video_db.finish_segment(self.segment_name, end_time, self.frame_count, os.path.getsize(video_path))
+        self.writer.reset()
+        self.segment_name = None
+        self.frame_count = 0
+        self._remove_expired_segments()
+
+    def _remove_expired_segments(self):
+        # Completed segments aren't modified again, so their modification time is when they ended
+        cutoff = time.time() - self.retention_seconds
+        extension = f".{MJPEG_EXTENSION}"
+        expired_segments = []
+        for file_name in os.listdir(self.segment_dir):
+            path = os.path.join(self.segment_dir, file_name)
+            if file_name.endswith(extension) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                timestamps_path = path[:-len(extension)] + f".{TIMESTAMPS_EXTENSION}"
+                if os.path.exists(timestamps_path):
+                    os.remove(timestamps_path)
+                expired_segments.append(file_name)
+        if expired_segments and self.video_db is not None:
+            self.video_db.mark_segments_deleted(expired_segments)
+
+
+def get_segment_dir(video_dir: str, channel: str) -> str:
+    return os.path.join(video_dir, CONTINUOUS_DIR_NAME, channel)
@@ -0,0 +1,228 @@
+import subprocess
+from abc import ABC, abstractmethod
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+
+class EncoderError(Exception):
+    pass
+
+
+class Encoder(ABC):
+    """
+    Encodes a stream of BGR frames to a video file.
+
+    start() opens the output, write() adds frames one at a time and finish() completes the file, so frames don't
+    need to be buffered by the caller.
+    """
+    name = "encoder"
+
+    @abstractmethod
+    def start(self, path: str, file_type: str, fps: float, resolution: Tuple[int, int]):
+        pass
+
+    @abstractmethod
+    def write(self, frame: np.ndarray):
+        pass
+
+    @abstractmethod
+    def finish(self):
+        pass
+
+    @abstractmethod
+    def abort(self):
+        """Stop encoding without completing the file."""
+        pass
+
+    def encode(self, path: str, file_type: str, fps: float, resolution: Tuple[int, int], frames: List[np.ndarray]):
+        self.start(path, file_type, fps, resolution)
+        try:
+            for frame in frames:
+                self.write(frame)
+        except Exception:
+            self.abort()
+            raise
+        self.finish()
+
+
+class OpenCVEncoder(Encoder):
+    """Encodes with cv2.VideoWriter. Always available, but OpenCV's VP9 encoder is single threaded and slow."""
+    name = "opencv"
+    FOURCCS = {
+        "webm": "VP90",
+        "mp4": "mp4v",
+    }
+
+    def __init__(self):
+        self.writer = None
+
+    def start(self, path: str, file_type: str, fps: float, resolution: Tuple[int, int]):
+        fourcc = cv2.VideoWriter_fourcc(*self.FOURCCS[file_type])
+        self.writer = cv2.VideoWriter(path, fourcc, fps, resolution)
+        if not self.writer.isOpened():
+            self.writer = None
+            raise EncoderError(f"OpenCV can't write {file_type} video")
+
+    def write(self, frame: np.ndarray):
+        self.writer.write(frame)
+
+    def finish(self):
+        self.writer.release()
+        self.writer = None
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+class FFmpegEncoder(Encoder):
+    """
+    Encodes by piping raw frames (or JPEGs) to an ffmpeg subprocess, which can use multithreaded encoders.
+
+    codec defaults to libvpx-vp9 for webm and libx264 for mp4. preset is an x264-style speed preset ("ultrafast" to
+    "veryslow"), which is mapped to the nearest equivalent for VP9. threads=0 lets ffmpeg choose.
+    """
+    name = "ffmpeg"
+    DEFAULT_CODECS = {
+        "webm": "libvpx-vp9",
+        "mp4": "libx264",
+    }
+    # x264 speed presets, fastest first
+    PRESETS = ["ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow"]
+    # Equivalent libvpx -cpu-used values (higher is faster)
+    VPX_CPU_USED = {"ultrafast": 8, "superfast": 8, "veryfast": 7, "faster": 6, "fast": 5, "medium": 4, "slow": 3,
+                    "slower": 2, "veryslow": 1}
+    # Where a CRF isn't given, aim for similar quality from each codec
+    DEFAULT_CRF = {"libvpx-vp9": 40, "libx264": 26}
+
+    def __init__(self, codec: Optional[str] = None, preset: str = "veryfast", threads: int = 0,
+                 crf: Optional[int] = None, ffmpeg_path: str = "ffmpeg", niceness: int = 0):
+        if preset not in self.PRESETS:
+            raise ValueError(f"Invalid preset: {preset}. Choose from {', '.join(self.PRESETS)}")
+        self.codec = codec
+        self.preset = preset
+        self.threads = threads
+        self.crf = crf
+        self.ffmpeg_path = ffmpeg_path
+        self.niceness = niceness
+        self.process = None
+        self.resolution = None
+
+    @property
+    def name(self) -> str:
+        return f"ffmpeg-{self.codec or 'default'}-{self.preset}"
+
+    def start(self, path: str, file_type: str, fps: float, resolution: Tuple[int, int]):
+        input_options = ["-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{resolution[0]}x{resolution[1]}"]
+        self.start_stream(input_options, fps, self.output_options(file_type) + ["-f", file_type, path])
+        self.resolution = resolution
+
+    def start_stream(self, input_options: List[str], fps: float, output_options: List[str]):
+        """
+        Start ffmpeg reading frames from stdin, with arbitrary input and output options (e.g. to read JPEGs, or write
+        HLS segments).
+        """
+        command = [*self._priority_prefix(), self.ffmpeg_path, "-loglevel", "error", "-y", *input_options,
+                   "-framerate", f"{fps:.3f}", "-i", "pipe:0", *output_options]
+        # Only start() reads raw frames of a known size
+        self.resolution = None
+        try:
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        except FileNotFoundError:
+            raise EncoderError(f"ffmpeg not found at '{self.ffmpeg_path}'")
+
+    def write(self, frame):
+        """
+        Write a frame: a BGR image of the resolution given to start() (other sizes are resized to it), or bytes in the
+        stream's input format.
+        """
+        if self.process is None:
+            return
+        if isinstance(frame, np.ndarray) and self.resolution is not None:
+            # ffmpeg splits the raw stream into frames of a fixed size, so one of the wrong size would corrupt every
+            # frame after it
+            if (frame.shape[1], frame.shape[0]) != self.resolution:
+                frame = cv2.resize(frame, self.resolution)
+            frame = np.ascontiguousarray(frame)
+        try:
+            self.process.stdin.write(frame.data if isinstance(frame, np.ndarray) else frame)
+        except (BrokenPipeError, ValueError) as e:
+            self.abort()
+            raise EncoderError(f"ffmpeg stopped: {e}")
+
+    def finish(self):
+        if self.process is None:
+            return
+        self.process.stdin.close()
+        return_code = self.process.wait()
+        self.process = None
+        if return_code != 0:
+            raise EncoderError(f"ffmpeg exited with status {return_code}")
+
+    def abort(self):
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+            self.process.wait()
+        except OSError as e:
+            print(f"Error stopping ffmpeg: {e}")
+        self.process = None
+
+    def transcode(self, source_path: str, path: str, file_type: str):
+        """Transcode a video file, rather than frames from stdin."""
+        command = [*self._priority_prefix(), self.ffmpeg_path, "-loglevel", "error", "-y", "-i", source_path,
+                   *self.output_options(file_type), "-f", file_type, path]
+        try:
+            subprocess.run(command, check=True)
+        except FileNotFoundError:
+            raise EncoderError(f"ffmpeg not found at '{self.ffmpeg_path}'")
+        except subprocess.CalledProcessError as e:
+            raise EncoderError(f"Failed to transcode {source_path}: {e}")
+
+    def output_options(self, file_type: str) -> List[str]:
+        options = self.codec_options(self.codec or self.DEFAULT_CODECS[file_type])
+        if file_type == "mp4":
+            options += ["-movflags", "+faststart"]
+        return options
+
+    def codec_options(self, codec: str) -> List[str]:
+        """ffmpeg options to encode with the given codec at this encoder's speed, quality and thread count."""
+        options = ["-c:v", codec]
+        if codec.startswith("libvpx"):
+            cpu_used = self.VPX_CPU_USED[self.preset]
+            options += ["-deadline", "realtime" if cpu_used >= 5 else "good", "-cpu-used", str(cpu_used),
+                        "-row-mt", "1", "-b:v", "0"]
+        elif codec in ("libx264", "libx265"):
+            options += ["-preset", self.preset]
+        crf = self.crf if self.crf is not None else self.DEFAULT_CRF.get(codec)
+        if crf is not None:
+            options += ["-crf", str(crf)]
+        return options + ["-threads", str(self.threads), "-pix_fmt", "yuv420p"]
+
+    def _priority_prefix(self) -> List[str]:
+        """
+        Run ffmpeg through nice to lower its priority. (Setting it with preexec_fn isn't safe in a process with
+        threads, since the child can deadlock before exec.)
+        """
+        if self.niceness > 0:
+            return ["nice", "-n", str(self.niceness)]
+        return []
+
+
+ENCODERS = {
+    "opencv": OpenCVEncoder,
+    "ffmpeg": FFmpegEncoder,
+}
+
+
+def create_encoder(name: str, **kwargs) -> Encoder:
+    """Create an encoder by name ("opencv" or "ffmpeg"); kwargs are passed to FFmpegEncoder."""
+    if name not in ENCODERS:
+        raise ValueError(f"Invalid encoder: {name}. Choose from {', '.join(ENCODERS)}, or auto")
+    if name == "opencv":
+        return OpenCVEncoder()
+    return FFmpegEncoder(**kwargs)
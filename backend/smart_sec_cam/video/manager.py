@@ -1,7 +1,8 @@
 import os
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Set
 
+from smart_sec_cam.video.mjpeg import MJPEG_EXTENSION
 from smart_sec_cam.video.writer import VideoWriter
 
 
@@ -10,40 +11,36 @@ class VideoManager:
         "webm": ".webm",
         "mp4": ".mp4"
     }
+    # Formats that clips may be recorded in. MJPEG recordings are listed before they've been transcoded.
+    RECORDED_EXTENSIONS = {*VIDEO_FORMATS.values(), "." + MJPEG_EXTENSION}
 
     def __init__(self, video_dir="data/videos/"):
         self.video_dir = video_dir
 
     def get_video_filenames(self, video_format: str = "webm") -> List[str]:
-        file_names = [filename for filename in self._get_all_filenames() if self._is_video_file(filename, video_format)]
+        """
+        Clips in the requested format, most recent first. Clips recorded in another format are included too, since the
+        server transcodes them when they're requested.
+        """
         # Get video timestamps from the filename
         datetimes_to_filenames = {}
-        for file_name in file_names:
-            try:
-                name = self._remove_file_type(file_name, self.VIDEO_FORMATS.get(video_format))
-            except ValueError:
-                continue
+        for name in self._get_clip_names():
             channel, timestamp_iso = name.split(VideoWriter.FILENAME_DELIM)
             video_timestamp = datetime.fromisoformat(timestamp_iso)
-            datetimes_to_filenames.update({video_timestamp: file_name})
+            datetimes_to_filenames.update({video_timestamp: name + self.VIDEO_FORMATS.get(video_format)})
         # Return sorted list of video files, with most recent video first
         datetimes = list(datetimes_to_filenames.keys())
         datetimes.sort(reverse=True)
         return [datetimes_to_filenames[key] for key in datetimes]
 
     def get_video_filenames_by_date(self, video_format: str = "webm") -> Dict[str, List[str]]:
-        all_filenames = [filename for filename in self._get_all_filenames() if self._is_video_file(filename, video_format)]
         filenames_by_date = {}
-        for filename in all_filenames:
-            try:
-                name = self._remove_file_type(filename)
-            except ValueError:
-                continue
+        for name in self._get_clip_names():
             channel, timestamp_iso = name.split(VideoWriter.FILENAME_DELIM)
             date = timestamp_iso.split("T")[0]
             if date not in filenames_by_date.keys():
                 filenames_by_date[date] = []
-            filenames_by_date[date].append(filename)
+            filenames_by_date[date].append(name + self.VIDEO_FORMATS.get(video_format))
         return filenames_by_date
 
     def delete_video(self, video_name: str) -> None:
@@ -59,7 +56,7 @@ class VideoManager:
         # Remove any existing extension from the video name
         base_name = strip_extension(video_name)
 
-        for video_format, extension in self.VIDEO_FORMATS.items():
+        for extension in self.RECORDED_EXTENSIONS:
             video_path = os.path.join(self.video_dir, f"{base_name}{extension}")
             if os.path.isfile(video_path):
                 try:
@@ -77,15 +74,14 @@ class VideoManager:
     def _get_all_filenames(self) -> List[str]:
         return os.listdir(self.video_dir)
 
-    @staticmethod
-    def _is_video_file(filename: str, file_type: str) -> bool:
-        return file_type in filename
-
-    @staticmethod
-    def _remove_file_type(filename: str, file_type: str) -> str:
-        if file_type in filename:
-            return filename.replace(file_type, "")
-        raise ValueError("File is not a supported file type")
+    def _get_clip_names(self) -> Set[str]:
+        """Names (without extension) of the clips recorded in any format."""
+        clip_names = set()
+        for filename in self._get_all_filenames():
+            name, extension = os.path.splitext(filename)
+            if extension in self.RECORDED_EXTENSIONS and VideoWriter.FILENAME_DELIM in name:
+                clip_names.add(name)
+        return clip_names
 
 
 def strip_extension(filename: str) -> str:
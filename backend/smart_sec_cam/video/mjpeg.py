@@ -0,0 +1,225 @@
+import datetime
+import os
+import struct
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+from smart_sec_cam.video.writer import VideoWriter
+
+
+MJPEG_EXTENSION = "avi"
+TIMESTAMPS_EXTENSION = "timestamps.txt"
+IN_PROGRESS_SUFFIX = ".part"
+# AVI 1.0 files are limited to 1 GiB of frames, far more than a recording ever needs
+MAX_AVI_BYTES = 1 << 30
+
+_AVIF_HASINDEX = 0x10
+_AVIIF_KEYFRAME = 0x10
+# JPEG start-of-frame markers; 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) share the range but aren't frame headers
+_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def get_jpeg_dimensions(data: Union[bytes, memoryview]) -> Tuple[int, int]:
+    """Read (width, height) from a JPEG's frame header without decoding it."""
+    view = memoryview(data)
+    offset = 2  # Skip the SOI marker
+    while offset + 4 <= len(view):
+        if view[offset] != 0xFF:
+            offset += 1
+            continue
+        marker = view[offset + 1]
+        if marker == 0xFF:
+            # Fill byte
+            offset += 1
+            continue
+        (segment_length,) = struct.unpack_from(">H", view, offset + 2)
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack_from(">HH", view, offset + 5)
+            return width, height
+        offset += 2 + segment_length
+    raise ValueError("No JPEG frame header found")
+
+
+class MjpegVideoWriter:
+    """
+    Records JPEG frames, exactly as received, to an MJPEG AVI file. Nothing is decoded or encoded.
+
+    Has the same interface as VideoWriter, but frames are JPEG bytes rather than decoded images, and they are streamed
+    to disk as they're added rather than buffered in memory. Frame capture times are written alongside the video in
+    the "timestamp format v2" used by mkvmerge (milliseconds since the first frame, one per line), since the frame
+    rate of a recording isn't constant. The file is named `<name>.avi.part` until write() completes it, and recordings
+    are converted to a web-friendly format later by a Transcoder.
+    """
+    FILENAME_DELIM = VideoWriter.FILENAME_DELIM
+    # The format recordings are transcoded to, and served as
+    SERVED_FILE_TYPE = "webm"
+
+    def __init__(self, channel: str, path="data/videos/"):
+        self.channel = channel
+        self.video_dir = path
+        self.full_filepath = None
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.first_frame_time = None
+        self.last_frame_time = None
+        self.resolution = None
+        self._file: Optional[BinaryIO] = None
+        self._timestamps: List[float] = []
+        self._index: List[Tuple[int, int]] = []  # (offset from the movi list, size) of each frame
+        self._movi_offset = 0
+        self._max_frame_size = 0
+
+    def add_frame(self, frame: Union[bytes, memoryview], timestamp: float):
+        if self.first_frame_time is None:
+            self.first_frame_time = timestamp
+            self.resolution = get_jpeg_dimensions(frame)
+            self._generate_file_name()
+            self._open()
+        else:
+            self.last_frame_time = timestamp
+        if self._file.tell() + len(frame) + 8 > MAX_AVI_BYTES:
+            return
+        self._index.append((self._file.tell() - self._movi_offset, len(frame)))
+        self._write_chunk(b"00dc", frame)
+        self._timestamps.append(timestamp)
+        self._max_frame_size = max(self._max_frame_size, len(frame))
+
+    def write(self):
+        if self._file is None:
+            raise RuntimeError("No frames added to the recording.")
+        print("Writing video to: " + self.full_filepath + " ...")
+        self._finish_file()
+        os.rename(self._part_path, self.video_path)
+        self._write_timestamps()
+        self._clear()
+
+    def discard(self):
+        """Delete the recording in progress."""
+        if self._file is not None:
+            self._file.close()
+            os.remove(self._part_path)
+        self._clear()
+
+    def reset(self):
+        self.discard()
+        self.first_frame_time = None
+        self.last_frame_time = None
+        self.resolution = None
+
+    @property
+    def video_path(self) -> str:
+        return f"{self.full_filepath}.{MJPEG_EXTENSION}"
+
+    @property
+    def video_file_name(self) -> str:
+        """The name the recording is served under once it's been transcoded (or by transcoding it on request)."""
+        return f"{os.path.basename(self.full_filepath)}.{self.SERVED_FILE_TYPE}"
+
+    @property
+    def _part_path(self) -> str:
+        return self.video_path + IN_PROGRESS_SUFFIX
+
+    def _generate_file_name(self):
+        date = datetime.datetime.fromtimestamp(self.first_frame_time)
+        filename = self.channel + self.FILENAME_DELIM + date.strftime("%Y-%m-%d_%H:%M:%S")
+        self.full_filepath = os.path.join(self.video_dir, filename)
+
+    def _open(self):
+        self._file = open(self._part_path, "wb")
+        # Sizes, frame counts and the frame rate are filled in by _finish_file()
+        self._file.write(b"RIFF" + struct.pack("<I", 0) + b"AVI ")
+        self._write_list(b"hdrl", self._main_header(0, 0) + self._stream_list(0, 0))
+        self._file.write(b"LIST" + struct.pack("<I", 0) + b"movi")
+        # Index offsets are relative to the "movi" fourcc
+        self._movi_offset = self._file.tell() - 4
+
+    def _finish_file(self):
+        movi_end = self._file.tell()
+        index = b"".join(struct.pack("<4sIII", b"00dc", _AVIIF_KEYFRAME, offset, size) for offset, size in self._index)
+        self._write_chunk(b"idx1", index)
+        file_size = self._file.tell()
+        fps_numerator, fps_denominator = self._frame_rate()
+        # Patch the headers now that the frame count and rate are known
+        self._file.seek(4)
+        self._file.write(struct.pack("<I", file_size - 8))
+        self._file.seek(12)
+        self._write_list(b"hdrl", self._main_header(fps_numerator, fps_denominator) +
+                         self._stream_list(fps_numerator, fps_denominator))
+        self._file.seek(self._movi_offset - 4)
+        self._file.write(struct.pack("<I", movi_end - self._movi_offset))
+        self._file.close()
+
+    def _frame_rate(self) -> Tuple[int, int]:
+        """The average frame rate, as a (rate, scale) fraction."""
+        if len(self._timestamps) < 2 or self._timestamps[-1] <= self._timestamps[0]:
+            return 10, 1
+        fps = (len(self._timestamps) - 1) / (self._timestamps[-1] - self._timestamps[0])
+        return max(1, round(fps * 1000)), 1000
+
+    def _main_header(self, rate: int, scale: int) -> bytes:
+        microseconds_per_frame = round(1e6 * scale / rate) if rate else 0
+        width, height = self.resolution
+        avih = struct.pack("<14I", microseconds_per_frame, 0, 0, _AVIF_HASINDEX, len(self._index), 0, 1,
+                           self._max_frame_size, width, height, 0, 0, 0, 0)
+        return self._chunk(b"avih", avih)
+
+    def _stream_list(self, rate: int, scale: int) -> bytes:
+        width, height = self.resolution
+        strh = struct.pack("<4s4sIHHIIIIIIIIhhhh", b"vids", b"MJPG", 0, 0, 0, 0, scale, rate, 0, len(self._index),
+                           self._max_frame_size, 0xFFFFFFFF, 0, 0, 0, width, height)
+        strf = struct.pack("<IiiHH4sIiiII", 40, width, height, 1, 24, b"MJPG", width * height * 3, 0, 0, 0, 0)
+        content = b"strl" + self._chunk(b"strh", strh) + self._chunk(b"strf", strf)
+        return b"LIST" + struct.pack("<I", len(content)) + content
+
+    def _write_list(self, list_type: bytes, content: bytes):
+        self._file.write(b"LIST" + struct.pack("<I", len(content) + 4) + list_type + content)
+
+    def _write_chunk(self, chunk_id: bytes, data: Union[bytes, memoryview]):
+        self._file.write(chunk_id + struct.pack("<I", len(data)))
+        self._file.write(data)
+        # Chunks are word aligned
+        if len(data) % 2:
+            self._file.write(b"\0")
+
+    @staticmethod
+    def _chunk(chunk_id: bytes, data: bytes) -> bytes:
+        padding = b"\0" if len(data) % 2 else b""
+        return chunk_id + struct.pack("<I", len(data)) + data + padding
+
+    def _write_timestamps(self):
+        with open(f"{self.full_filepath}.{TIMESTAMPS_EXTENSION}", "w") as timestamps_file:
+            timestamps_file.write("# timestamp format v2\n")
+            for timestamp in self._timestamps:
+                timestamps_file.write(f"{(timestamp - self._timestamps[0]) * 1000:.3f}\n")
+
+    def _clear(self):
+        self._file = None
+        self._timestamps = []
+        self._index = []
+        self._max_frame_size = 0
+
+
+def read_mjpeg_frames(path: str) -> Iterator[bytes]:
+    """Read the JPEG frames of an AVI written by MjpegVideoWriter, in order."""
+    with open(path, "rb") as video_file:
+        # Skip the RIFF header
+        video_file.seek(12)
+        while True:
+            chunk_header = video_file.read(8)
+            if len(chunk_header) < 8:
+                return
+            chunk_id, size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"LIST":
+                # Frames are chunks within the movi list; other lists are skipped
+                if video_file.read(4) != b"movi":
+                    video_file.seek(size - 4, os.SEEK_CUR)
+            elif chunk_id == b"00dc":
+                yield video_file.read(size)
+                video_file.seek(size % 2, os.SEEK_CUR)
+            else:
+                video_file.seek(size + size % 2, os.SEEK_CUR)
+
+
+def read_timestamps(path: str) -> List[float]:
+    """Read a timestamps file written by MjpegVideoWriter, as seconds from the first frame."""
+    with open(path, "r") as timestamps_file:
+        return [float(line) / 1000 for line in timestamps_file if line.strip() and not line.startswith("#")]
@@ -0,0 +1,220 @@
+import datetime
+import os
+import queue
+import shutil
+import threading
+from typing import Optional, List, Dict
+
+import numpy as np
+
+from smart_sec_cam.metrics import Counter
+from smart_sec_cam.video.encoders import EncoderError, FFmpegEncoder
+from smart_sec_cam.video.writer import VideoWriter
+
+
+LIVE_DIR_NAME = "live"
+PLAYLIST_NAME = "index.m3u8"
+PLAYLIST_END_TAG = "#EXT-X-ENDLIST"
+SEGMENT_EXTENSION = ".ts"
+
+LIVE_FRAMES_DROPPED = Counter("live_segment_frames_dropped",
+                              "Frames left out of live segments because ffmpeg fell behind", ["channel"])
+
+
+class LiveSegmentWriter:
+    """
+    Writes an in-progress recording as short HLS segments plus a playlist that is updated as each segment completes.
+
+    Frames are piped to an ffmpeg subprocess as they are recorded, so the event can be watched while it is still
+    happening. Each event is written to its own directory under `<video_dir>/live/`. Frames may be decoded images or
+    JPEG bytes (when recording in passthrough mode), in which case ffmpeg decodes them. Segments are always H.264,
+    which every HLS player supports; the encoder's preset and thread count are used.
+
+    Frames are written to ffmpeg by a thread of its own, from a queue of up to max_queued_frames, so a slow encoder
+    never holds up motion detection; frames that arrive while the queue is full are left out of the live segments.
+    """
+    def __init__(self, channel: str, path="data/videos/", segment_seconds: int = 2,
+                 encoder: Optional[FFmpegEncoder] = None, max_queued_frames: int = 30):
+        self.channel = channel
+        self.live_dir = os.path.join(path, LIVE_DIR_NAME)
+        self.segment_seconds = segment_seconds
+        self.encoder = encoder if encoder is not None else FFmpegEncoder()
+        self.fps = None
+        self.event_dir = None
+        self.resolution = None
+        self.jpeg_input = False
+        self.started = False
+        self.enabled = True
+        self.max_queued_frames = max_queued_frames
+        self.frame_queue = None
+        self.writer_thread = None
+        # Set by the writer thread if ffmpeg fails, after which nothing more is written for the event (restarting ffmpeg
+        # would overwrite the segments already written, which players may have cached)
+        self.failed = threading.Event()
+        # Whether frames of a different size have been skipped in this event (which is only logged once)
+        self.size_changed = False
+
+    def reset(self, fps: float):
+        """Start a new event. Previous events for this channel are removed."""
+        self.discard()
+        self._remove_previous_events()
+        self.fps = max(1, int(round(fps)))
+        self.size_changed = False
+        self.failed.clear()
+        name = self.channel + VideoWriter.FILENAME_DELIM + datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+        self.event_dir = os.path.join(self.live_dir, name)
+
+    def add_frame(self, frame, timestamp):
+        if not self.enabled or self.event_dir is None or self.failed.is_set():
+            return
+        jpeg_input = not isinstance(frame, np.ndarray)
+        if not self.started:
+            self.jpeg_input = jpeg_input
+            if not jpeg_input:
+                self.resolution = (frame.shape[1], frame.shape[0])  # (width, height)
+            self._start_encoder()
+            if not self.started:
+                return
+        # ffmpeg is reading frames in one format, and raw frames of a fixed size, so others can't be written
+        if jpeg_input != self.jpeg_input or (not jpeg_input and (frame.shape[1], frame.shape[0]) != self.resolution):
+            if not self.size_changed:
+                print(f"Frame format or size changed for channel {self.channel}; live segments will resume with the "
+                      f"next event")
+                self.size_changed = True
+            return
+        try:
+            self.frame_queue.put_nowait(frame)
+        except queue.Full:
+            LIVE_FRAMES_DROPPED.labels(self.channel).inc()
+
+    def finish(self):
+        """Flush remaining frames and mark the playlist as complete."""
+        self._stop_writer_thread()
+        if self.failed.is_set():
+            # ffmpeg was stopped part way through, so end the playlist at the last segment it completed
+            self._end_playlist()
+        elif self.started:
+            try:
+                self.encoder.finish()
+            except EncoderError as e:
+                print(f"Error stopping live segment writer for channel {self.channel}: {e}")
+        self.started = False
+        self.event_dir = None
+
+    def discard(self):
+        """Stop writing and delete the current event (e.g. on a false alarm)."""
+        self._stop_writer_thread(discard_frames=True)
+        self.encoder.abort()
+        self.started = False
+        if self.event_dir and os.path.isdir(self.event_dir):
+            shutil.rmtree(self.event_dir, ignore_errors=True)
+        self.event_dir = None
+
+    def _start_encoder(self):
+        os.makedirs(self.event_dir, exist_ok=True)
+        if self.jpeg_input:
+            input_options = ["-f", "mjpeg"]
+        else:
+            input_options = ["-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{self.resolution[0]}x{self.resolution[1]}"]
+        output_options = [
+            *self.encoder.codec_options("libx264"), "-tune", "zerolatency",
+            # Force a keyframe at every segment boundary so each segment is independently playable
+            "-g", str(self.fps * self.segment_seconds), "-sc_threshold", "0",
+            "-f", "hls", "-hls_time", str(self.segment_seconds), "-hls_list_size", "0",
+            "-hls_playlist_type", "event", "-hls_flags", "independent_segments+temp_file",
+            "-hls_segment_filename", os.path.join(self.event_dir, "segment_%05d" + SEGMENT_EXTENSION),
+            os.path.join(self.event_dir, PLAYLIST_NAME),
+        ]
+        try:
+            self.encoder.start_stream(input_options, self.fps, output_options)
+            self.started = True
+        except EncoderError as e:
+            print(f"{e}; disabling live segments for channel {self.channel}")
+            self.enabled = False
+            return
+        self.frame_queue = queue.Queue(maxsize=self.max_queued_frames)
+        self.writer_thread = threading.Thread(target=self._write_frames, args=(self.frame_queue,), daemon=True)
+        self.writer_thread.start()
+
+    def _write_frames(self, frame_queue: queue.Queue):
+        """Write queued frames to ffmpeg until None is queued."""
+        while True:
+            frame = frame_queue.get()
+            if frame is None:
+                return
+            try:
+                self.encoder.write(frame)
+            except EncoderError as e:
+                print(f"Live segment writer for channel {self.channel} stopped for the rest of the event: {e}")
+                self.failed.set()
+                return
+
+    def _stop_writer_thread(self, discard_frames: bool = False):
+        """Wait for the writer thread to write the queued frames (or only the current one, if discard_frames is set)."""
+        if self.writer_thread is None:
+            return
+        if discard_frames:
+            while True:
+                try:
+                    self.frame_queue.get_nowait()
+                except queue.Empty:
+                    break
+        # The thread may already have stopped (if ffmpeg did), in which case nothing is taking frames off the queue
+        while self.writer_thread.is_alive():
+            try:
+                self.frame_queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.writer_thread.join()
+        self.writer_thread = None
+        self.frame_queue = None
+
+    def _end_playlist(self):
+        playlist_path = os.path.join(self.event_dir, PLAYLIST_NAME)
+        if os.path.isfile(playlist_path) and not is_playlist_complete(playlist_path):
+            with open(playlist_path, "a") as playlist_file:
+                playlist_file.write(PLAYLIST_END_TAG + "\n")
+
+    def _remove_previous_events(self):
+        if not os.path.isdir(self.live_dir):
+            return
+        prefix = self.channel + VideoWriter.FILENAME_DELIM
+        for event_name in os.listdir(self.live_dir):
+            if event_name.startswith(prefix):
+                shutil.rmtree(os.path.join(self.live_dir, event_name), ignore_errors=True)
+
+
+def get_live_events(video_dir: str) -> List[Dict]:
+    """List live events in the video directory, with whether each one is still being recorded."""
+    live_dir = os.path.join(video_dir, LIVE_DIR_NAME)
+    if not os.path.isdir(live_dir):
+        return []
+    events = []
+    for event_name in sorted(os.listdir(live_dir), reverse=True):
+        playlist_path = os.path.join(live_dir, event_name, PLAYLIST_NAME)
+        if not os.path.isfile(playlist_path):
+            continue
+        events.append({
+            "name": event_name,
+            "room": event_name.split(VideoWriter.FILENAME_DELIM)[0],
+            "recording": not is_playlist_complete(playlist_path),
+        })
+    return events
+
+
+def is_playlist_complete(playlist_path: str) -> bool:
+    with open(playlist_path, "r") as playlist_file:
+        return PLAYLIST_END_TAG in playlist_file.read()
+
+
+def rewrite_playlist_uris(playlist: str, query: Optional[str]) -> str:
+    """Append a query string to each segment URI, so segment requests carry the same credentials as the playlist."""
+    if not query:
+        return playlist
+    lines = []
+    for line in playlist.splitlines():
+        if line and not line.startswith("#"):
+            line = f"{line}?{query}"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
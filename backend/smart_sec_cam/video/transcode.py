@@ -0,0 +1,140 @@
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from smart_sec_cam.metrics import Counter, Histogram
+from smart_sec_cam.video.encoders import EncoderError, FFmpegEncoder
+from smart_sec_cam.video.mjpeg import MJPEG_EXTENSION, TIMESTAMPS_EXTENSION, read_mjpeg_frames, read_timestamps
+
+
+TRANSCODES = Counter("transcoder_transcodes", "Recordings transcoded from MJPEG, by outcome", ["result"])
+TRANSCODE_SECONDS = Histogram("transcoder_transcode_seconds", "Time spent transcoding a recording",
+                              buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+
+# The default encoder runs ffmpeg at a lower CPU priority than motion detection
+TRANSCODE_NICENESS = 10
+# Recordings with timestamps are transcoded at a constant frame rate of at most this
+MAX_TRANSCODE_FPS = 30.0
+
+
+class Transcoder:
+    """
+    Converts MJPEG recordings (from MjpegVideoWriter) to web formats in the background.
+
+    Transcoding only starts while `is_idle()` returns True, e.g. when no recording is in progress, and ffmpeg runs at
+    a lower CPU priority, so it doesn't compete with motion detection. Once every format has been written the MJPEG
+    original is deleted, unless keep_originals is set.
+
+    Where a recording has a timestamps file, each frame is shown at the time it was captured, rather than at the
+    recording's average frame rate, so gaps (e.g. while a camera's link was congested) play back at the right speed.
+    """
+    def __init__(self, video_dir: str, file_types: List[str] = ["webm"], is_idle: Callable[[], bool] = lambda: True,
+                 poll_interval: float = 5.0, keep_originals: bool = False, encoder: Optional[FFmpegEncoder] = None):
+        self.video_dir = video_dir
+        self.file_types = file_types
+        self.is_idle = is_idle
+        self.poll_interval = poll_interval
+        self.keep_originals = keep_originals
+        self.encoder = encoder if encoder is not None else FFmpegEncoder(niceness=TRANSCODE_NICENESS)
+        self.shutdown = False
+        # Recordings that failed to transcode aren't retried until restart
+        self._failed = set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run_in_background(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown = True
+
+    def run(self):
+        while not self.shutdown:
+            if self.is_idle():
+                recording = self._next_recording()
+                if recording:
+                    if not self.transcode(recording):
+                        self._failed.add(recording)
+                    continue
+            time.sleep(self.poll_interval)
+
+    def transcode(self, base_path: str) -> bool:
+        """Transcode `<base_path>.avi` to each format. Returns True if every format was written."""
+        source_path = f"{base_path}.{MJPEG_EXTENSION}"
+        succeeded = True
+        for file_type in self.file_types:
+            if not os.path.exists(f"{base_path}.{file_type}"):
+                succeeded = self.transcode_file(source_path, base_path, file_type) and succeeded
+        if succeeded and not self.keep_originals:
+            os.remove(source_path)
+            timestamps_path = f"{base_path}.{TIMESTAMPS_EXTENSION}"
+            if os.path.exists(timestamps_path):
+                os.remove(timestamps_path)
+        return succeeded
+
+    def transcode_file(self, source_path: str, base_path: str, file_type: str) -> bool:
+        # Written to a temporary name first, so a partial file is never listed as a video
+        output_path = f"{base_path}.{file_type}"
+        temp_path = f"{output_path}.tmp"
+        print(f"Transcoding {source_path} to {file_type}")
+        start_time = time.monotonic()
+        timestamps_path = f"{base_path}.{TIMESTAMPS_EXTENSION}"
+        try:
+            if os.path.exists(timestamps_path):
+                self._transcode_frames(source_path, read_timestamps(timestamps_path), temp_path, file_type)
+            else:
+                self.encoder.transcode(source_path, temp_path, file_type)
+        except (EncoderError, OSError) as e:
+            print(f"Failed to transcode {source_path}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            TRANSCODES.labels("failed").inc()
+            return False
+        os.rename(temp_path, output_path)
+        TRANSCODE_SECONDS.observe(time.monotonic() - start_time)
+        TRANSCODES.labels("succeeded").inc()
+        return True
+
+    def _transcode_frames(self, source_path: str, timestamps: List[float], path: str, file_type: str):
+        """
+        Pipe a recording's JPEGs to ffmpeg at a constant rate, repeating each frame until the next one's timestamp (and
+        dropping frames that arrived faster than the output rate).
+        """
+        fps = get_frame_rate(timestamps)
+        self.encoder.start_stream(["-f", "mjpeg"], fps,
+                                  self.encoder.output_options(file_type) + ["-f", file_type, path])
+        try:
+            output_count = 0
+            previous_frame = None
+            for frame, timestamp in zip(read_mjpeg_frames(source_path), timestamps):
+                while previous_frame is not None and output_count / fps < timestamp:
+                    self.encoder.write(previous_frame)
+                    output_count += 1
+                previous_frame = frame
+            if previous_frame is not None:
+                self.encoder.write(previous_frame)
+        except Exception:
+            self.encoder.abort()
+            raise
+        self.encoder.finish()
+
+    def _next_recording(self) -> Optional[str]:
+        """A completed MJPEG recording that still needs transcoding, as a path without the extension."""
+        extension = f".{MJPEG_EXTENSION}"
+        for file_name in sorted(os.listdir(self.video_dir)):
+            if file_name.endswith(extension):
+                base_path = os.path.join(self.video_dir, file_name[:-len(extension)])
+                if base_path not in self._failed:
+                    return base_path
+        return None
+
+
+def get_frame_rate(timestamps: List[float]) -> float:
+    """
+    The rate at which frames usually arrived, from the median interval between them. Unlike the average, it isn't
+    lowered by gaps, which would otherwise make the frames around them be dropped.
+    """
+    intervals = sorted(later - earlier for earlier, later in zip(timestamps, timestamps[1:]) if later > earlier)
+    if not intervals:
+        return 10.0
+    return min(MAX_TRANSCODE_FPS, max(1.0, 1 / intervals[len(intervals) // 2]))
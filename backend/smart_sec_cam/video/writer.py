@@ -1,17 +1,17 @@
 import datetime
 import os
-import time
-from typing import Tuple
+from typing import Optional
 
-import cv2
+from smart_sec_cam.video.encoders import Encoder, EncoderError, OpenCVEncoder
 
 
 class VideoWriter:
     FILENAME_DELIM = "__"
 
     def __init__(self, channel: str, path="data/videos/",
-                 file_types: list[str] = ["webm"]):
+                 file_types: list[str] = ["webm"], encoder: Optional[Encoder] = None):
         self.channel = channel
+        self.encoder = encoder if encoder is not None else OpenCVEncoder()
         self.video_dir = path
         self.full_filepath = None
         self._make_target_dir(path)
@@ -43,20 +43,26 @@ class VideoWriter:
         print("Writing video to: " + self.full_filepath + " ...")
         fps = self._calculate_fps()
         
-        if 'webm' in self.file_types:
-            self._write_video("webm", 'VP90', fps)
-        if 'mp4' in self.file_types:
-            self._write_video("mp4", 'mp4v', fps)
+        for file_type in self.file_types:
+            self._write_video(file_type, fps)
         
         self._clear_frame_buffer()
 
-    def _write_video(self, file_type: str, codec: str, fps: int):
+    def _write_video(self, file_type: str, fps: float):
         file_path = f"{self.full_filepath}.{file_type}"
-        fourcc = cv2.VideoWriter_fourcc(*codec)
-        writer = cv2.VideoWriter(file_path, fourcc, fps, self.resolution)
-        for frame in self.frame_buffer:
-            writer.write(frame)
-        writer.release()
+        try:
+            self.encoder.encode(file_path, file_type, fps, self.resolution, self.frame_buffer)
+        except EncoderError as e:
+            print(f"Failed to write {file_path} with the {self.encoder.name} encoder: {e}")
+
+    @property
+    def video_file_name(self) -> str:
+        """The name the recording is served under (its first format), once written."""
+        return f"{os.path.basename(self.full_filepath)}.{self.file_types[0]}"
+
+    def discard(self):
+        """Drop the frames recorded so far."""
+        self._clear_frame_buffer()
 
     def reset(self):
         self._clear_frame_buffer()
@@ -68,17 +74,13 @@ class VideoWriter:
         self.frame_buffer = []
 
     def _generate_file_name(self):
-        date = self._monotonic_to_datetime(self.first_frame_time)
+        # Frame timestamps are unix times (the capture time, when the streamer provides it)
+        date = datetime.datetime.fromtimestamp(self.first_frame_time)
         filename = self.channel + self.FILENAME_DELIM + date.strftime("%Y-%m-%d_%H:%M:%S")
         self.full_filepath = os.path.join(self.video_dir, filename)
 
-    def _calculate_fps(self) -> int:
+    def _calculate_fps(self) -> float:
         elapsed_time = self.last_frame_time - self.first_frame_time
         print('debug elapsed time', elapsed_time)
-        return int(len(self.frame_buffer) / elapsed_time)
-
-    def _monotonic_to_datetime(self, monotonic_timestamp):
-        monotonic_ref = time.monotonic()
-        datetime_ref = datetime.datetime.now()
-        elapsed = monotonic_ref - monotonic_timestamp
-        return datetime_ref - datetime.timedelta(seconds=elapsed)
+        # N frames span N - 1 frame intervals
+        return (len(self.frame_buffer) - 1) / elapsed_time
@@ -17,7 +17,7 @@ import { refreshToken } from "./utils/RefreshToken";
 import SERVER_URL from './config';
 
 const ROOMS_ENDPOINT = "/api/video/rooms"
-let socket = io(SERVER_URL)
+let socket = io(SERVER_URL, { transports: ["websocket"] })
 
 export default function App() {
     const [rooms, setRooms] = React.useState([]);
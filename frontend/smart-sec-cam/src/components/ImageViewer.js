@@ -10,7 +10,7 @@ export default function ImageViewer({ room }) {
 
     useEffect(() => {
         // Initialize a new socket connection
-        const newSocket = io(SERVER_URL);
+        const newSocket = io(SERVER_URL, { transports: ["websocket"] });
 
         const handleImagePayload = (payload) => {
             if (payload.room === room) {        
@@ -52,15 +52,16 @@ export default function ImageViewer({ room }) {
         };
     }, [room, cookies.token]); // Dependencies: room and token
 
+    // Until the first frame arrives over the socket, show the latest snapshot so the tile isn't blank
+    const snapshotUrl = `${SERVER_URL}/api/video/rooms/${encodeURIComponent(room)}/snapshot?token=${cookies.token}`;
+
     return (
         <div className="imageviewer">
-            {srcBlob && (
-                <img
-                    src={`data:image/jpeg;base64,${srcBlob}`}
-                    alt={room}
-                    style={{ maxWidth: "100%", height: "auto" }}
-                />
-            )}
+            <img
+                src={srcBlob ? `data:image/jpeg;base64,${srcBlob}` : snapshotUrl}
+                alt={room}
+                style={{ maxWidth: "100%", height: "auto" }}
+            />
         </div>
     );
 }
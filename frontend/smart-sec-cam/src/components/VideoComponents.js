@@ -1,10 +1,18 @@
 import ReactPlayer from 'react-player'
+import { useCookies } from 'react-cookie';
 import SERVER_URL from '../config';
 
 const VIDEO_ENDPOINT = "/api/video/"
 
+// The server reads the token from the cookie where it can, but the cookie isn't sent when SERVER_URL is a different
+// site, so the token is passed as a query param too.
+function getVideoUrl(videoFileName, token) {
+    return `${SERVER_URL}${VIDEO_ENDPOINT}${videoFileName}?token=${token}`;
+}
+
 export function VideoPlayer(props) {
-    const videoUrl = SERVER_URL + VIDEO_ENDPOINT + props.videoFileName + "?token=" + props.token;
+    const [cookies] = useCookies(["token"]);
+    const videoUrl = getVideoUrl(props.videoFileName, cookies.token);
     return (
         <ReactPlayer
             className="videoPlayer"
@@ -18,8 +26,9 @@ export function VideoPlayer(props) {
     );
 }
 
-export function VideoPreviewer({ videoFileName, token, onMetadataLoaded }) {
-    const videoUrl = `${SERVER_URL}${VIDEO_ENDPOINT}${videoFileName}?token=${token}`;
+export function VideoPreviewer({ videoFileName, onMetadataLoaded }) {
+    const [cookies] = useCookies(["token"]);
+    const videoUrl = getVideoUrl(videoFileName, cookies.token);
 
     const handleMetadata = (e) => {
         if (onMetadataLoaded) {
@@ -21,7 +21,7 @@ import SERVER_URL from '../config';
 const VIDEOS_ENDPOINT = "/api/video/video-list";
 const ROOMS_ENDPOINT = "/api/video/rooms";
 const DELETE_VIDEO_ENDPOINT = "/api/video";
-const socket = io(SERVER_URL);
+const socket = io(SERVER_URL, { transports: ["websocket"] });
 
 Modal.setAppElement("#root");
 
@@ -52,7 +52,7 @@ export default function VideoList(props) {
     const [rooms, setRooms] = useState([]); // Live rooms
     const [hasValidToken, setHasValidToken] = React.useState(null);
     const [tokenTTL, setTokenTTL] = React.useState(null);
-    const [cookies] = useCookies(["token"]);
+    const [cookies, setCookie] = useCookies(["token"]);
     const [editingMode, setEditingMode] = useState(false); // New state for editing mode
     const navigate = useNavigate();
     const [jumpToPage, setJumpToPage] = React.useState("");
@@ -110,7 +110,7 @@ export default function VideoList(props) {
         const tokenRefreshInterval = Math.max((tokenTTL - 60) * 1000, 0);
 
         const timer = setTimeout(() => {
-            refreshToken(cookies.token);
+            refreshToken(cookies.token, setCookie);
             setHasValidToken(null);
         }, tokenRefreshInterval);
 
@@ -334,7 +334,6 @@ export default function VideoList(props) {
                                     >
                                         <VideoPreviewer
                                             videoFileName={item}
-                                            token={cookies.token}
                                             onMetadataLoaded={(duration) =>
                                                 handleMetadataLoaded(item, duration)
                                             }